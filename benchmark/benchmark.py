@@ -0,0 +1,378 @@
+"""
+Throughput benchmarks for the streaming tools, run against the local
+repository stand-in in :mod:`localrepo`.
+
+Each case is run in a separate Python process, so that the module path, signal
+handlers and replaced ``Repository`` of one tool don't affect the others.
+
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from datetime import datetime
+from cStringIO import StringIO
+
+import numpy as np
+
+import localrepo
+
+
+VERSION = '0.1.0'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [ 'bsml2strm-text', 'bsml2strm-binary', 'bsml2strm-framed', 'strm2bsml', 'strm2bsml-overview', 'interface',
+          'flow2bsml', 'flow2strm', 'flow2strm-varint' ]
+
+RECORDING = 'http://localhost/benchmark/synthetic'
+
+
+class Counter(object):
+#=====================
+
+  def __init__(self):
+  #------------------
+    self.bytes = 0
+
+  def write(self, data):
+  #---------------------
+    self.bytes += len(data)
+
+
+def load(tool, module):
+#======================
+  sys.path.insert(0, os.path.join(ROOT, tool))
+  module = __import__(module)
+  module.Repository = localrepo.Repository
+  return module
+
+
+def write_flow_file(fn, seconds, timestamp=datetime(2014, 1, 1)):
+#================================================================
+  """
+  Write a FLOW file with a sine wave flow signal and constant pressure and leak.
+  """
+  import flowfile
+  header = '\r'.join(['BENCHMARK', '1', 'BENCH.FLW', '00000000', '', '', ''])
+  header = header.ljust(flowfile.HEADER_SIZE - 1) + ';'
+  date = ((timestamp.year - 2000) << 9) | (timestamp.month << 5) | timestamp.day
+  clock = (timestamp.hour << 11) | (timestamp.minute << 5) | (timestamp.second >> 1)
+  blocks = np.zeros(seconds, flowfile.BLOCK_DTYPE)
+  t = np.arange(seconds*flowfile.FLOW_RATE)/float(flowfile.FLOW_RATE)
+  blocks['flow'] = (3000*np.sin(2.0*np.pi*t/4.0)).astype(np.int16).reshape(seconds, flowfile.FLOW_RATE)
+  blocks['pressure'] = 1000
+  blocks['leak'] = 20
+  blocks['marker'] = flowfile.BLOCK_MARKER
+  with open(fn, 'wb') as f:
+    f.write(header)
+    f.write(np.array([date, clock], '<u2').tostring())
+    f.write(blocks.tostring())
+    f.write(flowfile.END_OF_DATA)
+
+
+def text_stream(channels, rate, duration):
+#=========================================
+  bsml2strm = load('bsml2strm', 'bsml2strm')
+  localrepo.synthetic_recording(RECORDING, channels, rate, duration)
+  output = StringIO()
+  bsml2strm.bsml2strm([RECORDING], { }, None, { -1: 'f4' }, None, True, output)
+  return output.getvalue()
+
+
+def run_case(case, channels, rate, duration):
+#============================================
+  """
+  Run a benchmark case.
+
+  :return: A tuple giving the number of frames processed, the number of bytes
+    streamed (None if not measured), and the elapsed time in seconds.
+  """
+  frames = int(round(rate*duration))
+  if case in ['bsml2strm-text', 'bsml2strm-binary', 'bsml2strm-framed']:
+    bsml2strm = load('bsml2strm', 'bsml2strm')
+    localrepo.synthetic_recording(RECORDING, channels, rate, duration)
+    output = Counter()
+    binary = not case.endswith('text')
+    start = time.time()
+    bsml2strm.bsml2strm([RECORDING], { }, None, { -1: 'f4' }, None, True, output,
+                        binary, case.endswith('framed'))
+    return (frames, output.bytes, time.time() - start)
+
+  elif case in ['strm2bsml', 'strm2bsml-overview']:
+    stream = text_stream(channels, rate, duration)
+    strm2bsml = load('strm2bsml', 'strm2bsml')
+    repo = localrepo.Repository(RECORDING)
+    rec = repo.new_recording(RECORDING + '/copy')
+    signals = [ rec.new_signal(None, None, rate=rate) for n in xrange(channels) ]
+    start = time.time()
+    overview = strm2bsml.pyramid.OverviewWriter(rec, signals) if case.endswith('overview') else None
+    frames = strm2bsml.strm2bsml(StringIO(stream), rec, signals, range(1, channels + 1), overview=overview)
+    if overview is not None: overview.close()
+    return (frames, len(stream), time.time() - start)
+
+  elif case == 'interface':
+    interface = load('interface', 'interface')
+    localrepo.synthetic_recording(RECORDING, channels, rate, duration)
+    lengths = localrepo.share_lengths()     # The copy is written by another process
+    tmpdir = tempfile.mkdtemp()
+    try:
+      pipe = os.path.join(tmpdir, 'pipe')
+      signals = ' '.join('<signal/%d>' % n for n in xrange(channels))
+      definition = ('stream <%s> to %s signals [ %s ] ' % (RECORDING, pipe, signals)
+                  + 'recording <%s/copy> from %s rate = %g signals [ %s ]' % (RECORDING, pipe, rate, signals))
+      running = multiprocessing.active_children()   # The lengths' manager
+      start = time.time()
+      error = interface.stream_data(definition)
+      for p in multiprocessing.active_children():
+        if p not in running: p.join()
+      elapsed = time.time() - start
+    finally:
+      shutil.rmtree(tmpdir)
+    if error: raise RuntimeError(error)
+    copied = [ lengths.get('%s/copy/signal/%d' % (RECORDING, n), 0) for n in xrange(channels) ]
+    if copied != [ frames ]*channels:
+      raise RuntimeError("Interface copied %s of %d frames" % (copied, frames))
+    return (frames, None, elapsed)
+
+  elif case in ['flow2bsml', 'flow2strm', 'flow2strm-varint']:
+    tool = 'flow2bsml' if case == 'flow2bsml' else 'bsml2strm'
+    module = load(tool, case.split('-')[0])
+    seconds = int(duration)
+    tmpdir = tempfile.mkdtemp()
+    try:
+      fn = os.path.join(tmpdir, 'BENCH.FLW')
+      write_flow_file(fn, seconds)
+      start = time.time()
+      if case == 'flow2bsml':
+        module.send_file(localrepo.Repository(RECORDING), RECORDING, fn)
+        streamed = os.path.getsize(fn)
+      else:
+        output = Counter()
+        if case.endswith('varint'): module.flow2strm([fn], None, output, True, True, 'varint')
+        else:                       module.flow2strm([fn], None, output)
+        streamed = output.bytes
+      elapsed = time.time() - start
+    finally:
+      shutil.rmtree(tmpdir)
+    return (seconds*module.flowfile.FLOW_RATE, streamed, elapsed)
+
+  else:
+    raise ValueError("Unknown benchmark case: %s" % case)
+
+
+COMPRESS_LEVELS = [ 1, 6, 9 ]
+COMPRESS_BLOCK_SIZES = [ 4096, 16384, 65536, 262144, 1048576 ]
+
+def compression_benchmark(duration, levels=COMPRESS_LEVELS, block_sizes=COMPRESS_BLOCK_SIZES):
+#============================================================================================
+  """
+  Compress text and framed streams of FLOW data with different block sizes
+  and levels.
+
+  :return: A list of dictionaries giving the compression ratio and the rates,
+    in MB/s of uncompressed data, of compression and decompression.
+  """
+  flow2strm = load('bsml2strm', 'flow2strm')
+  import streamformat
+  tmpdir = tempfile.mkdtemp()
+  try:
+    fn = os.path.join(tmpdir, 'BENCH.FLW')
+    write_flow_file(fn, int(duration))
+    streams = [ ]
+    for name, args in [ ('text', ()), ('framed', (True, True)) ]:
+      output = StringIO()
+      flow2strm.flow2strm([fn], None, output, *args)
+      streams.append((name, output.getvalue()))
+  finally:
+    shutil.rmtree(tmpdir)
+  results = [ ]
+  for name, stream in streams:
+    for block_size in block_sizes:
+      for level in levels:
+        output = StringIO()
+        start = time.time()
+        compressor = streamformat.Compressor(output, level, block_size)
+        for pos in xrange(0, len(stream), 4096):         # As written to a pipe
+          compressor.write(stream[pos:pos+4096])
+        compressor.flush()
+        compressing = time.time() - start
+        compressed = output.getvalue()
+        start = time.time()
+        if streamformat.StreamInput(StringIO(compressed)).read() != stream:
+          raise RuntimeError("Decompressed stream differs")
+        decompressing = time.time() - start
+        results.append({ 'stream': name, 'block_size': block_size, 'level': level,
+                         'ratio': len(stream)/float(len(compressed)),
+                         'compress MB/s': len(stream)/compressing/1.0e6,
+                         'decompress MB/s': len(stream)/decompressing/1.0e6 })
+  return results
+
+
+def follow_benchmark(channels, rate, duration, block=0.1):
+#=========================================================
+  """
+  Append blocks of ``block`` seconds of data to a new recording, in real time,
+  while following it with ``bsml2strm.stream_arrays()``.
+
+  :return: A dictionary giving the number of frames streamed and the mean,
+    median, 99th percentile and maximum latency, in seconds, between a frame
+    being appended and being streamed.
+  """
+  bsml2strm = load('bsml2strm', 'bsml2strm')
+  uri = RECORDING + '/live'
+  rec = localrepo.Repository(uri).new_recording(uri)
+  signals = [ rec.new_signal(None, None, rate=rate) for n in xrange(channels) ]
+  size = int(round(block*rate))
+  blocks = int(round(duration/block))
+
+  def acquire():
+  #-------------
+    start = time.time()
+    for n in xrange(blocks):
+      time.sleep(max(0.0, start + n*block - time.time()))
+      data = np.sin(2.0*np.pi*np.arange(n*size, (n + 1)*size)/rate)
+      for s in signals: s.append(data)
+    rec.duration = blocks*size/float(rate)
+
+  writer = threading.Thread(target=acquire)
+  writer.start()
+  latencies = [ ]
+  frames = 0
+  appended = signals[-1].appended    # The last signal is written last
+  for frame, data in bsml2strm.stream_arrays([uri], follow=True):
+    now = time.time()
+    frames = frame + len(data)
+    n = 0
+    while appended[n][0] < frames: n += 1
+    latencies.append(now - appended[n][1])
+  writer.join()
+  latencies = np.array(latencies)
+  return { 'frames': frames, 'blocks': blocks, 'mean': latencies.mean(), 'median': np.median(latencies),
+           '99%': np.percentile(latencies, 99), 'max': latencies.max() }
+
+
+def benchmark(cases, channels, rate, duration, latency=0.0, repeat=3):
+#=====================================================================
+  """
+  Run each case ``repeat`` times, in a separate process, keeping the fastest.
+
+  :return: A list of dictionaries giving each case's results.
+  """
+  results = [ ]
+  for case in cases:
+    best = None
+    for n in xrange(repeat):
+      output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                        '--run', case,
+                                        '--channels', str(channels), '--rate', str(rate),
+                                        '--duration', str(duration), '--latency', str(latency)])
+      result = json.loads(output.strip().split('\n')[-1])
+      if best is None or result['seconds'] < best['seconds']: best = result
+    best['frames/s'] = best['frames']/best['seconds']
+    best['MB/s'] = None if best['bytes'] is None else best['bytes']/best['seconds']/1.0e6
+    results.append(best)
+  return results
+
+
+if __name__ == '__main__':
+#=========================
+
+  import logging
+  import docopt
+
+  LOGFORMAT = '%(asctime)s %(levelname)8s %(processName)s: %(message)s'
+  logging.basicConfig(format=LOGFORMAT)
+
+  usage = """Usage:
+  %(prog)s [options] [CASE...]
+  %(prog)s (-h | --help)
+
+Measure the throughput of streaming tools, using a local stand-in for a
+BioSignalML repository with synthetic sine wave signals.
+
+CASE is one of: %(cases)s. All cases are run if none are given.
+
+FLOW cases use a synthetic FLOW file of DURATION seconds, with frames being
+samples of flow at 50 Hz.
+
+
+Options:
+
+  -h --help   Show this text and exit.
+
+  -c N --channels=N              Number of signals to stream [default: 4].
+
+  --compression                  Compare zlib block sizes and levels for
+                                 compressing text and framed FLOW streams.
+
+  -d SECONDS --duration=SECONDS  Duration of streamed data [default: 60].
+
+  --follow                       Measure the latency of streaming a recording
+                                 that's being written, in real time, for
+                                 DURATION seconds.
+
+  --json                         Output results as JSON.
+
+  -l SECONDS --latency=SECONDS   Time added to each repository request [default: 0].
+
+  -n N --repeat=N                Run each case N times, reporting the
+                                 fastest [default: 3].
+
+  -r RATE --rate=RATE            Sampling rate of signals [default: 1000].
+
+  --run=CASE                     Run a single case in this process, printing
+                                 its result as JSON.
+
+"""
+
+  args = docopt.docopt(usage % { 'prog': sys.argv[0], 'cases': ', '.join(CASES) })
+  channels = int(args['--channels'])
+  rate = float(args['--rate'])
+  duration = float(args['--duration'])
+  latency = float(args['--latency'])
+  localrepo.set_latency(latency)
+
+  try:
+    if args['--compression']:
+      results = compression_benchmark(duration)
+      if args['--json']:
+        print json.dumps(results, indent=2)
+      else:
+        print '%-8s %10s %6s %8s %14s %16s' % ('stream', 'block', 'level', 'ratio',
+                                                'compress MB/s', 'decompress MB/s')
+        for r in results:
+          print '%-8s %10d %6d %8.2f %14.2f %16.2f' % (r['stream'], r['block_size'], r['level'],
+            r['ratio'], r['compress MB/s'], r['decompress MB/s'])
+    elif args['--follow']:
+      result = follow_benchmark(channels, rate, duration)
+      if args['--json']:
+        print json.dumps(result, indent=2)
+      else:
+        print '%(frames)d frames in %(blocks)d blocks' % result
+        print 'Latency (seconds): mean %(mean).4f, median %(median).4f, 99%% %(99%).4f, maximum %(max).4f' % result
+    elif args['--run'] is not None:
+      frames, streamed, seconds = run_case(args['--run'], channels, rate, duration)
+      print json.dumps({ 'case': args['--run'], 'frames': frames, 'bytes': streamed,
+                         'seconds': seconds, 'channels': channels, 'rate': rate,
+                         'latency': latency })
+    else:
+      cases = args['CASE'] or CASES
+      for c in cases:
+        if c not in CASES: raise ValueError("Unknown benchmark case: %s" % c)
+      results = benchmark(cases, channels, rate, duration, latency, int(args['--repeat']))
+      if args['--json']:
+        print json.dumps(results, indent=2)
+      else:
+        print '%-18s %12s %10s %10s' % ('case', 'frames/s', 'MB/s', 'seconds')
+        for r in results:
+          print '%-18s %12.0f %10s %10.3f' % (r['case'], r['frames/s'],
+            '-' if r['MB/s'] is None else '%.2f' % r['MB/s'], r['seconds'])
+  except Exception, msg:
+    sys.exit(msg)
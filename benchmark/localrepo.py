@@ -0,0 +1,287 @@
+"""
+A local stand-in for a BioSignalML repository
+=============================================
+
+Implements the parts of :class:`biosignalml.client.Repository` used by the
+streaming tools, so they can be run and timed without a server. Recordings are
+held in memory; synthetic recordings, whose signals are generated as they are
+read, are added with :func:`synthetic_recording`. Data appended to other signals
+can be read back, as it's being appended, and a recording is closed when its
+``duration`` is set.
+
+Replace a tool's ``Repository`` with this module's before running it:::
+
+  import bsml2strm, localrepo
+  bsml2strm.Repository = localrepo.Repository
+
+Every request to the repository (getting or creating a resource, reading a
+segment of data, appending data) is delayed by :data:`LATENCY` seconds, to
+simulate a remote server.
+
+"""
+
+import time
+import uuid
+import threading
+import multiprocessing
+
+import numpy as np
+
+
+LATENCY = 0.0       # Seconds added to every request
+
+_lock = threading.Lock()
+_recordings = { }   # Recordings by URI, shared by all Repository instances
+_lengths = None     # Lengths of appended signals, shared with other processes
+
+
+def set_latency(seconds):
+#========================
+  global LATENCY
+  LATENCY = seconds
+
+def _request():
+#--------------
+  if LATENCY > 0: time.sleep(LATENCY)
+
+def share_lengths():
+#===================
+  """
+  Record the length of each signal appended to, in this process or in ones
+  started afterwards, such as an interface's streams, which have their own
+  copies of the repository.
+
+  :return: A dictionary, shared between processes, of lengths by signal URI.
+  """
+  global _lengths
+  _lengths = multiprocessing.Manager().dict()
+  return _lengths
+
+
+class Uri(str):
+#==============
+
+  def make_uri(self, sibling=False):
+  #---------------------------------
+    base = self.rsplit('/', 1)[0] if sibling else self
+    return Uri('%s/%s' % (base, uuid.uuid4()))
+
+
+class DataSegment(object):
+#=========================
+
+  def __init__(self, starttime, data, rate):
+  #-----------------------------------------
+    self.starttime = starttime
+    self.data = data
+    self.rate = rate
+    self.is_uniform = True
+
+  def __len__(self):
+  #-----------------
+    return len(self.data)
+
+
+class Segment(object):
+#=====================
+
+  def __init__(self, uri, start, duration):
+  #----------------------------------------
+    self.uri = Uri(uri)
+    self.start = start
+    self.duration = duration
+
+  def save_to_graph(self, graph):
+  #------------------------------
+    pass
+
+
+class Signal(object):
+#====================
+
+  def __init__(self, recording, uri, units=None, rate=None, generator=None, **kwds):
+  #---------------------------------------------------------------------------------
+    self.recording = recording
+    self.uri = Uri(uri)
+    self.units = units
+    self.rate = rate
+    self.label = kwds.get('label')
+    self.description = kwds.get('description')
+    self._generator = generator
+    self._data = [ ]        # Appended arrays
+    self.length = 0         # Samples appended
+    self.nbytes = 0
+    self.appended = [ ]     # (length, time) after each append
+
+  def read(self, interval=None, segment=None, maxpoints=10000, dtype=None, rate=None, units=None):
+  #-----------------------------------------------------------------------------------------------
+    """
+    Read the signal's data, as a sequence of :class:`DataSegment`\ s of at most
+    ``maxpoints`` samples. ``segment`` gives the offset and count of samples.
+
+    Synthetic signals end at their recording's duration and a ``rate`` other
+    than the signal's is treated as if the repository had resampled the signal.
+    Other signals have the data appended so far, at the signal's rate.
+    """
+    dtype = np.dtype('f8' if dtype is None else dtype)
+    if self._generator is None:
+      rate = self.rate
+      with _lock:
+        if len(self._data) > 1: self._data = [ np.concatenate(self._data) ]
+        stored = self._data[0] if self._data else np.empty(0)
+      end = len(stored)
+    else:
+      rate = self.rate if rate is None else rate
+      end = int(round(self.recording.duration*rate))
+    if segment is not None:
+      first, count = segment
+    elif interval is not None:
+      first, count = int(round(interval[0]*rate)), int(round(interval[1]*rate))
+    else:
+      first, count = 0, end
+    first = min(first, end)
+    count = max(0, min(first + count, end) - first)
+    step = maxpoints if maxpoints else max(count, 1)
+    for pos in xrange(first, first + count, step):
+      _request()
+      n = min(step, first + count - pos)
+      if self._generator is None: data = stored[pos:pos+n].astype(dtype)
+      else:                       data = self._generator(pos, n, rate).astype(dtype)
+      yield DataSegment(pos/float(rate), data, rate)
+
+  def append(self, timeseries, dtype=None):
+  #----------------------------------------
+    _request()
+    if not isinstance(timeseries, (np.ndarray, list)): timeseries = timeseries.data  # A TimeSeries
+    data = np.asarray(timeseries, dtype=dtype)
+    with _lock:
+      self._data.append(data)
+      self.length += len(data)
+      self.nbytes += data.nbytes
+      self.appended.append((self.length, time.time()))
+      if _lengths is not None: _lengths[str(self.uri)] = self.length
+
+  def close(self):
+  #---------------
+    pass
+
+
+class Recording(object):
+#=======================
+
+  def __init__(self, repository, uri, duration=None, **kwds):
+  #----------------------------------------------------------
+    self.repository = repository
+    self.uri = Uri(uri)
+    self.duration = duration
+    self.label = kwds.get('label')
+    self.description = kwds.get('description')
+    self.starttime = kwds.get('starttime')
+    self.metadata = [ ]
+    self.resources = [ ]
+    self._signals = [ ]
+
+  def signals(self):
+  #-----------------
+    return list(self._signals)
+
+  def get_signal(self, uri):
+  #-------------------------
+    for s in self._signals:
+      if s.uri == uri: return s
+    raise IOError("Unknown signal <%s>" % uri)
+
+  def new_signal(self, uri, units, id=None, **kwds):
+  #-------------------------------------------------
+    _request()
+    if uri is None: uri = '%s/signal/%s' % (self.uri, len(self._signals) if id is None else id)
+    signal = Signal(self, uri, units, **kwds)
+    self._signals.append(signal)
+    return signal
+
+  def new_segment(self, uri, at, duration):
+  #----------------------------------------
+    segment = Segment(uri, at, duration)
+    self.resources.append(segment)
+    return segment
+
+  def add_resource(self, resource):
+  #--------------------------------
+    self.resources.append(resource)
+
+  def save_metadata(self, metadata, format=None):
+  #----------------------------------------------
+    _request()
+    self.metadata.append(metadata)
+
+  def close(self):
+  #---------------
+    pass
+
+
+class Repository(object):
+#========================
+
+  def __init__(self, uri):
+  #-----------------------
+    self.uri = uri
+
+  def get_recording(self, uri):
+  #----------------------------
+    _request()
+    with _lock:
+      if uri in _recordings: return _recordings[uri]
+      for rec in _recordings.itervalues():
+        for s in rec.signals():
+          if s.uri == uri: return rec
+    raise IOError("Unknown recording <%s>" % uri)
+
+  def get_signal(self, uri):
+  #-------------------------
+    return self.get_recording(uri).get_signal(uri)
+
+  def new_recording(self, uri, **kwds):
+  #------------------------------------
+    _request()
+    rec = Recording(self, uri, **kwds)
+    with _lock: _recordings[str(uri)] = rec
+    return rec
+
+  def close(self):
+  #---------------
+    pass
+
+
+def sine_wave(frequency=1.0, amplitude=1.0, noise=0.0, seed=0):
+#==============================================================
+  """
+  A signal generator giving ``n`` samples of a sine wave starting at
+  sample ``pos``, with optional Gaussian noise.
+  """
+  def generate(pos, n, rate):
+  #--------------------------
+    t = np.arange(pos, pos + n, dtype=np.float64)/rate
+    data = amplitude*np.sin(2.0*np.pi*frequency*t)
+    if noise: data += np.random.RandomState(seed + pos).normal(0.0, noise, n)
+    return data
+  return generate
+
+
+def synthetic_recording(uri, channels=1, rate=1000.0, duration=60.0, generator=None, units=None):
+#================================================================================================
+  """
+  Add a recording whose signals, ``<uri>/signal/N``, are generated as they are
+  read, by default as sine waves of 1 Hz, 2 Hz, and so on.
+
+  :return: The new :class:`Recording`.
+  """
+  rec = Repository(uri).new_recording(uri, duration=duration)
+  for n in xrange(channels):
+    gen = sine_wave(n + 1.0) if generator is None else generator
+    rec.new_signal(None, units, rate=rate, generator=gen)
+  return rec
+
+
+def clear():
+#===========
+  with _lock: _recordings.clear()
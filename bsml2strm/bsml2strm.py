@@ -1,17 +1,31 @@
-import sys
+import os, sys
 import signal as sighandler
 import threading
 import logging
 
+import numpy as np
+
 from biosignalml.client import Repository
 from biosignalml.units import get_units_uri
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))   # Shared modules
+
 import framestream
+import merging
+import pacing
+import streamformat
+import follower
+import pyramid
+import stages
+import events
+import segments
 
 VERSION = '0.4.0'
 
 BUFFER_SIZE = 10000
 
+QUEUE_SIZE = 4     # Blocks of data queued for each channel by stream_arrays()
+
 ##Stream signals at the given RATE.
 ##Otherwise all URIs must be for signals from the one BioSignalML recording.
 
@@ -21,38 +35,76 @@ _thread_exit = threading.Event()
 class SignalReader(threading.Thread):
 #====================================
 
-  def __init__(self, signal, output, channel, ratechecker, **options):
-  #-------------------------------------------------------------------
+  def __init__(self, signal, output, channel, ratechecker, stop=_thread_exit, stages=(), detection=None,
+                     timed=False, **options):
+  #-------------------------------------------------------------------------------------------------
     threading.Thread.__init__(self)
+    self._stop_reading = stop
+    self._stages = stages           # Applied to uniformly sampled data...
+    self._detection = detection     # ...and then searched for events
+    self._timed = timed             # Put (time, value) rows, for merging
+    self._start = None              # Time of the first uniform sample
+    self._count = 0                 # Uniform samples put
     self._signal = signal
     self._output = output
     self._channel = channel
     self._options = options
     self._ratechecker = ratechecker
+    self.error = None               # ``sys.exc_info()`` if reading fails
 
   def run(self):
   #-------------
     logging.debug("Starting channel %d", self._channel)
     try:
       for ts in self._signal.read(**self._options):
-        if _thread_exit.is_set(): break
+        if self._stop_reading.is_set(): break
         if ts.is_uniform:
-          self._ratechecker.check(ts.rate)
-          self._output.put_data(self._channel, ts.data)
+          self._rate = stages.stages_rate(self._stages, ts.rate)
+          if self._start is None: self._start = ts.starttime
+          if not self._timed: self._ratechecker.check(self._rate)
+          self._put_uniform(stages.apply_stages(self._stages, ts.data))
         else:
-          self._ratechecker.check(None)
+          if not self._timed: self._ratechecker.check(None)
           self._output.put_data(self._channel, ts.points)
+      else:
+        if self._stages and self._start is not None:
+          data = stages.finish_stages(self._stages)
+          if len(data): self._put_uniform(data)
+    except Exception:
+      self.error = sys.exc_info()   # Raised again by whoever is streaming...
+      self._stop_reading.set()      # ...once the other readers stop
+      logging.debug("Channel %d failed", self._channel, exc_info=True)
     finally:
       self._output.put_data(self._channel, None)
+      if self._detection is not None: self._detection.finish()
+      if isinstance(self._signal, follower.Follower):
+        logging.info("Followed channel %d: %s", self._channel, self._signal.stats())
+        self._signal.close()
       logging.debug("Finished channel %d", self._channel)
 
 
+  def _put_uniform(self, data):
+  #----------------------------
+    if self._detection is not None: self._detection.process(data)
+    if self._timed:
+      times = self._start + (self._count + np.arange(len(data)))/float(self._rate)
+      self._count += len(data)
+      data = np.column_stack((times, data))
+    self._output.put_data(self._channel, data)
+
+
 def interrupt(signum, frame):
 #============================
   _thread_exit.set()
   sys.exit()
 
 
+def _raise_error(readers):
+#-------------------------
+  for t in readers:
+    if t.error is not None: raise t.error[0], t.error[1], t.error[2]
+
+
 class RateChecker(object):
 #=========================
 
@@ -69,23 +121,150 @@ class RateChecker(object):
       self._lock.release()
     elif self._rate != rate:
       logging.debug("%s != %s", self._rate, rate)
-      _thread_exit.set()
       raise ValueError("Signal rates don't match")
 
 
-def bsml2strm(uris, units, rate, dtypes, segment, nometadata, outfile, binary=False):
-#====================================================================================
+def get_signals(uris, overview=None):
+#===================================
+  """
+  Find the signals to stream. A recording's URI gives all its signals, other
+  than those of overview pyramids.
 
+  :param overview: If given, get the minimum, maximum and mean signals of this
+    level of each signal's overview pyramid (see :mod:`pyramid`) in place of
+    the signal.
+  """
   signals = [ ]
   for u in uris:
     repo = Repository(u)
     rec = repo.get_recording(u)
     logging.debug("got recording: %s %s", type(rec), str(rec.uri))
-    if u == str(rec.uri): signals.extend([ s for s in rec.signals() if s.rate is not None ])
-    else:                 signals.append(repo.get_signal(u))
+    if u == str(rec.uri): found = [ s for s in rec.signals() if s.rate is not None and not pyramid.is_overview(s.uri) ]
+    else:                 found = [ repo.get_signal(u) ]
+    if overview is not None:
+      found = [ repo.get_signal(pyramid.overview_uri(s.uri, overview, stat))
+                  for s in found for stat in pyramid.STATISTICS ]
+    signals.extend(found)
     repo.close()
-
   logging.debug("got signals: %s", [ (type(s), str(s.uri)) for s in signals ])
+  return signals
+
+
+def signal_events(signal, detectors, rate, start=0.0):
+#=====================================================
+  """
+  Get a :class:`events.Detection` that annotates a signal's recording with the
+  events found by ``detectors``, a list of specifications (see :mod:`events`).
+
+  :param rate: The rate of the data searched.
+  :param start: The time of the data's first sample, from the start of the recording.
+  """
+  found = [ events.make_detector(d, rate) for d in detectors ]
+  repo = Repository(str(signal.uri))
+  rec = repo.get_recording(str(signal.uri))
+  return events.Detection(found, events.EventWriter(rec, repository=repo), signal.uri, start)
+
+
+def start_readers(signals, output, units, rate, dtypes, segment, stop=_thread_exit, follow=False,
+                  decimate=None, method='minmax', filters=None, detect=None, timed=False):
+#================================================================================================
+  ratechecker = RateChecker()
+  readers = [ ]
+  if filters is None: filters = { }
+  if detect is None: detect = { }
+  for n, s in enumerate(signals):
+    signal_rate = s.rate if rate is None else rate
+    processing = [ stages.make_filter(f, signal_rate) for f in filters.get(n, filters.get(-1, [ ])) ]
+    if decimate is not None:
+      processing.append(stages.decimator(signal_rate, decimate, method))
+    detection = None
+    if detect.get(n, detect.get(-1)):
+      detection = signal_events(s, detect.get(n, detect.get(-1)), stages.stages_rate(processing, signal_rate),
+                                0.0 if segment is None else segment[0])
+    if follow: s = follower.Follower(s, follower.RecordingClosed(str(s.uri), Repository), stop)
+    readers.append(SignalReader(s, output, n, ratechecker, stop, processing, detection, timed,
+                                rate=rate,
+                                units=units.get(n, units.get(-1)),
+                                dtype=dtypes.get(n, dtypes.get(-1)),
+                                interval=segment, maxpoints=BUFFER_SIZE))
+    readers[-1].daemon = (stop is not _thread_exit)
+    readers[-1].start()                   # Start thread
+  return readers
+
+
+def stream_arrays(uris, rate=None, segment=None, units=None, dtype='f4', follow=False, overview=None,
+                  decimate=None, method='minmax', filters=None, detect=None, merge=None):
+#=====================================================================================================
+  """
+  Stream signals as blocks of NumPy arrays, without formatting them.
+
+  :param uris: The URIs of signals, or of recordings whose signals are all used.
+  :param rate: The rate to stream signals at. All signals must have this rate
+    if it's not given.
+  :param segment: An optional ``(start, duration)`` tuple, in seconds.
+  :param units: An optional dictionary giving the units to convert each channel
+    to, keyed by channel number, with key -1 giving a default.
+  :param follow: Keep reading signals that are still being written until their
+    recording is closed (see :mod:`follower`).
+  :param overview: Stream the minimum, maximum and mean of each signal at this
+    level of its overview pyramid, as three channels.
+  :param decimate: Decimate signals to this rate, keeping their envelopes with
+    ``method``, either ``minmax`` or ``lttb`` (see :mod:`stages`).
+  :param filters: A dictionary giving a list of filter specifications for
+    channels, by channel number, with ``-1`` for the default (see :mod:`stages`).
+  :param detect: A dictionary, as for ``filters``, of event detectors to run over
+    channels, with events being written to recordings (see :mod:`events`).
+  :param merge: Merge signals, which can have different rates or be irregularly
+    sampled, onto the timeline of all their sample times, with this policy
+    (see :func:`merging.merge`).
+  :return: An iterator giving ``(frame, data)`` tuples, where ``frame`` is the
+    index of the block's first frame and ``data`` is a 2-D array with a row
+    for each frame and a column for each channel, after a column of times
+    when merging.
+  """
+  signals = get_signals(uris, overview)
+  output = framestream.FrameStream(len(signals), True, True, QUEUE_SIZE)
+  stop = threading.Event()           # Separate streams can run at the same time
+  readers = start_readers(signals, output, units or { }, rate, { -1: dtype }, segment, stop, follow,
+                          decimate, method, filters, detect, merge is not None)
+  try:
+    for block in (output.blocks() if merge is None else output.merged(merge)):
+      yield block
+    _raise_error(readers)            # A reader failed, rather than the data ending
+  finally:
+    stop.set()                       # If we're closed early...
+    for t in readers:
+      while t.is_alive():
+        output.discard()             # ...readers may be waiting to queue data
+        t.join(0.1)
+
+
+def bsml2strm(uris, units, rate, dtypes, segment, nometadata, outfile, binary=False, framed=False, encoding=None,
+              compress=None, speed=None, follow=False, overview=None, decimate=None, method='minmax',
+              filters=None, detect=None, merge=None):
+#=================================================================================================================
+  """
+  Stream signals to ``outfile``, following them as they are written if
+  ``follow`` is set, or the level ``overview`` of their overview pyramids.
+  Signals are filtered as given by ``filters``, and then decimated to the rate
+  ``decimate`` if it's given. Events found by the detectors in ``detect`` are
+  written to the signals' recordings.
+
+  Signals are merged onto the timeline of all their sample times if a
+  ``merge`` policy is given (see :func:`merging.merge`), with a first
+  column of times and 64-bit binary values.
+
+  When ``speed`` is given, frames are released at ``speed`` times their
+  sampling rate, and the result is the pacer's statistics (see
+  :meth:`pacing.Pacer.stats`).
+
+  A metadata channel is only sent in text or binary frames, as framed and
+  merged streams have no place for it.
+  """
+
+  if not nometadata and (framed or merge is not None):
+    raise ValueError("A metadata channel can't be sent in %s output" % ('merged' if merge else 'framed'))
+  signals = get_signals(uris, overview)
 
 #  rate = signals[0].rate    ############
 #  for s in signals[1:]:
@@ -95,25 +274,85 @@ def bsml2strm(uris, units, rate, dtypes, segment, nometadata, outfile, binary=Fa
 
   output = framestream.FrameStream(len(signals), nometadata, binary)
   sighandler.signal(sighandler.SIGINT, interrupt)
-  ratechecker = RateChecker()
+  readers = [ ]
+  stream = outfile
+  if decimate is not None: output_rate = decimate
+  else:                    output_rate = signals[0].rate if rate is None else rate
+  pacer = None
+  if speed is not None:
+    pacer = pacing.Pacer(output_rate if merge is None else 1.0, speed)   # Merged rows are paced by time
+  if compress is not None:       # Live data is sent by release() when paced, else on a timer
+    interval = streamformat.COMPRESS_INTERVAL if follow and pacer is None else None
+    outfile = streamformat.Compressor(outfile, compress, interval=interval)
+
+  def release(frame):
+  #------------------
+    outfile.flush()                # Send what's been released...
+    if compress is not None: stream.flush()
+    pacer.wait(frame)              # ...and wait until the next batch is due
+
+  stop = threading.Event()
   readers = [ ]
   try:
-    for n, s in enumerate(signals):
-      readers.append(SignalReader(s, output, n, ratechecker,
-                                  rate=rate,
-                                  units=units.get(n, units.get(-1)),
-                                  dtype=dtypes.get(n, dtypes.get(-1)),
-                                  interval=segment, maxpoints=BUFFER_SIZE))
-      readers[-1].start()                   # Start thread
-
-    for f in output.frames():
-      outfile.write(f)
-      if not binary: outfile.write('\n')
-      # Calling flush() significantly slows throughput...
+    readers = start_readers(signals, output, units, rate, dtypes, segment, stop, follow,
+                            decimate=decimate, method=method, filters=filters, detect=detect,
+                            timed=merge is not None)
+
+    if merge is not None:
+      if framed:
+        writer = streamformat.StreamWriter(outfile, len(signals) + 1, None, '<f8',
+          [ None ] + [ units.get(n, units.get(-1, getattr(s, 'units', None))) for n, s in enumerate(signals) ],
+          [ None ] + [ s.uri for s in signals ], encoding)
+        write = writer.write
+      elif binary:
+        write = lambda data: outfile.write(data.astype('=f8').tostring())
+      else:
+        write = lambda data: outfile.write(''.join('%.6f %s\n' % (r[0], ' '.join('%8g' % v for v in r[1:]))
+                                                     for r in data))
+      origin = None
+      for row, data in output.merged(merge):
+        pos = 0
+        while pos < len(data):
+          end = len(data)
+          if pacer is not None:
+            if origin is None: origin = data[0, 0]
+            end = data[:, 0].searchsorted(data[pos, 0] + pacing.PACING_BATCH*speed, 'right')
+            release(data[pos, 0] - origin)
+          write(data[pos:end])
+          pos = end
+    elif framed:
+      writer = streamformat.StreamWriter(outfile, len(signals),
+        output_rate,
+        dtypes.get(-1),
+        [ units.get(n, units.get(-1, getattr(s, 'units', None))) for n, s in enumerate(signals) ],
+        [ s.uri for s in signals ],
+        encoding)
+      for frame, data in output.blocks():
+        if pacer is None:
+          writer.write(data)
+        else:
+          for pos in xrange(0, len(data), pacer.batch):
+            release(frame + pos)
+            writer.write(data[pos:pos+pacer.batch])
+    else:
+      for n, f in enumerate(output.frames()):
+        if pacer is not None and n % pacer.batch == 0: release(n)
+        outfile.write(f)
+        if not binary: outfile.write('\n')
+        # Calling flush() significantly slows throughput...
+    _raise_error(readers)
+    if compress is not None: outfile.flush()      # Compress what's left
+    if pacer is not None:
+      stream.flush()
+      return pacer.stats()
 
   finally:
+    if compress is not None: outfile.stop()
+    stop.set()                     # If output failed or was interrupted...
     for t in readers:
-      if t.is_alive(): t.join()
+      while t.is_alive():
+        output.discard()           # ...readers may be waiting to queue data
+        t.join(0.1)
 
 
 if __name__ == '__main__':
@@ -122,25 +361,35 @@ if __name__ == '__main__':
   import urlparse
   import docopt
   import pyparsing as pp
-  import numpy as np
 
   LOGFORMAT = '%(asctime)s %(levelname)8s %(threadName)s: %(message)s'
   logging.basicConfig(format=LOGFORMAT)
 
   usage = """Usage:
-  %(prog)s [options] [-u UNITS --units=UNITS] URI...
+  %(prog)s [options] [-u UNITS --units=UNITS] [-f FILTERS --filter=FILTERS]
+                   [-e DETECTORS --detect=DETECTORS] URI...
   %(prog)s (-h | --help)
 
 Channel order is that of the given URIs. If the URI is that of a recording then all
 signals in the recording are streamed.
 
-All signals MUST have the same sampling rate.
+All signals MUST have the same sampling rate, unless they are decimated to a
+common rate with --decimate or merged with --merge.
 
 Each line in a text output stream starts with a frame number, followed by
 space-separated channel values, with the last channel being metadata. A binary
 output stream is a sequence of 32-bit floating point values, with no frame
 number.
 
+A framed output stream starts with a header giving the number of channels, the
+rate, and the units and URI of each signal, followed by blocks of 32-bit floating
+point values, each block prefixed by its length and the number of its first
+frame (see ``streamformat.py``). Signals that are decimal fixed-point values
+(integers divided by a power of ten) can be sent, losslessly, as 16-bit or
+variable length integers.
+
+Any output stream can be compressed, in blocks, with zlib.
+
 
 Options:
 
@@ -150,12 +399,97 @@ Options:
 
   --binary                       Output data as 32-bit floats.
 
+  --compress=LEVEL               Compress the stream with zlib, at LEVEL from
+                                 1 (fastest) to 9 (smallest). With --follow,
+                                 and not --realtime or --speed, data is sent
+                                 at least once a second.
+
   --debug                        Enable debug output.
 
+  --decimate=RATE                Decimate signals to RATE on the client, keeping
+                                 the minimum and maximum of each bucket of
+                                 samples so peaks aren't lost. Signals may have
+                                 different rates, as long as twice each divides
+                                 by RATE.
+
+  -e DETECTORS --detect=DETECTORS
+              A comma separated list of "N:detector" entries, as for FILTERS,
+              giving detectors that search channels for events as they are
+              streamed, with events written to the signal's recording as
+              annotations. A detector is one of:
+
+                above:LEVEL[:DURATION]     A channel is above (or below) LEVEL,
+                below:LEVEL[:DURATION]     for at least DURATION seconds.
+                rising:LEVEL               A channel crosses LEVEL.
+                falling:LEVEL
+                apnea[:DROP[:DURATION]]    A flow signal's amplitude drops by
+                                           at least DROP (default 0.9) for at
+                                           least DURATION (default 10) seconds.
+                hypopnea[:DROP[:DURATION]] As for apnea, with DROP default 0.3.
+                flat[:DURATION[:TOL]]      A channel doesn't change by more than
+                                           TOL for DURATION (default 10) seconds.
+
+              Detectors search data after any filtering and decimation.
+
+  --encoding=ENCODING            Send signals that are fixed-point in a framed
+                                 stream as either "int16" or "varint" integers.
+                                 Implies --framed.
+
+  -f FILTERS --filter=FILTERS    A comma separated list of "N:filter" entries,
+              where "N" is the 0-origin channel number and "filter" is one of:
+
+                lowpass:FREQ[:ORDER]       Butterworth filters, of ORDER 2 by
+                highpass:FREQ[:ORDER]      default, with FREQ in Hz.
+                bandpass:LOW-HIGH[:ORDER]
+                notch:FREQ[:Q]             A notch filter, with Q 30 by default.
+                fir-KIND:FREQ[:TAPS]       A windowed-sinc FIR filter, with
+                                           KIND lowpass, highpass, bandpass
+                                           (with LOW-HIGH) or bandstop (with
+                                           LOW-HIGH), and 101 TAPS by default.
+                fir:FILE                   FIR filter taps read from FILE.
+                sos:FILE                   Second-order sections read from FILE,
+                                           as rows of "b0 b1 b2 a0 a1 a2".
+
+              A channel's filters are applied in the order given, as blocks of
+              data are read, and before any decimation. Filters without a
+              channel number are used for channels that have none given.
+
+              FILTERS can also be in the form "@file", as for UNITS.
+
+  --follow                       Keep streaming signals that are still being
+                                 written, until their recording is closed.
+
+  --framed                       Output a self-describing binary stream of
+                                 blocks of frames.
+
+  --lttb                         Decimate by choosing one sample from each bucket,
+                                 using the Largest Triangle Three Buckets method.
+                                 Each signal's rate must then divide by RATE.
+
+  --merge=POLICY                 Merge signals onto the timeline of all their
+                                 sample times, with times as the first column.
+                                 Signals may have different rates or be
+                                 irregularly sampled. A signal's value at a time
+                                 is its last value (POLICY "hold"), its nearest
+                                 value ("nearest"), or as for "hold" with only
+                                 times when some value changes output
+                                 ("change"). Binary and framed output is 64-bit.
+
   --metadata                     Add a metadata channel (under development).
+                                 Not with --framed, --encoding or --merge.
+
+  --realtime                     Release frames at the signals' sampling rate,
+                                 reporting how late frames were when done.
+
+  --overview=LEVEL               Stream the minimum, maximum and mean of each
+                                 signal at LEVEL (10, 100 or 1000) of its
+                                 overview pyramid, as three channels.
 
   -r RATE --rate RATE            Stream signals at the given RATE.
 
+  --speed=SPEED                  Release frames at SPEED times their sampling
+                                 rate. Implies --realtime.
+
   -s SEGMENT --segment=SEGMENT   Temporal segment of recording to stream.
 
               SEGMENT is either "start-end" or "start:duration", with times being
@@ -225,6 +559,19 @@ Options:
             raise ValueError("Invalid units specification - %s" % e)
     return result
 
+  def parse_specs(specs):
+  #======================
+    result = { }
+    for f in specs:
+      if f.startswith('@'):
+        with open(f[1:]) as file:
+          for channel, specs in parse_specs(file.read().split()).iteritems():
+            result.setdefault(channel, [ ]).extend(specs)
+      else:
+        for l in opt_valuelist.parseString(f):
+          result.setdefault(l[0], [ ]).append(l[1])
+    return result
+
   def parse_dtypes(dtypes):
   #========================
     result = { }
@@ -236,19 +583,6 @@ Options:
           raise ValueError("Invalid datatype - %s" % e)
     return result
 
-  def parse_segment(segment):
-  #==========================
-    if segment in [None, '']:
-      return None
-    elif ':' in segment:
-      ## ISO durations.... OR seconds...
-      return [ float(t) for t in segment.split(':') ]
-    elif '-' in segment:
-      t = [ float(t) for t in segment.split('-') ]
-      return ( t[0], t[1] - t[0] )
-    elif segment:
-      raise ValueError("Invalid segment specification")
-
   def add_base(base, uri):
   #-----------------------
     if base is None or uri is None or uri.startswith('http:'):
@@ -261,14 +595,45 @@ Options:
   if args['--debug']: logging.getLogger().setLevel(logging.DEBUG)
 #  rate = float(args['RATE'])
   units = parse_units(args['--units'])
+  filters = parse_specs(args['--filter'])
+  detect = parse_specs(args['--detect'])
   ##dtypes = parse_dtypes(args['--dtypes'])
   dtypes = { -1: 'f4' }   ## Don't allow user to specify
-  segment = parse_segment(args['--segment'])
+  try:
+    segment = segments.parse_segment(args['--segment'])
+  except ValueError, msg:
+    sys.exit(msg)
   base = args['--base']
   uris = [ add_base(base, u) for u in args['URI'] ]
 
+  encoding = args['--encoding']
+  if encoding not in [None] + streamformat.ENCODINGS:
+    sys.exit("Encoding must be one of: %s" % ', '.join(streamformat.ENCODINGS))
+  compress = None if args['--compress'] is None else int(args['--compress'])
+  merge = args['--merge']
+  if merge not in [None] + merging.MERGE_POLICIES:
+    sys.exit("Merge policy must be one of: %s" % ', '.join(merging.MERGE_POLICIES))
+  try:
+    decimate = parse_rate(args['--decimate'])
+  except ValueError:
+    sys.exit("Invalid decimation rate")
+  try:
+    overview = None if args['--overview'] is None else int(args['--overview'])
+  except ValueError:
+    sys.exit("Invalid overview level")
+  try:
+    speed = float(args['--speed']) if args['--speed'] is not None else (1.0 if args['--realtime'] else None)
+  except ValueError:
+    sys.exit("Invalid speed")
+
   try:
-    bsml2strm(uris, units, parse_rate(args['--rate']), dtypes, segment,
-                    not args['--metadata'], sys.stdout, args['--binary'])
+    stats = bsml2strm(uris, units, parse_rate(args['--rate']), dtypes, segment,
+                            not args['--metadata'], sys.stdout, args['--binary'],
+                            args['--framed'] or encoding is not None, encoding, compress, speed,
+                            args['--follow'], overview, decimate, 'lttb' if args['--lttb'] else 'minmax',
+                            filters, detect, merge)
   except Exception, msg:
     sys.exit(msg)
+  if stats is not None:
+    sys.stderr.write("%(batches)d batches in %(elapsed).3f seconds, %(late)d late "
+                     "(mean %(mean_lateness).4f s, maximum %(max_lateness).4f s)\n" % stats)
@@ -0,0 +1,179 @@
+import os
+import sys
+import errno
+import signal as sighandler
+import threading
+import logging
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))   # Shared modules
+
+import framestream
+import streamformat
+import flowfile
+import segments
+
+VERSION = '0.1.0'
+
+QUEUE_SIZE = 4     # Blocks of data queued for each channel
+
+RATE = flowfile.FLOW_RATE
+
+
+_thread_exit = threading.Event()
+
+class FlowReader(threading.Thread):
+#==================================
+
+  def __init__(self, files, output, interval=None):
+  #------------------------------------------------
+    threading.Thread.__init__(self)
+    self._files = files
+    self._output = output
+    self._interval = interval
+    self.failed = [ ]           # Files that couldn't be read
+
+  def run(self):
+  #-------------
+    try:
+      for fn in self._files:
+        if _thread_exit.is_set(): break
+        try:
+          self._read(fn)
+        except (flowfile.FormatError, IOError), msg:
+          logging.error("%s: %s", fn, msg)
+          self.failed.append(fn)
+    finally:
+      for n in xrange(3): self._output.put_data(n, None)
+      logging.debug("Finished reading")
+
+  def _read(self, fn):
+  #-------------------
+    logging.debug("Reading %s", fn)
+    flow_file = flowfile.FlowFile(fn)
+    try:
+      for flow, pressure, leak in flow_file.data(interval=self._interval):
+        if _thread_exit.is_set(): return
+        self._output.put_data(0, flow)
+        self._output.put_data(1, np.repeat(pressure, RATE))   # Resample 1 Hz to 50 Hz
+        self._output.put_data(2, np.repeat(leak, RATE))
+      for gap in flow_file.gaps:
+        logging.warning("%s: %d bytes of corrupt data at offset %d", fn, gap[3], gap[2])
+    finally:
+      flow_file.close()
+
+
+def interrupt(signum, frame):
+#============================
+  _thread_exit.set()
+  sys.exit()
+
+
+def flow2strm(files, interval, outfile, binary=False, framed=False, encoding=None, compress=None):
+#================================================================================================
+  """
+  Stream FLOW files to ``outfile``, one after another. Files that can't be
+  read are logged and skipped.
+
+  :return: A list of the files that couldn't be read.
+  """
+  output = framestream.FrameStream(3, True, binary, QUEUE_SIZE)
+  _thread_exit.clear()
+  sighandler.signal(sighandler.SIGINT, interrupt)
+  reader = FlowReader(files, output, interval)
+  reader.daemon = True       # Don't wait for the reader if output stops early
+  if compress is not None: outfile = streamformat.Compressor(outfile, compress)
+  try:
+    reader.start()
+    if framed:
+      writer = streamformat.StreamWriter(outfile, 3, RATE, encoding=encoding)
+      for frame, data in output.blocks():
+        writer.write(data)
+    else:
+      for f in output.frames():
+        outfile.write(f)
+        if not binary: outfile.write('\n')
+    if compress is not None: outfile.flush()      # Compress what's left
+  finally:
+    _thread_exit.set()
+  return reader.failed
+
+
+if __name__ == '__main__':
+#=========================
+
+  import docopt
+
+  LOGFORMAT = '%(asctime)s %(levelname)8s %(threadName)s: %(message)s'
+  logging.basicConfig(format=LOGFORMAT)
+
+  usage = """Usage:
+  %(prog)s [options] FILE...
+  %(prog)s (-h | --help)
+
+Stream the flow, pressure and leak signals of FLOW files, one file after
+another, in the same format as bsml2strm. Files that can't be read are reported
+and skipped, and the exit status is then non-zero.
+
+Flow is sampled at 50 Hz; pressure and leak, sampled at 1 Hz, are resampled
+to 50 Hz by repeating each value. Corrupt regions of a file are streamed as NaN.
+
+FLOW data are integers scaled by 0.01, so a framed stream with an encoding is
+around a third the size of a binary stream.
+
+
+Options:
+
+  -h --help   Show this text and exit.
+
+  --binary                       Output data as 32-bit floats.
+
+  --compress=LEVEL               Compress the stream with zlib, at LEVEL from
+                                 1 (fastest) to 9 (smallest).
+
+  --debug                        Enable debug output.
+
+  --encoding=ENCODING            Send values in a framed stream as either "int16"
+                                 or "varint" integers. Implies --framed.
+
+  --framed                       Output a self-describing binary stream of
+                                 blocks of frames (see ``streamformat.py``).
+
+  -o PIPE --output=PIPE          Write the stream to the named PIPE, creating it
+                                 if necessary, instead of to standard output.
+
+  -s SEGMENT --segment=SEGMENT   Temporal segment of each file to stream.
+
+              SEGMENT is either "start-end" or "start:duration", with times being
+              in seconds from the start of the file's data. Times are widened to
+              whole seconds.
+
+"""
+
+  def open_pipe(name):
+  #-------------------
+    try: os.mkfifo(name, 0600)
+    except OSError, e:
+      if e.errno != errno.EEXIST: raise
+    return open(name, 'wb')     # Blocks until there's a reader
+
+
+  args = docopt.docopt(usage % { 'prog': sys.argv[0] } )
+  if args['--debug']: logging.getLogger().setLevel(logging.DEBUG)
+
+  try:
+    segment = segments.parse_segment(args['--segment'])
+    outfile = sys.stdout if args['--output'] is None else open_pipe(args['--output'])
+    try:
+      encoding = args['--encoding']
+      if encoding not in [None] + streamformat.ENCODINGS:
+        raise ValueError("Encoding must be one of: %s" % ', '.join(streamformat.ENCODINGS))
+      compress = None if args['--compress'] is None else int(args['--compress'])
+      failed = flow2strm(args['FILE'], segment, outfile, args['--binary'],
+                         args['--framed'] or encoding is not None, encoding, compress)
+    finally:
+      if outfile is not sys.stdout: outfile.close()
+  except Exception, msg:
+    sys.exit(msg)
+  if failed: sys.exit("%d of %d files couldn't be read" % (len(failed), len(args['FILE'])))
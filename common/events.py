@@ -0,0 +1,379 @@
+"""
+Event detection
+===============
+
+Detectors find events in a signal's data as it's streamed, a block at a time,
+keeping whatever state they need between blocks. Detected events are written to
+the signal's recording as annotations of segments of the recording, and posted to
+its repository in batches.
+
+Detectors are given by specifications of the form ``KIND[:ARGUMENT...]``, with
+durations in seconds:
+
+  * ``above:LEVEL[:DURATION]`` or ``below:LEVEL[:DURATION]``: the signal is
+    above (or below) ``LEVEL`` for at least ``DURATION`` (default 0).
+  * ``rising:LEVEL`` or ``falling:LEVEL``: the signal crosses ``LEVEL``, giving
+    an event with no duration.
+  * ``apnea[:DROP[:DURATION]]``: the amplitude of a flow signal drops by at
+    least ``DROP`` (default 0.9) of its baseline for at least ``DURATION``
+    (default 10).
+  * ``hypopnea[:DROP[:DURATION]]``: as for ``apnea``, with a drop of at least
+    ``DROP`` (default 0.3) but less than an apnea's.
+  * ``flat[:DURATION[:TOLERANCE]]``: the signal changes by no more than
+    ``TOLERANCE`` (default 0) between samples for at least ``DURATION`` (default
+    10).
+
+A flow signal's amplitude is its peak-to-peak range over the
+:data:`ENVELOPE_WINDOW` seconds up to each sample, which is longer than a
+breath, so leaks and offsets don't count, and its baseline is the mean amplitude
+over the :data:`BASELINE_WINDOW` seconds up to each sample. As the range only
+drops when a window has no full breath, flow events are taken to start
+:data:`ENVELOPE_WINDOW` seconds before the drop. NaNs are ignored in windows and
+never match a level.
+
+"""
+
+import os
+import threading
+
+import numpy as np
+
+import biosignalml.model as model
+import biosignalml.rdf as rdf
+
+import windows
+
+
+APNEA_DROP = 0.9
+
+HYPOPNEA_DROP = 0.3
+
+FLOW_EVENT_DURATION = 10.0
+
+FLAT_DURATION = 10.0
+
+ENVELOPE_WINDOW = 6.0      # Seconds
+
+BASELINE_WINDOW = 120.0    # Seconds
+
+EVENT_BATCH = 100          # Events added to a recording at a time
+
+
+class _Runs(object):
+#===================
+
+  def __init__(self, length=1):
+  #----------------------------
+    # Find runs of at least ``length`` samples
+    self._length = max(1, length)
+    self._position = 0
+    self._open = None        # Start of a run continuing into the next block
+
+  def process(self, mask):
+  #-----------------------
+    """
+    :return: A list of ``(start, end)`` sample numbers of runs that ended in the block.
+    """
+    pos = self._position
+    self._position += len(mask)
+    if len(mask) == 0: return [ ]
+    edges = np.diff(np.concatenate(([ 0 ], mask.astype(np.int8), [ 0 ])))
+    starts = list(np.flatnonzero(edges == 1) + pos)
+    ends = list(np.flatnonzero(edges == -1) + pos)
+    if self._open is not None:
+      if starts and starts[0] == pos: starts[0] = self._open
+      else:
+        starts.insert(0, self._open)
+        ends.insert(0, pos)
+      self._open = None
+    if ends and ends[-1] == self._position:
+      self._open = starts.pop()
+      ends.pop()
+    return [ (s, e) for s, e in zip(starts, ends) if e - s >= self._length ]
+
+  def finish(self):
+  #----------------
+    runs = [ ]
+    if self._open is not None and self._position - self._open >= self._length:
+      runs.append((self._open, self._position))
+    self._open = None
+    return runs
+
+
+class _RunningMean(object):
+#==========================
+
+  def __init__(self, size):
+  #------------------------
+    # Mean over ``size`` samples ending at each sample, ignoring NaNs
+    self._size = max(1, size)
+    self._history = np.empty(self._size - 1)
+    self._history.fill(np.nan)
+
+  def process(self, data):
+  #-----------------------
+    data = np.concatenate((self._history, data))
+    self._history = data[len(data) - len(self._history):]
+    valid = ~np.isnan(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return windows.sums(np.where(valid, data, 0.0), self._size)/windows.sums(valid.astype(np.float64), self._size)
+
+
+class _RunningRange(object):
+#===========================
+
+  def __init__(self, size):
+  #------------------------
+    # Maximum less minimum over ``size`` samples ending at each sample, ignoring
+    # NaNs, using the van Herk/Gil-Werman method
+    self._size = max(1, size)
+    self._history = np.empty(self._size - 1)
+    self._history.fill(np.nan)
+
+  def process(self, data):
+  #-----------------------
+    data = np.concatenate((self._history, data))
+    self._history = data[len(data) - len(self._history):]
+    return windows.extremes(data, self._size, np.fmax) - windows.extremes(data, self._size, np.fmin)
+
+
+class _Detector(object):
+#=======================
+
+  def __init__(self, rate, description, mask, runs):
+  #-------------------------------------------------
+    # Events are runs, found by ``runs``, in the boolean mask ``mask(data)`` gives
+    self._rate = float(rate)
+    self._description = description
+    self._mask = mask
+    self._runs = runs
+
+  def _events(self, runs):
+  #-----------------------
+    return [ (s/self._rate, (e - s)/self._rate, self._description) for s, e in runs ]
+
+  def process(self, data):
+  #-----------------------
+    """
+    :return: A list of ``(start, duration, description)`` tuples of the events
+      that ended in the block, with times in seconds from the start of the data.
+    """
+    return self._events(self._runs.process(self._mask(np.asarray(data, dtype=np.float64))))
+
+  def finish(self):
+  #----------------
+    """
+    :return: As for :meth:`process`, for an event continuing to the end of the data.
+    """
+    return self._events(self._runs.finish())
+
+
+class Threshold(_Detector):
+#==========================
+
+  def __init__(self, rate, level, above=True, duration=0.0):
+  #---------------------------------------------------------
+    _Detector.__init__(self, rate, '%s %g' % ('Above' if above else 'Below', level),
+                       self._threshold, _Runs(int(round(duration*rate))))
+    self._level = level
+    self._above = above
+
+  def _threshold(self, data):
+  #--------------------------
+    with np.errstate(invalid='ignore'):
+      return data > self._level if self._above else data < self._level
+
+
+class Crossing(_Detector):
+#=========================
+
+  def __init__(self, rate, level, rising=True):
+  #--------------------------------------------
+    _Detector.__init__(self, rate, '%s through %g' % ('Rising' if rising else 'Falling', level),
+                       None, None)     # Crossings aren't runs, see process()
+    self._level = level
+    self._rising = rising
+    self._previous = np.nan
+    self._position = 0
+
+  def process(self, data):
+  #-----------------------
+    data = np.asarray(data, dtype=np.float64)
+    signal = np.concatenate(([ self._previous ], data))
+    with np.errstate(invalid='ignore'):
+      if self._rising: found = (signal[:-1] <= self._level) & (signal[1:] > self._level)
+      else:            found = (signal[:-1] >= self._level) & (signal[1:] < self._level)
+    crossings = np.flatnonzero(found) + self._position
+    self._position += len(data)
+    if len(data): self._previous = data[-1]
+    return self._events([ (c, c) for c in crossings ])
+
+  def finish(self):
+  #----------------
+    return [ ]
+
+
+class FlowDrop(_Detector):
+#=========================
+
+  def __init__(self, rate, description, drop, limit=None, duration=FLOW_EVENT_DURATION):
+  #-------------------------------------------------------------------------------------
+    self._window = int(round(ENVELOPE_WINDOW*rate))
+    _Detector.__init__(self, rate, description, self._reduced,
+                       _Runs(int(round(duration*rate)) - self._window))
+    self._drop = drop
+    self._limit = limit
+    self._amplitude = _RunningRange(self._window)
+    self._baseline = _RunningMean(int(round(BASELINE_WINDOW*rate)))
+
+  def _events(self, runs):
+  #-----------------------
+    return _Detector._events(self, [ (max(0, s - self._window), e) for s, e in runs ])
+
+  def _reduced(self, data):
+  #------------------------
+    amplitude = self._amplitude.process(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      reduction = 1.0 - amplitude/self._baseline.process(amplitude)
+      mask = reduction >= self._drop
+      if self._limit is not None: mask &= (reduction < self._limit)
+    return mask
+
+
+class FlatLine(_Detector):
+#=========================
+
+  def __init__(self, rate, duration=FLAT_DURATION, tolerance=0.0):
+  #---------------------------------------------------------------
+    _Detector.__init__(self, rate, 'Flat line', self._flat, _Runs(int(round(duration*rate))))
+    self._tolerance = tolerance
+    self._previous = np.nan
+
+  def _flat(self, data):
+  #---------------------
+    signal = np.concatenate(([ self._previous ], data))
+    if len(data): self._previous = data[-1]
+    with np.errstate(invalid='ignore'):
+      return np.abs(np.diff(signal)) <= self._tolerance
+
+
+def make_detector(spec, rate):
+#=============================
+  """
+  Get the detector given by a specification (see above) for a signal at
+  ``rate`` Hz.
+  """
+  parts = spec.split(':')
+  kind = parts[0].lower()
+  try:
+    args = [ float(a) for a in parts[1:] ]
+    if kind in [ 'above', 'below' ] and len(args) in [1, 2]:
+      return Threshold(rate, args[0], kind == 'above', *args[1:])
+    elif kind in [ 'rising', 'falling' ] and len(args) == 1:
+      return Crossing(rate, args[0], kind == 'rising')
+    elif kind in [ 'apnea', 'hypopnea' ] and len(args) <= 2:
+      duration = args[1] if len(args) > 1 else FLOW_EVENT_DURATION
+      if kind == 'apnea':
+        return FlowDrop(rate, 'Apnea', args[0] if args else APNEA_DROP, None, duration)
+      drop = args[0] if args else HYPOPNEA_DROP
+      return FlowDrop(rate, 'Hypopnea', drop, max(drop, APNEA_DROP), duration)
+    elif kind == 'flat' and len(args) <= 2:
+      return FlatLine(rate, *args)
+    raise ValueError("Unknown detector")
+  except ValueError as e:
+    raise ValueError("Invalid detector '%s' - %s" % (spec, e))
+
+
+class EventWriter(object):
+#=========================
+
+  def __init__(self, recording, batch=EVENT_BATCH, repository=None):
+  #-----------------------------------------------------------------
+    """
+    Write events to a recording in a repository as annotations, posting
+    their metadata to the repository once ``batch`` are pending, so they
+    appear while data is still being streamed. Events from several threads can
+    be written at once.
+
+    :param repository: If given, the recording and this repository are closed
+      when the writer is.
+    """
+    self._recording = recording
+    self._repository = repository
+    self._batch = batch
+    self._pending = [ ]
+    self._lock = threading.Lock()
+    self.count = 0
+
+  def add(self, signal, events):
+  #-----------------------------
+    """
+    Add events found in a signal, with times in seconds from the start of its
+    recording.
+    """
+    with self._lock:
+      self._pending.extend((signal, e) for e in events)
+      if len(self._pending) >= self._batch: self._flush()
+
+  def _flush(self):
+  #----------------
+    if not self._pending: return
+    rec = self._recording
+    graph = rdf.Graph(rec.uri)     # Just the new resources
+    for signal, (start, duration, description) in self._pending:
+      segment = rec.new_segment(rec.uri.make_uri(), start, duration)
+      note = model.Annotation.Note(rec.uri.make_uri(), segment.uri, '%s in <%s>' % (description, signal),
+                                   creator='file://' + os.path.abspath(__file__))
+      rec.add_resource(note)
+      segment.save_to_graph(graph)
+      note.save_to_graph(graph)
+    rec.save_metadata(graph.serialise())
+    self.count += len(self._pending)
+    self._pending = [ ]
+
+  def close(self):
+  #---------------
+    """
+    Write any pending events.
+    """
+    with self._lock:
+      self._flush()
+      if self._repository is not None:
+        self._recording.close()
+        self._repository.close()
+        self._repository = None
+
+
+class Detection(object):
+#=======================
+
+  def __init__(self, detectors, writer, signal, start=0.0):
+  #--------------------------------------------------------
+    """
+    Run detectors over a signal's data, writing the events found.
+
+    :param signal: The URI of the signal.
+    :param start: The time, in seconds from the start of the recording, of
+      the signal's first sample.
+    """
+    self._detectors = detectors
+    self._writer = writer
+    self._signal = str(signal)
+    self._start = start
+
+  def _add(self, events):
+  #----------------------
+    if events:
+      self._writer.add(self._signal, [ (self._start + s, d, t) for s, d, t in events ])
+
+  def process(self, data):
+  #-----------------------
+    for d in self._detectors: self._add(d.process(data))
+
+  def finish(self):
+  #----------------
+    """
+    Write events continuing to the end of the data, and any pending events.
+    """
+    for d in self._detectors: self._add(d.finish())
+    self._writer.close()
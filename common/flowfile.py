@@ -0,0 +1,325 @@
+"""
+FLOW files
+==========
+
+A FLOW file has a 512-byte text header followed by a 4-byte timestamp and then
+a sequence of 105-byte blocks, each holding one second of data:
+
+  * 50 flow samples, as little-endian 16-bit integers in units of 0.01 lpm.
+  * A CPAP pressure sample, as a little-endian 16-bit integer in units of 0.01 cmH2O.
+  * A leak sample, as an unsigned byte in units of 0.01 lpm.
+  * A '\\xFF\\xFF' block marker.
+
+Data ends with a block starting with '\\xFF\\x7F\\x00\\x00'.
+
+Corrupt regions, where blocks don't end with a marker, are skipped by searching
+for the next run of :data:`RESYNC_BLOCKS` consecutive good blocks. Each skipped
+region is recorded as a gap, with its duration estimated from the number of bytes
+lost.
+
+"""
+
+import math
+import mmap
+import bisect
+import struct
+from datetime import datetime
+
+import numpy as np
+
+
+HEADER_SIZE = 512
+BLOCK_SIZE  = 105          # One second of data
+CHUNK_SIZE  = 3600         # Blocks decoded at a time
+SCAN_SIZE   = 10000        # Blocks searched at a time when resynchronising
+
+RESYNC_BLOCKS = 8          # Good blocks needed in a row to resynchronise
+
+FLOW_RATE   = 50
+BLOCK_DTYPE = np.dtype([ ('flow',     '<i2', (FLOW_RATE,)),
+                         ('pressure', '<i2'),
+                         ('leak',     'u1'),
+                         ('marker',   '<u2') ])
+
+MISSING_VALUE = -0x8000      # Raw value for data in a gap
+
+BLOCK_MARKER = 0xFFFF
+END_OF_DATA  = '\xFF\x7F\x00\x00'
+
+
+class FormatError(Exception):
+#============================
+  pass
+
+
+def get_time(ts):
+#================
+  buf = buffer(ts)
+  date = struct.unpack_from("<H", buf)[0]
+  year = 2000 + (date >> 9)
+  month = (date & 0x01E0) >> 5
+  day = (date & 0x001F)
+  time = struct.unpack_from("<H", buf, 2)[0]
+  hours = time >> 11
+  mins = (time & 0x07E0) >> 5
+  secs = (time & 0x001F) << 1
+  if (1 <= month <= 12 and 1 <= day <= 31
+   and hours < 24 and mins < 60 and secs < 60):
+    return datetime(year, month, day, hours, mins, secs)
+  else:
+    raise ValueError("Invalid timestamp")
+
+
+def good_block(b):
+#=================
+  return b[103:105] == '\xFF\xFF'
+
+
+def flow_data(blocks):
+#=====================
+  return blocks['flow'].ravel()/100.0
+
+def pressure_data(blocks):
+#=========================
+  return blocks['pressure']/100.0
+
+def leak_data(blocks):
+#=====================
+  return blocks['leak']/100.0
+
+
+def find_blocks(buf, pos, count=RESYNC_BLOCKS):
+#==============================================
+  """
+  Find the first of ``count`` consecutive good blocks at or after ``pos``.
+
+  :return: The position of the first block, or None if there is no such
+    sequence in the remainder of ``buf``.
+  """
+  def shifted(a, n, length):
+  #-------------------------
+    result = np.zeros(length, bool)
+    a = a[n:n+length]
+    result[:len(a)] = a
+    return result
+
+  chain = (count - 1)*BLOCK_SIZE
+  while pos + BLOCK_SIZE <= len(buf):
+    length = min((SCAN_SIZE + count)*BLOCK_SIZE, len(buf) - pos)
+    data = np.frombuffer(buf, np.uint8, length, pos)
+    starts = length - BLOCK_SIZE + 1                    # Possible block positions
+    marker = (data[BLOCK_SIZE-2:length-1] == 0xFF) & (data[BLOCK_SIZE-1:] == 0xFF)
+    ended = ((data[:starts] == 0xFF) & (data[1:starts+1] == 0x7F)
+           & (data[2:starts+2] == 0) & (data[3:starts+3] == 0))
+    if pos + length < len(buf): starts -= chain      # Need a complete chain
+    if starts <= 0: return None
+    good = marker[:starts].copy()
+    finished = np.zeros(starts, bool)                # A shorter chain may end the data
+    for n in xrange(BLOCK_SIZE, chain + 1, BLOCK_SIZE):
+      at_end = shifted(ended, n, starts)
+      good &= finished | at_end | shifted(marker, n, starts)
+      finished |= at_end
+    found = np.flatnonzero(good)
+    if len(found): return pos + int(found[0])
+    pos += starts
+  return None
+
+
+class FlowFile(object):
+#======================
+
+  def __init__(self, fn):
+  #----------------------
+    self._file = open(fn, mode='rb')
+    try:
+      self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+      self._file.close()
+      raise FormatError("File appears to be empty")
+    try:
+      self._read_header()
+    except:
+      self.close()
+      raise
+
+  def _read_header(self):
+  #----------------------
+    buf = self._buf
+    hdr = buf[:HEADER_SIZE]
+    if hdr[-1:] != '\x3B': raise FormatError("Bad file header")
+    header = hdr.split('\x0D')
+    if len(header) != 7: raise FormatError("Wrong header format")
+    if buf[512:516] in ['', '\x00\x00\x00\x00']:
+      raise FormatError("File appears to be empty")
+    self.error = ''
+    try:
+      try:
+        if not good_block(buf[516:]): raise ValueError("Block error")
+        self.timestamp = get_time(buf[512:516])
+        self.start = 516
+      except ValueError:
+        if good_block(buf[1028:]):
+          self.error = "First 512-byte chunk corrupt"
+          self.timestamp = get_time(buf[1024:1028])
+          self.start = 1028
+        else:
+          self.error = "Short first block"
+          self.timestamp = get_time(buf[512:516])
+          self.start = find_blocks(buf, 516)
+          if self.start is None: raise FormatError("No data blocks found")
+    except ValueError, msg:
+      raise FormatError(str(msg))
+    self.gaps = [ ]
+    self.duration = None
+    self._index = None
+    self.header = header
+    self.serialno = header[3]
+    self.fileid = header[2].rsplit('.', 1)[0]
+
+  def close(self):
+  #---------------
+    if self._buf is not None:
+      self._buf.close()
+      self._buf = None
+    self._file.close()
+
+  def _add_gap(self, time, pos, length):
+  #-------------------------------------
+    seconds = max(1, int(math.ceil(length/float(BLOCK_SIZE))))
+    self.gaps.append((time, seconds, pos, length))
+    return seconds
+
+  def _runs(self, size):
+  #---------------------
+    """
+    Find runs of good blocks, recording corrupt regions in :attr:`gaps`
+    and the total duration of data in :attr:`duration`.
+
+    :return: An iterator giving ``(time, position, count)`` tuples for runs
+      of at most ``size`` blocks.
+    """
+    self.gaps = [ ]
+    buf = self._buf
+    pos = self.start
+    time = 0
+    while True:
+      count = min(size, (len(buf) - pos)//BLOCK_SIZE)
+      if count <= 0:
+        if buf[pos:pos+4] not in ['', END_OF_DATA]:
+          time += self._add_gap(time, pos, len(buf) - pos)     # A short final block
+        break
+      blocks = np.frombuffer(buf, BLOCK_DTYPE, count, pos)
+      end = np.flatnonzero((blocks['flow'][:, 0] == 0x7FFF) & (blocks['flow'][:, 1] == 0))
+      if len(end): count = end[0]
+      bad = np.flatnonzero(blocks['marker'][:count] != BLOCK_MARKER)
+      if len(bad): count = bad[0]
+      if count:
+        yield (time, pos, int(count))
+        time += count
+        pos += count*BLOCK_SIZE
+      if len(bad):
+        resync = find_blocks(buf, pos)
+        if resync is None:
+          end = buf.rfind(END_OF_DATA, pos)
+          time += self._add_gap(time, pos, (end if end >= 0 else len(buf)) - pos)
+          break
+        time += self._add_gap(time, pos, resync - pos)
+        pos = resync
+      elif len(end):
+        break
+    self.duration = time
+
+  def chunks(self, size=CHUNK_SIZE):
+  #---------------------------------
+    """
+    Decode the file's data blocks, skipping over any corrupt regions.
+
+    :param size: The maximum number of blocks to decode at a time.
+    :return: An iterator giving ``(time, blocks)`` tuples, where ``time`` is the
+      offset in seconds from the start of data and ``blocks`` is an array of at
+      most ``size`` elements of :data:`BLOCK_DTYPE`.
+
+    Corrupt regions are recorded in :attr:`gaps`, as a list of ``(time, duration,
+    position, length)`` tuples.
+    """
+    for time, pos, count in self._runs(size):   # Copy so we don't keep a view of the mmap
+      yield (time, np.frombuffer(self._buf, BLOCK_DTYPE, count, pos).copy())
+
+  def index(self):
+  #---------------
+    """
+    Find where data for each second is in the file. Only block markers are
+    checked, so this is much faster than decoding the file.
+
+    :return: A list of ``[time, position, count]`` entries for each run of
+      good blocks, in time order.
+    """
+    if self._index is None:
+      runs = [ ]
+      for time, pos, count in self._runs(SCAN_SIZE):
+        if runs and runs[-1][0] + runs[-1][2] == time:
+          runs[-1][2] += count
+        else:
+          runs.append([time, pos, count])
+      self._index = runs
+    return self._index
+
+  def _select(self, start, end, size):
+  #-----------------------------------
+    runs = self.index()
+    n = max(0, bisect.bisect_right([r[0] for r in runs], start) - 1)
+    for time, pos, count in runs[n:]:
+      if time >= end: break
+      first = max(start, time)
+      last = min(end, time + count)
+      pos += (first - time)*BLOCK_SIZE
+      while first < last:
+        count = min(size, last - first)
+        yield (first, np.frombuffer(self._buf, BLOCK_DTYPE, count, pos).copy())
+        first += count
+        pos += count*BLOCK_SIZE
+
+  def data(self, size=CHUNK_SIZE, interval=None, raw=False):
+  #---------------------------------------------------------
+    """
+    Decode the file's flow, pressure and leak data, with gaps filled by NaNs.
+
+    :param size: The maximum number of seconds of data to return at a time.
+    :param interval: An optional ``(start, duration)`` tuple, in seconds, giving
+      the portion of data to decode. This is widened to whole seconds.
+    :param raw: If set, return 16-bit integer values, in units of 0.01, with
+      gaps filled by :data:`MISSING_VALUE`.
+    :return: An iterator giving ``(flow, pressure, leak)`` arrays of values.
+
+    When an ``interval`` is given only the blocks it contains are decoded, using
+    the file's :meth:`index`.
+    """
+    def missing(seconds):
+    #--------------------
+      fill = MISSING_VALUE if raw else np.nan
+      dtype = np.int16 if raw else np.float64
+      return (np.full(seconds*FLOW_RATE, fill, dtype), np.full(seconds, fill, dtype), np.full(seconds, fill, dtype))
+
+    if interval is None:
+      time = 0
+      end = None
+      chunks = self.chunks(size)
+    else:
+      time = max(0, int(math.floor(interval[0])))
+      end = int(math.ceil(interval[0] + interval[1]))
+      chunks = self._select(time, end, size)
+    for offset, blocks in chunks:
+      while time < offset:
+        n = min(size, offset - time)
+        yield missing(n)
+        time += n
+      if raw:
+        yield (blocks['flow'].ravel(), blocks['pressure'], blocks['leak'].astype(np.int16))
+      else:
+        yield (flow_data(blocks), pressure_data(blocks), leak_data(blocks))
+      time += len(blocks)
+    end = self.duration if end is None else min(end, self.duration)
+    while time < end:              # Data may end with a gap
+      n = min(size, end - time)
+      yield missing(n)
+      time += n
@@ -0,0 +1,148 @@
+"""
+Following signals
+=================
+
+Read a signal that is still being written, such as one that ``strm2bsml`` or an
+interface ``InputStream`` is ingesting.
+
+After reading to the signal's current end, a :class:`Follower` polls for newly
+appended samples, starting with a short wait and doubling it after each poll
+that finds nothing, up to :data:`MAX_WAIT`. New data resets the wait. Reading
+ends when the signal's recording is closed (i.e. has a duration), after a final
+read of what was appended before closing.
+
+Whether the recording has been closed is only checked once polls have backed
+off to ``max_wait``, and then no more than once every :data:`CLOSED_INTERVAL`
+seconds, over a single repository connection.
+
+As appended data is read no more than ``max_wait`` seconds after a poll that
+didn't find it, ``max_wait`` bounds the latency between data being appended and
+being read, apart from the time taken by the repository, which includes an
+occasional check for closing.
+
+"""
+
+import time
+
+
+MIN_WAIT = 0.01          # Seconds between polls once data stops arriving...
+MAX_WAIT = 0.1           # ...backing off to this
+
+CLOSED_INTERVAL = 1.0    # Seconds between checks for the recording being closed
+
+READ_COUNT = 2**31 - 1   # Samples requested by a poll, i.e. all there are
+
+
+class RecordingClosed(object):
+#=============================
+
+  def __init__(self, uri, repository):
+  #-----------------------------------
+    """
+    A function that checks if the recording containing a signal has been
+    closed, i.e. has a duration. The repository is connected to when first
+    checking, and then kept open until :meth:`close`.
+
+    :param repository: The repository class, e.g. :class:`biosignalml.client.Repository`.
+    """
+    self._uri = uri
+    self._repository = repository
+    self._repo = None
+
+  def __call__(self):
+  #------------------
+    if self._repo is None: self._repo = self._repository(self._uri)
+    return self._repo.get_recording(self._uri).duration is not None
+
+  def close(self):
+  #---------------
+    if self._repo is not None:
+      self._repo.close()
+      self._repo = None
+
+
+class Follower(object):
+#======================
+
+  def __init__(self, signal, closed, stop, min_wait=MIN_WAIT, max_wait=MAX_WAIT):
+  #------------------------------------------------------------------------------
+    """
+    :param signal: The signal to follow.
+    :param closed: A function returning True once the signal's recording is
+      closed, so no more data will be appended, such as a :class:`RecordingClosed`.
+      Its ``close()`` method, if it has one, is called by :meth:`close`.
+    :param stop: A :class:`threading.Event` (or ``multiprocessing.Event``) that
+      stops following when set.
+    """
+    self._signal = signal
+    self._closed = closed
+    self._stop = stop
+    self._min_wait = min_wait
+    self._max_wait = max_wait
+    self._polls = 0
+    self._empty = 0
+    self._delays = 0          # Polls that found new data after waiting...
+    self._delay = 0.0         # ...the total wait before them...
+    self._max_delay = 0.0     # ...and the longest
+
+  def read(self, interval=None, maxpoints=0, dtype=None, rate=None, units=None):
+  #-----------------------------------------------------------------------------
+    """
+    Read the signal, as :meth:`Signal.read` does, and then follow it.
+
+    Only the start of an ``interval`` is used. Following can't resample a signal.
+
+    :return: An iterator giving :class:`DataSegment`\ s.
+    """
+    if rate is not None and rate != self._signal.rate:
+      raise ValueError("Can't change the rate of a signal being followed")
+    position = 0 if interval is None else int(round(interval[0]*self._signal.rate))
+    wait = self._min_wait
+    waited = 0.0              # Before the last poll
+    checked = 0.0             # When closing was last checked
+    closing = False
+    while not self._stop.is_set():
+      found = 0
+      self._polls += 1
+      for ts in self._signal.read(segment=(position, READ_COUNT), maxpoints=maxpoints,
+                                  dtype=dtype, units=units):
+        if found == 0 and self._polls > 1:
+          self._delays += 1
+          self._delay += waited
+          self._max_delay = max(self._max_delay, waited)
+        found += len(ts)
+        yield ts
+        if self._stop.is_set(): return
+      position += found
+      if found:
+        wait = self._min_wait
+        waited = 0.0
+        continue              # There may be more
+      self._empty += 1
+      if closing: break
+      start = time.time()
+      if wait >= self._max_wait and start - checked >= CLOSED_INTERVAL:
+        checked = start
+        closing = self._closed()
+        if closing: continue  # Read what was appended before closing
+        start = time.time()
+      self._stop.wait(wait)
+      waited = time.time() - start
+      wait = min(2*wait, self._max_wait)
+
+  def close(self):
+  #---------------
+    if hasattr(self._closed, 'close'): self._closed.close()
+    self._signal.close()
+
+  def stats(self):
+  #---------------
+    """
+    :return: A dictionary giving the number of polls, how many found no data,
+      and the mean and maximum wait before polls that found new data. As the
+      previous poll didn't find it, this wait bounds how long the data was
+      available before being read.
+    """
+    return { 'polls': self._polls, 'empty': self._empty,
+             'mean_delay': self._delay/self._delays if self._delays else 0.0,
+             'max_delay': self._max_delay }
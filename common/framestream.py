@@ -1,10 +1,12 @@
-from multiprocessing import Queue
+import Queue
 import collections
 import itertools
 import struct
 
 import numpy as np
 
+from merging import merge
+
 
 BYTE_ORDER_MARK   = u'\uFEFF'
 BYTE_ORDER_TEXT   = '%8g' % ord(BYTE_ORDER_MARK)
@@ -17,22 +19,33 @@ format_binary = np.frompyfunc(lambda x: struct.pack('f', x), 1, 1)
 class DataBuffer(object):
 #========================
 
-  def __init__(self, binary=False):
-  #--------------------------------
+  def __init__(self, binary=False, maxsize=0, queue=Queue.Queue):
+  #--------------------------------------------------------------
     self._binary = binary
-    self._queue = Queue()
+    self._queue = queue(maxsize)
     self._data = [ ]
     self._datalen = 0
     self._pos = 0
 
-  def close(self):
-  #---------------
-    self._queue.cancel_join_thread()
-
   def put(self, data):
   #-------------------
     self._queue.put(data)
 
+  def get(self):
+  #-------------
+    return self._queue.get()
+
+  def close(self):
+  #---------------
+    if hasattr(self._queue, 'cancel_join_thread'): self._queue.cancel_join_thread()
+
+  def discard(self):
+  #-----------------
+    try:
+      while True: self._queue.get_nowait()
+    except Queue.Empty:
+      pass
+
   def __iter__(self):
   #------------------
     while True:
@@ -69,7 +82,7 @@ class TextBuffer(object):
   #------------------
     while True:
       d = None
-      while len(self._data) == 0:
+      while self._pos >= len(self._data):
         if len(self._queue) == 0:
           d = BYTE_ORDER_BINARY if self._binary else BYTE_ORDER_TEXT
           break
@@ -104,28 +117,92 @@ class FrameCounter(object):
 class FrameStream(object):
 #=========================
 
-  def __init__(self, channels, no_text=False, binary=False):
-  #---------------------------------------------------------
-    self._databuf = tuple(DataBuffer(binary) for n in xrange(channels))
+  def __init__(self, channels, no_text=False, binary=False, maxsize=0, derive=None, queue=Queue.Queue):
+  #---------------------------------------------------------------------------------------------------
+    # ``maxsize`` limits the number of blocks of data queued for each channel
+    # ``derive``, if given, is called with each block of frames and returns the
+    # block with extra channels added
+    # ``queue`` is the class of channel queues, ``multiprocessing.Queue`` when
+    # data is put by other processes
+    self._databuf = tuple(DataBuffer(binary, maxsize, queue) for n in xrange(channels))
     self._textbuf = None if no_text else TextBuffer(binary)
     self._binary = binary
+    self._derive = derive
+
+  def put_data(self, channel, data):
+  #---------------------------------
+    self._databuf[channel].put(data)
 
+  def discard(self):
+  #-----------------
+    # Throw away queued data, so that writers blocked on a full queue can continue
+    for db in self._databuf: db.discard()
 
   def close(self):
   #---------------
     for db in self._databuf: db.close()
 
-  def put_data(self, channel, data):
-  #---------------------------------
-    self._databuf[channel].put(data)
-
   def put_text(self, text):
   #------------------------
     if self._textbuf is not None:
       self._textbuf.put(text)
 
+  def blocks(self):
+  #----------------
+    """
+    Assemble data from all channels into blocks of frames, without formatting.
+
+    :return: An iterator giving ``(frame, data)`` tuples, where ``frame`` is the
+      index of the block's first frame and ``data`` is a 2-D array with a row
+      for each frame and a column for each channel.
+    """
+    pending = [ np.empty(0) for db in self._databuf ]
+    frame = 0
+    while True:
+      for n, db in enumerate(self._databuf):
+        while len(pending[n]) == 0:
+          data = db.get()
+          if data is None: return
+          pending[n] = np.asarray(data)
+      count = min(len(p) for p in pending)
+      block = np.column_stack([ p[:count] for p in pending ])
+      if self._derive is not None: block = self._derive(block)
+      yield (frame, block)
+      pending = [ p[count:] for p in pending ]
+      frame += count
+
+  def merged(self, policy='hold'):
+  #-------------------------------
+    """
+    Merge channels of timed data onto a common timeline (see :func:`merging.merge`).
+    Each block of data put into a channel must be a 2-D array of
+    ``(time, value)`` rows.
+
+    :return: An iterator giving ``(row, data)`` tuples, where ``row`` is the
+      index of the block's first row and ``data`` is a 2-D array with a column
+      of times followed by a column for each channel.
+    """
+    row = 0
+    for data in merge([ db.get for db in self._databuf ], policy):
+      yield (row, data)
+      row += len(data)
+
+  def _derived_frames(self):
+  #-------------------------
+    text = iter(self._textbuf) if self._textbuf is not None else None
+    for frame, data in self.blocks():
+      values = format_binary(data) if self._binary else format_text(data)
+      for n, row in enumerate(values):
+        line = list(row)
+        if not self._binary: line.insert(0, str(frame + n))
+        if text is not None: line.append(next(text))
+        yield ('' if self._binary else ' ').join(line)
+
   def frames(self):
   #----------------
+    if self._derive is not None:   # Channels have to be aligned to derive others
+      for line in self._derived_frames(): yield line
+      return
     framecount = FrameCounter()
     try:
       if self._binary:
@@ -0,0 +1,89 @@
+"""
+Merging timed data
+==================
+
+Merge channels of irregularly timed values, such as point signals or signals
+with different sampling rates, onto a common timeline.
+
+"""
+
+import heapq
+
+import numpy as np
+
+
+MERGE_POLICIES = [ 'hold', 'nearest', 'change' ]
+
+
+def _merge_values(times, values, at, policy):
+#-------------------------------------------
+  # A channel's values at the times ``at``
+  if len(times) == 0: return np.nan
+  before = np.searchsorted(times, at, 'right') - 1
+  result = np.where(before >= 0, values[np.maximum(before, 0)], np.nan)
+  if policy == 'nearest':
+    after = np.minimum(before + 1, len(times) - 1)
+    later = (before < 0) | ((times[after] - at) < (at - times[np.maximum(before, 0)]))
+    result = np.where(later, values[after], result)
+  return result
+
+def merge(sources, policy='hold'):
+#=================================
+  """
+  Merge series of irregularly timed values onto the timeline of all their
+  times, with a k-way merge of their blocks.
+
+  The source that has been read least far is always read next, using a heap
+  ordered on the last time read from each source. All times up to the least of
+  these are then complete, and are merged at once. A channel's value at a time
+  is, for the ``policy``:
+
+    * ``hold``: its last value at or before the time (sample-and-hold), or NaN
+      before its first value;
+    * ``nearest``: its value nearest in time; or
+    * ``change``: as for ``hold``, with only the times when some channel's
+      value changes being kept.
+
+  :param sources: A function for each channel giving its next block, as a 2-D
+    array of ``(time, value)`` rows in time order, or None at the end.
+  :return: An iterator giving 2-D arrays, with a column of times followed by a
+    column for each channel.
+  """
+  if policy not in MERGE_POLICIES: raise ValueError("Unknown merge policy: %s" % policy)
+  channels = len(sources)
+  times = [ np.empty(0) for s in sources ]
+  values = [ np.empty(0) for s in sources ]
+  heap = [ (-np.inf, n) for n in xrange(channels) ]  # (last time read, channel)
+  done = -np.inf                                     # Times merged so far
+  previous = None                                    # Last row, for ``change``
+  while heap:
+    last, n = heapq.heappop(heap)
+    block = sources[n]()
+    if block is not None:
+      block = np.asarray(block, dtype=np.float64).reshape(-1, 2)
+      if len(block):
+        times[n] = np.concatenate((times[n], block[:, 0]))
+        values[n] = np.concatenate((values[n], block[:, 1]))
+        last = times[n][-1]
+      heapq.heappush(heap, (last, n))
+    complete = heap[0][0] if heap else np.inf
+    if complete <= done: continue
+    at = np.unique(np.concatenate([ t[(t > done) & (t <= complete)] for t in times ]))
+    if len(at) == 0: continue
+    rows = np.column_stack([ at ] + [ np.broadcast_to(_merge_values(t, v, at, policy), at.shape)
+                                        for t, v in zip(times, values) ])
+    done = at[-1]
+    for c in xrange(channels):            # Keep the last value before what's to come
+      keep = max(0, np.searchsorted(times[c], done, 'right') - 1)
+      times[c] = times[c][keep:]
+      values[c] = values[c][keep:]
+    if policy == 'change':
+      first = rows[:1, 1:] if previous is None else previous
+      steps = np.vstack((first, rows[:, 1:]))
+      same = (steps[1:] == steps[:-1]) | (np.isnan(steps[1:]) & np.isnan(steps[:-1]))
+      changed = ~same.all(axis=1)
+      if previous is None: changed[0] = True
+      previous = rows[-1:, 1:]
+      rows = rows[changed]
+      if len(rows) == 0: continue
+    yield rows
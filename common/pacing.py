@@ -0,0 +1,95 @@
+"""
+Pacing
+======
+
+Release a stream's frames at their sampling times, for real-time playback.
+
+"""
+
+import sys
+import time
+import ctypes, ctypes.util
+
+
+def _monotonic_clock():
+#======================
+  """
+  Find a clock that can't go backwards, falling back to :func:`time.time`
+  if ``clock_gettime()`` isn't available.
+  """
+  class timespec(ctypes.Structure):
+    _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+  except (OSError, AttributeError):
+    return time.time
+  clock_id = 6 if sys.platform == 'darwin' else 1     # CLOCK_MONOTONIC
+  def monotonic():
+    t = timespec()
+    if clock_gettime(clock_id, ctypes.byref(t)) != 0:
+      raise OSError(ctypes.get_errno(), "clock_gettime() failed")
+    return t.tv_sec + t.tv_nsec*1.0e-9
+  return monotonic
+
+monotonic = _monotonic_clock()
+
+
+PACING_BATCH = 0.02       # Seconds of frames released at a time when pacing
+LATE_TOLERANCE = 0.002    # Seconds after its time that a batch is counted as late
+
+
+class Pacer(object):
+#===================
+
+  def __init__(self, rate, speed=1.0, batch=PACING_BATCH):
+  #-------------------------------------------------------
+    """
+    Release frames at their sampling time, or ``speed`` times faster.
+
+    Frames are released in batches of ``batch`` seconds. Each batch's release
+    time is found from the number of its first frame and the time the first
+    batch was released, so errors in sleeping don't accumulate and the long-run
+    rate is exact. A batch released after its time is late; when the source
+    can't keep up, later batches are released as soon as possible until the
+    stream is back on time.
+    """
+    if rate is None or rate <= 0: raise ValueError("Pacing needs a sampling rate")
+    if speed <= 0: raise ValueError("Speed must be positive")
+    self._rate = float(rate)*speed
+    self.batch = max(1, int(round(self._rate*batch)))   # Frames per batch
+    self._start = None
+    self._batches = 0
+    self._late = 0
+    self._lateness = 0.0
+    self._max_lateness = 0.0
+
+  def wait(self, frame):
+  #---------------------
+    """
+    Wait until ``frame``, counting from the start of the stream, is due.
+    """
+    now = monotonic()
+    if self._start is None: self._start = now - frame/self._rate
+    due = self._start + frame/self._rate
+    if now < due:
+      time.sleep(due - now)
+      now = monotonic()
+    late = now - due
+    if late > LATE_TOLERANCE:
+      self._late += 1
+      self._lateness += late
+    self._max_lateness = max(self._max_lateness, late)
+    self._batches += 1
+
+  def stats(self):
+  #---------------
+    """
+    :return: A dictionary giving the number of batches released, how many were
+      late, the mean lateness of late batches and the maximum lateness of any
+      batch, in seconds, and the time since the first batch.
+    """
+    return { 'batches': self._batches, 'late': self._late,
+             'mean_lateness': self._lateness/self._late if self._late else 0.0,
+             'max_lateness': self._max_lateness,
+             'elapsed': 0.0 if self._start is None else monotonic() - self._start }
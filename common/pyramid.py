@@ -0,0 +1,139 @@
+"""
+Overview pyramids
+=================
+
+A pyramid summarises a signal at several reductions, by default 10, 100 and
+1000 times, so zoomed-out views of long recordings can be drawn without reading
+every sample. For each reduction, or level, the minimum, maximum and mean of
+each bucket of samples are stored as companion signals in the signal's
+recording, with URIs ``<signal>/overview/<level>/<statistic>`` and rates the
+signal's divided by the level.
+
+Levels are computed incrementally as data is appended, each from the buckets
+of the level below it. NaNs, such as in gaps in FLOW data, are ignored; a
+bucket with no other values has NaN statistics. The last, partial, bucket of
+each level is summarised when the pyramid is finished.
+
+"""
+
+import numpy as np
+
+
+LEVELS = [ 10, 100, 1000 ]
+
+STATISTICS = [ 'min', 'max', 'mean' ]
+
+
+def overview_uri(uri, level, statistic):
+#=======================================
+  return '%s/overview/%d/%s' % (uri, level, statistic)
+
+def is_overview(uri):
+#====================
+  return '/overview/' in str(uri)
+
+
+def _reduce(buckets, ratio):
+#---------------------------
+  # Combine each ``ratio`` buckets of (min, max, sum, count) arrays
+  mn, mx, total, count = [ b.reshape(-1, ratio) for b in buckets ]
+  return (np.fmin.reduce(mn, axis=1), np.fmax.reduce(mx, axis=1),
+          total.sum(axis=1), count.sum(axis=1))
+
+
+class Pyramid(object):
+#=====================
+
+  def __init__(self, levels=LEVELS):
+  #---------------------------------
+    self.levels = levels
+    self._ratios = [ ]
+    below = 1
+    for level in levels:
+      if level <= below or level % below:
+        raise ValueError("Each overview level must be a multiple of the one below")
+      self._ratios.append(level//below)
+      below = level
+    self._pending = [ None for l in levels ]   # Buckets not yet combined
+
+  def add(self, data, final=False):
+  #--------------------------------
+    """
+    Add samples to the pyramid.
+
+    :param final: Set if no more data will be added, to summarise the partial
+      bucket at the end of each level.
+    :return: A list, for each level, of ``(min, max, mean)`` arrays for the
+      buckets completed by ``data``.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    valid = ~np.isnan(data)
+    buckets = (data, data, np.where(valid, data, 0.0), valid.astype(np.int64))
+    result = [ ]
+    for n, ratio in enumerate(self._ratios):
+      pending = self._pending[n]
+      if pending is not None and len(pending[0]):
+        buckets = tuple(np.concatenate((p, b)) for p, b in zip(pending, buckets))
+      end = len(buckets[0]) - len(buckets[0]) % ratio
+      done = _reduce([ b[:end] for b in buckets ], ratio)
+      if final and end < len(buckets[0]):
+        last = _reduce([ b[end:] for b in buckets ], len(buckets[0]) - end)
+        done = tuple(np.concatenate((d, l)) for d, l in zip(done, last))
+        self._pending[n] = None
+      else:
+        self._pending[n] = tuple(b[end:] for b in buckets)
+      with np.errstate(invalid='ignore', divide='ignore'):
+        result.append((done[0], done[1], done[2]/done[3]))
+      buckets = done
+    return result
+
+  def finish(self):
+  #----------------
+    """
+    Summarise the partial buckets at the end of each level.
+
+    :return: As for :meth:`add`.
+    """
+    return self.add(np.empty(0), True)
+
+
+class OverviewWriter(object):
+#============================
+
+  def __init__(self, recording, signals, levels=LEVELS, dtype='f4'):
+  #-----------------------------------------------------------------
+    """
+    Store pyramids of signals as companion signals in their recording.
+
+    :param signals: The signals being written. Each is a channel, in order.
+    """
+    self._dtype = dtype
+    self._pyramids = [ Pyramid(levels) for s in signals ]
+    self._signals = [ ]
+    for s in signals:
+      self._signals.append([ [ recording.new_signal(overview_uri(s.uri, level, stat), getattr(s, 'units', None),
+                                                    rate=s.rate/float(level), dtype=dtype,
+                                                    label='%s per %d samples' % (stat, level))
+                                 for stat in STATISTICS ]
+                               for level in levels ])
+
+  def _append(self, channel, levels):
+  #----------------------------------
+    for signals, values in zip(self._signals[channel], levels):
+      if len(values[0]):
+        for s, v in zip(signals, values): s.append(v.astype(self._dtype), dtype=self._dtype)
+
+  def append(self, channel, data):
+  #-------------------------------
+    """
+    Add data written to a channel's signal.
+    """
+    self._append(channel, self._pyramids[channel].add(data))
+
+  def close(self):
+  #---------------
+    """
+    Write the partial buckets at the end of each channel.
+    """
+    for n, p in enumerate(self._pyramids):
+      self._append(n, p.finish())
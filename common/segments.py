@@ -0,0 +1,27 @@
+"""
+Segments
+========
+
+Parse the segments of recordings given on command lines.
+
+"""
+
+
+def parse_segment(segment):
+#==========================
+  """
+  Parse a segment given as ``START:DURATION`` or ``START-END``, in seconds.
+
+  :return: A ``(start, duration)`` tuple, or None if no segment is given.
+  """
+  if segment in [None, '']: return None
+  separator = ':' if ':' in segment else '-'
+  times = segment.split(separator)
+  if len(times) != 2: raise ValueError("Invalid segment specification")
+  try:
+    start, end = [ float(t) for t in times ]
+  except ValueError:
+    raise ValueError("Invalid segment specification")
+  duration = end if separator == ':' else end - start
+  if start < 0 or duration < 0: raise ValueError("Invalid segment specification")
+  return (start, duration)
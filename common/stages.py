@@ -0,0 +1,399 @@
+"""
+Processing stages
+=================
+
+Stages process each channel's data between it being read from the repository
+and being framed, a block at a time. A stage keeps whatever state it needs
+between blocks, so results don't depend on where blocks start and end.
+
+A stage has:
+
+  * ``rate(rate)``, giving the rate of its output for input at ``rate``.
+  * ``process(data)``, giving the output for a block of input.
+  * ``finish()``, giving any output that's pending at the end of the input.
+
+
+Decimation
+----------
+
+A :class:`Decimator` reduces a signal to a lower rate while keeping its
+envelope, so that peaks and artefacts are still shown. Input is divided into
+buckets and either:
+
+  * ``minmax``: the minimum and maximum of each bucket are output, in the order
+    they occur, giving two samples per bucket; or
+
+  * ``lttb``: one sample of each bucket is output, chosen as in the Largest
+    Triangle Three Buckets algorithm to form the largest triangle with the
+    previous output sample and the mean of the next bucket. Output samples are
+    treated as being uniformly spaced.
+
+NaNs are ignored, with a bucket of only NaNs giving NaN.
+
+
+Filtering
+---------
+
+An :class:`FIRFilter` or :class:`IIRFilter` filters a signal, keeping the
+filter's state between blocks so there are no transients at block boundaries.
+IIR filters are cascades of second-order sections, each applied to a block at a
+time by splitting it into short runs, whose outputs and final states are found
+with matrix products, so only the state passed from run to run is computed
+sample by sample.
+
+Filters are given by specifications of the form ``KIND:FREQUENCY[:N]``, where
+``KIND`` is one of:
+
+  * ``lowpass`` or ``highpass``: a Butterworth filter of order ``N`` (default 2,
+    rounded up to be even) at ``FREQUENCY`` Hz.
+  * ``bandpass``: highpass and lowpass Butterworth filters of order ``N`` at
+    the frequencies given by ``FREQUENCY`` as ``LOW-HIGH``.
+  * ``notch``: a notch at ``FREQUENCY`` with a quality factor of ``N``
+    (default 30).
+  * ``fir-lowpass``, ``fir-highpass``, ``fir-bandpass`` or ``fir-bandstop``: a
+    windowed-sinc FIR filter with ``N`` taps (default 101, rounded up to be
+    odd).
+
+or by ``fir:FILE`` or ``sos:FILE``, where ``FILE`` contains either FIR filter
+taps or a row of ``b0 b1 b2 a0 a1 a2`` coefficients for each second-order
+section. A NaN in a filter's input is output as NaN, with the last valid value
+being filtered in its place.
+
+"""
+
+import numpy as np
+
+
+DECIMATION_METHODS = [ 'minmax', 'lttb' ]
+
+IIR_KINDS = [ 'lowpass', 'highpass', 'bandpass', 'notch' ]
+
+FIR_KINDS = [ 'lowpass', 'highpass', 'bandpass', 'bandstop' ]
+
+FIR_TAPS = 101
+
+NOTCH_Q = 30.0
+
+IIR_RUN = 64          # Samples in each run of a block that's filtered at once
+
+
+def apply_stages(stages, data):
+#==============================
+  for s in stages: data = s.process(data)
+  return data
+
+def finish_stages(stages):
+#=========================
+  data = np.empty(0)
+  for s in stages: data = np.concatenate((s.process(data), s.finish()))
+  return data
+
+def stages_rate(stages, rate):
+#=============================
+  for s in stages: rate = s.rate(rate)
+  return rate
+
+
+def decimator(rate, target, method='minmax'):
+#============================================
+  """
+  Get a :class:`Decimator` from ``rate`` to ``target`` Hz, which must divide
+  ``rate`` (or twice ``rate`` for ``minmax``) by an integer.
+  """
+  per_bucket = 2 if method == 'minmax' else 1
+  bucket = per_bucket*rate/float(target)
+  if abs(bucket - round(bucket)) > 1.0e-6 or round(bucket) < per_bucket:
+    raise ValueError("Can't decimate from %g Hz to %g Hz" % (rate, target))
+  return Decimator(int(round(bucket)), method)
+
+
+class Decimator(object):
+#=======================
+
+  def __init__(self, bucket, method='minmax'):
+  #-------------------------------------------
+    """
+    :param bucket: The number of input samples in each bucket.
+    :param method: Either ``minmax`` or ``lttb``.
+    """
+    if method not in DECIMATION_METHODS: raise ValueError("Unknown decimation method: %s" % method)
+    if bucket < (2 if method == 'minmax' else 1):
+      raise ValueError("Decimation bucket is too small")
+    self._bucket = bucket
+    self._method = method
+    self._pending = np.empty(0)
+    self._previous = None         # LTTB's last output, as (time, value)
+    self._time = 0                # Index of the first pending sample
+
+  def rate(self, rate):
+  #--------------------
+    return (2.0 if self._method == 'minmax' else 1.0)*rate/self._bucket
+
+  def process(self, data):
+  #-----------------------
+    data = np.asarray(data, dtype=np.float64)
+    if len(self._pending): data = np.concatenate((self._pending, data))
+    keep = len(data) % self._bucket
+    if self._method == 'lttb': keep += self._bucket   # We need the next bucket's mean
+    end = max(0, len(data) - keep)
+    self._pending = data[end:]
+    result = self._decimate(data[:end].reshape(-1, self._bucket))
+    self._time += end
+    return result
+
+  def finish(self):
+  #----------------
+    data = self._pending
+    self._pending = np.empty(0)
+    if len(data) == 0: return data
+    if self._method == 'minmax':
+      return self._minmax(data.reshape(1, -1))
+    full = len(data) - len(data) % self._bucket
+    buckets = [ data[pos:pos+self._bucket] for pos in xrange(0, full, self._bucket) ]
+    if full < len(data): buckets.append(data[full:])
+    return self._lttb(buckets, data[-1:])
+
+  def _decimate(self, buckets):
+  #----------------------------
+    if self._method == 'minmax': return self._minmax(buckets)
+    if len(buckets) == 0: return np.empty(0)
+    following = self._pending[:self._bucket]
+    return self._lttb(list(buckets), following)
+
+  @staticmethod
+  def _minmax(buckets):
+  #--------------------
+    nans = np.isnan(buckets)
+    lo = np.where(nans, np.inf, buckets).argmin(axis=1)
+    hi = np.where(nans, -np.inf, buckets).argmax(axis=1)
+    rows = np.arange(len(buckets))
+    first = np.minimum(lo, hi)
+    second = np.maximum(lo, hi)
+    result = np.empty((len(buckets), 2))
+    result[:, 0] = buckets[rows, first]
+    result[:, 1] = buckets[rows, second]
+    return result.ravel()
+
+  def _lttb(self, buckets, following):
+  #-----------------------------------
+    # ``buckets`` is a list of arrays, the last being followed by ``following``
+    with np.errstate(invalid='ignore'):
+      means = [ np.nanmean(b) if np.any(~np.isnan(b)) else np.nan for b in buckets[1:] ]
+      if len(following) and np.any(~np.isnan(following)):
+        means.append(np.nanmean(following))
+      else:
+        means.append(np.nan)
+    result = np.empty(len(buckets))
+    start = self._time
+    for n, b in enumerate(buckets):
+      if self._previous is None:
+        self._previous = (float(start), b[0])
+      ta, ya = self._previous
+      tc = start + len(b) + self._bucket/2.0      # Middle of the next bucket
+      yc = means[n]
+      t = np.arange(start, start + len(b), dtype=np.float64)
+      if np.isnan(yc) or np.isnan(ya):
+        area = np.where(np.isnan(b), -1.0, np.abs(b - (ya if not np.isnan(ya) else 0.0)))
+      else:
+        area = np.abs((ta - tc)*(b - ya) - (ta - t)*(yc - ya))
+        area = np.where(np.isnan(area), -1.0, area)
+      i = int(area.argmax())
+      result[n] = b[i]
+      if not np.isnan(b[i]): self._previous = (t[i], b[i])
+      start += len(b)
+    return result
+
+
+def _hold(data, last):
+#---------------------
+  # Replace NaNs by the last valid value, or ``last`` at the start
+  missing = np.isnan(data)
+  if not missing.any(): return data
+  index = np.where(missing, -1, np.arange(len(data)))
+  index = np.maximum.accumulate(index)
+  return np.where(index >= 0, data[np.maximum(index, 0)], last)
+
+
+class FIRFilter(object):
+#=======================
+
+  def __init__(self, taps):
+  #------------------------
+    """
+    :param taps: The filter's impulse response.
+    """
+    self._taps = np.asarray(taps, dtype=np.float64)
+    if self._taps.ndim != 1 or len(self._taps) == 0: raise ValueError("Invalid FIR filter taps")
+    self._history = np.zeros(len(self._taps) - 1)
+    self._last = 0.0
+
+  def rate(self, rate):
+  #--------------------
+    return rate
+
+  def process(self, data):
+  #-----------------------
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0: return data
+    held = _hold(data, self._last)
+    self._last = held[-1]
+    signal = np.concatenate((self._history, held))
+    self._history = signal[len(signal) - len(self._history):]
+    result = np.convolve(signal, self._taps, 'valid')
+    result[np.isnan(data)] = np.nan
+    return result
+
+  def finish(self):
+  #----------------
+    return np.empty(0)
+
+
+class IIRFilter(object):
+#=======================
+
+  def __init__(self, sections, run=IIR_RUN):
+  #-----------------------------------------
+    """
+    :param sections: A list of ``(b0, b1, b2, a0, a1, a2)`` coefficients, for
+      each second-order section in turn.
+    :param run: The number of samples filtered at once.
+    """
+    sections = np.atleast_2d(np.asarray(sections, dtype=np.float64))
+    if sections.shape[1] != 6 or np.any(sections[:, 3] == 0.0):
+      raise ValueError("Invalid second-order sections")
+    self._run = run
+    self._sections = [ self._matrices(s[:3]/s[3], s[4:]/s[3], run) for s in sections ]
+    self._states = [ np.zeros(2) for s in sections ]
+    self._last = 0.0
+
+  @staticmethod
+  def _matrices(b, a, run):
+  #------------------------
+    # Transposed direct form II, as state space: s' = As + Bx, y = Cs + Dx
+    A = np.array([ [ -a[0], 1.0 ], [ -a[1], 0.0 ] ])
+    B = np.array([ b[1] - a[0]*b[0], b[2] - a[1]*b[0] ])
+    powers = [ np.eye(2) ]
+    for n in xrange(run): powers.append(np.dot(A, powers[-1]))
+    powers = np.array(powers)                     # A^0 ... A^run
+    impulse = np.concatenate(([ b[0] ], np.dot(powers[:run-1], B)[:, 0]))
+    rows = np.arange(run)
+    lags = rows[:, None] - rows[None, :]
+    response = np.where(lags >= 0, impulse[np.maximum(lags, 0)], 0.0)   # Output for input
+    initial = powers[:run, 0, :]                  # Output for initial state
+    final = np.dot(powers[run-1::-1], B)          # Final state for input
+    return (response, initial, final, powers)
+
+  def _section(self, n, data):
+  #---------------------------
+    response, initial, final, powers = self._sections[n]
+    state = self._states[n]
+    run = self._run
+    full = len(data) - len(data) % run
+    runs = data[:full].reshape(-1, run)
+    starts = np.empty((len(runs), 2))
+    ends = np.dot(runs, final)
+    step = powers[run]
+    for r in xrange(len(runs)):
+      starts[r] = state
+      state = np.dot(step, state) + ends[r]
+    result = np.empty(len(data))
+    result[:full] = (np.dot(runs, response.T) + np.dot(starts, initial.T)).ravel()
+    if full < len(data):
+      rest = data[full:]
+      size = len(rest)
+      result[full:] = np.dot(response[:size, :size], rest) + np.dot(initial[:size], state)
+      state = np.dot(powers[size], state) + np.dot(final[run-size:].T, rest)
+    self._states[n] = state
+    return result
+
+  def rate(self, rate):
+  #--------------------
+    return rate
+
+  def process(self, data):
+  #-----------------------
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0: return data
+    result = _hold(data, self._last)
+    self._last = result[-1]
+    for n in xrange(len(self._sections)):
+      result = self._section(n, result)
+    result[np.isnan(data)] = np.nan
+    return result
+
+  def finish(self):
+  #----------------
+    return np.empty(0)
+
+
+def _biquad(kind, rate, frequency, q):
+#-------------------------------------
+  # From the "Audio EQ Cookbook" by R. Bristow-Johnson
+  w = 2.0*np.pi*frequency/rate
+  alpha = np.sin(w)/(2.0*q)
+  cos = np.cos(w)
+  if   kind == 'lowpass':  b = [ (1.0 - cos)/2.0, 1.0 - cos, (1.0 - cos)/2.0 ]
+  elif kind == 'highpass': b = [ (1.0 + cos)/2.0, -(1.0 + cos), (1.0 + cos)/2.0 ]
+  else:                    b = [ 1.0, -2.0*cos, 1.0 ]   # notch
+  return b + [ 1.0 + alpha, -2.0*cos, 1.0 - alpha ]
+
+def _butterworth(kind, rate, frequency, order):
+#----------------------------------------------
+  sections = (order + 1)//2
+  return [ _biquad(kind, rate, frequency, 1.0/(2.0*np.cos(np.pi*(2*k + 1)/(4.0*sections))))
+             for k in xrange(sections) ]
+
+def _sinc(rate, frequency, taps):
+#--------------------------------
+  n = np.arange(taps) - (taps - 1)/2.0
+  h = np.sinc(2.0*frequency/rate*n)*np.hamming(taps)
+  return h/h.sum()
+
+def _fir(kind, rate, frequencies, taps):
+#---------------------------------------
+  taps += 1 - taps % 2                    # Odd, so highpass filters are possible
+  impulse = np.zeros(taps)
+  impulse[taps//2] = 1.0
+  if   kind == 'lowpass':  return _sinc(rate, frequencies[0], taps)
+  elif kind == 'highpass': return impulse - _sinc(rate, frequencies[0], taps)
+  band = _sinc(rate, frequencies[1], taps) - _sinc(rate, frequencies[0], taps)
+  return band if kind == 'bandpass' else impulse - band
+
+
+def make_filter(spec, rate):
+#===========================
+  """
+  Get the filter given by a specification (see above) for a signal at
+  ``rate`` Hz.
+
+  :rtype: :class:`FIRFilter` or :class:`IIRFilter`
+  """
+  parts = spec.split(':')
+  kind = parts[0].lower()
+  try:
+    if kind in [ 'fir', 'sos' ] and len(parts) == 2:
+      coefficients = np.loadtxt(parts[1], ndmin=2 if kind == 'sos' else 1)
+      return FIRFilter(coefficients) if kind == 'fir' else IIRFilter(coefficients)
+    fir = kind.startswith('fir-')
+    if fir: kind = kind[4:]
+    if kind not in (FIR_KINDS if fir else IIR_KINDS) or len(parts) not in [2, 3]:
+      raise ValueError("Unknown filter")
+    frequencies = [ float(f) for f in parts[1].split('-') ]
+    if len(frequencies) != (2 if kind in [ 'bandpass', 'bandstop' ] else 1):
+      raise ValueError("Wrong number of frequencies")
+    if not (0.0 < frequencies[0] <= frequencies[-1] < rate/2.0):
+      raise ValueError("Frequencies must be between 0 and %g Hz" % (rate/2.0))
+    n = float(parts[2]) if len(parts) == 3 else None
+    if n is not None and n <= 0: raise ValueError("Invalid order")
+    if fir:
+      return FIRFilter(_fir(kind, rate, frequencies, FIR_TAPS if n is None else int(n)))
+    elif kind == 'notch':
+      return IIRFilter([ _biquad(kind, rate, frequencies[0], NOTCH_Q if n is None else n) ])
+    order = 2 if n is None else int(n)
+    if   kind in [ 'lowpass', 'highpass' ]:
+      return IIRFilter(_butterworth(kind, rate, frequencies[0], order))
+    else:
+      return IIRFilter(_butterworth('highpass', rate, frequencies[0], order)
+                     + _butterworth('lowpass', rate, frequencies[1], order))
+  except (ValueError, IOError) as e:
+    raise ValueError("Invalid filter '%s' - %s" % (spec, e))
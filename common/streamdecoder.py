@@ -0,0 +1,248 @@
+"""
+Decoding streams
+================
+
+Decoders for the text and binary streams written by ``bsml2strm``, which parse
+chunks of a stream straight into NumPy arrays. Data can be fed to a decoder in
+pieces of any size, as read from a pipe.
+
+A text stream has a line for each frame, with the frame number followed by
+space separated channel values. A binary stream is a sequence of 32-bit floats,
+``channels`` to a frame, with no frame number. Either can have a final metadata
+channel holding character codes of text, with a byte order mark (U+FEFF) in
+frames that have no text.
+
+Typical use is:::
+
+  decoder = FrameDecoder(channels)
+  for frame, data in decode(sys.stdin, decoder):
+    ...
+
+or, when reading from some other source:::
+
+  for chunk in source:
+    block = decoder.feed(chunk)
+    if block is not None: ...
+  block = decoder.finish()
+
+"""
+
+import os
+import warnings
+
+import numpy as np
+
+import streamformat
+
+
+READ_SIZE = 65536
+
+BYTE_ORDER_MARK = 0xFEFF
+
+
+class FormatError(Exception):
+#============================
+  pass
+
+
+def _aligned(text, columns):
+#---------------------------
+  # Check that each newline terminated line has ``columns`` whitespace separated
+  # fields, i.e. that each newline comes after the last field of its line and
+  # before the first of the next
+  b = np.frombuffer(text, np.uint8)
+  blank = (b <= 32).view(np.uint8)     # Spaces, tabs, newlines, etc.
+  starts = np.flatnonzero(blank[:-1] > blank[1:]) + 1
+  if len(b) and not blank[0]: starts = np.concatenate(([ 0 ], starts))
+  ends = np.flatnonzero(b == 10)
+  return (len(starts) == len(ends)*columns
+      and np.all(starts[columns-1::columns] < ends) and np.all(ends[:-1] < starts[columns::columns]))
+
+
+class TextDecoder(object):
+#=========================
+
+  def __init__(self, columns=None, delimiter=None):
+  #------------------------------------------------
+    """
+    Decode lines of numbers into rows of a 2-D array.
+
+    :param columns: The number of values in each line. It's found from the
+      first line if not given.
+    :param delimiter: Values are separated by this character, as well as by
+      whitespace.
+    """
+    self.columns = columns
+    self._delimiter = delimiter
+    self._partial = ''
+    self.lines = 0
+
+  def _parse(self, text):
+  #----------------------
+    if self._delimiter is not None: text = text.replace(self._delimiter, ' ')
+    if self.columns is None:
+      first = text.lstrip('\n').split('\n', 1)[0]
+      self.columns = len(first.split())
+    lines = text.count('\n')
+    with warnings.catch_warnings():   # We check for values not being parsed
+      warnings.simplefilter('ignore')
+      values = np.fromstring(text, np.float64, sep=' ')
+    if len(values) != lines*self.columns or not _aligned(text, self.columns):
+      return self._parse_lines(text)  # Find what's wrong
+    self.lines += lines
+    return values.reshape(lines, self.columns)
+
+  def _parse_lines(self, text):
+  #----------------------------
+    rows = [ ]
+    for l in text.split('\n'):
+      fields = l.split()
+      if not fields: continue         # Blank lines are allowed
+      self.lines += 1
+      if len(fields) != self.columns:
+        raise FormatError("Line %d has %d values, not %d" % (self.lines, len(fields), self.columns))
+      try:
+        rows.append([ float(f) for f in fields ])
+      except ValueError:
+        raise FormatError("Line %d has an invalid value" % self.lines)
+    return np.array(rows, np.float64).reshape(len(rows), self.columns)
+
+  def feed(self, data):
+  #--------------------
+    """
+    Decode the complete lines in ``data``, keeping any partial line for
+    the next call.
+
+    :return: A 2-D array, with a row for each line and a column for each value.
+      It has no rows when no lines are complete.
+    """
+    end = data.rfind('\n') + 1
+    if end == 0:
+      self._partial += data
+      return np.empty((0, self.columns or 0))
+    text = self._partial + data[:end]
+    self._partial = data[end:]
+    return self._parse(text)
+
+  def finish(self):
+  #----------------
+    """
+    Decode a final line that isn't terminated by a newline.
+    """
+    text = self._partial
+    self._partial = ''
+    if text.strip(): return self._parse(text + '\n')
+    return np.empty((0, self.columns or 0))
+
+
+class FrameDecoder(object):
+#==========================
+
+  def __init__(self, channels=None, metadata=False, binary=False, dtype='=f4'):
+  #----------------------------------------------------------------------------
+    """
+    Decode a stream from ``bsml2strm``.
+
+    :param channels: The number of data channels, not counting any metadata
+      channel. It's required for binary streams, and found from the first
+      line of a text stream if not given.
+    :param metadata: Set if the stream has a metadata channel.
+    :param binary: Set if the stream is binary.
+    :param dtype: The type of values in a binary stream. ``bsml2strm`` writes
+      native 32-bit floats.
+    """
+    if binary and channels is None: raise ValueError("Binary streams need a number of channels")
+    self._extra = 1 if metadata else 0
+    self._binary = binary
+    if binary:
+      self._dtype = np.dtype(dtype)
+      self._framesize = (channels + self._extra)*self._dtype.itemsize
+      self._buffer = ''
+    else:
+      self._text = TextDecoder(None if channels is None else channels + 1 + self._extra)
+    self.channels = channels
+    self.frames = 0
+    self._codes = [ ]
+
+  def feed(self, data):
+  #--------------------
+    """
+    Decode a chunk of the stream.
+
+    :return: A ``(frame, data)`` tuple, where ``frame`` is the number of the
+      first frame decoded and ``data`` is a 2-D array with a row for each frame
+      and a column for each data channel, or None if no frames are complete.
+    """
+    if self._binary:
+      buf = self._buffer + data if self._buffer else data
+      end = len(buf) - len(buf) % self._framesize
+      self._buffer = buf[end:]
+      if end == 0: return None
+      values = np.frombuffer(buf, self._dtype, end//self._dtype.itemsize)
+      return self._frames(values.reshape(-1, self.channels + self._extra), None)
+    else:
+      rows = self._text.feed(data)
+      if len(rows) == 0: return None
+      return self._frames(rows[:, 1:], rows[0, 0])
+
+  def finish(self):
+  #----------------
+    """
+    Decode the end of the stream.
+
+    :return: As for :meth:`feed`.
+    """
+    if self._binary:
+      if self._buffer: raise FormatError("Stream ends with a partial frame")
+      return None
+    rows = self._text.finish()
+    if len(rows) == 0: return None
+    return self._frames(rows[:, 1:], rows[0, 0])
+
+  def _frames(self, values, first):
+  #--------------------------------
+    if self.channels is None: self.channels = values.shape[1] - self._extra
+    if self._extra:
+      codes = values[:, -1]
+      self._codes.append(codes[codes != BYTE_ORDER_MARK])
+      values = values[:, :-1]
+    frame = self.frames if first is None else int(first)
+    self.frames = frame + len(values)
+    return (frame, values)
+
+  def text(self):
+  #--------------
+    """
+    Get the metadata text received since the last call.
+
+    :return: The text, as a string of UTF-8 if any characters aren't bytes.
+    """
+    if not self._codes: return ''
+    codes = np.concatenate(self._codes).astype(np.uint32)
+    self._codes = [ ]
+    if len(codes) == 0 or codes.max() < 256: return codes.astype(np.uint8).tostring()
+    return codes.astype('<u4').tostring().decode('utf-32-le').encode('utf-8')
+
+
+def decode(infile, decoder, read_size=READ_SIZE):
+#================================================
+  """
+  Decode a stream read from a file, decompressing it if necessary.
+
+  :param decoder: A :class:`FrameDecoder` (or :class:`TextDecoder`).
+  :return: An iterator giving what the decoder returns for each chunk read.
+  """
+  try:
+    fd = infile.fileno()     # Use what's available, as a pipe may be live
+  except (AttributeError, IOError):
+    fd = None
+  decompressor = streamformat.Decompressor()
+  while True:
+    data = os.read(fd, read_size) if fd is not None else infile.read(read_size)
+    if not data: break
+    result = decoder.feed(decompressor.feed(data))
+    if result is not None and len(result): yield result
+  result = decoder.feed(decompressor.finish())
+  if result is not None and len(result): yield result
+  result = decoder.finish()
+  if result is not None and len(result): yield result
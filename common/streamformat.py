@@ -0,0 +1,585 @@
+"""
+Framed binary streams
+=====================
+
+A framed stream starts with a header describing its contents, followed by
+blocks of frames:
+
+  * The header is the 8 bytes ``BSMLSTRM``, the length of the header's text as
+    a little-endian 32-bit unsigned integer, and then the text, a JSON object
+    giving:
+
+    - ``version``: the format's version, currently 1.
+    - ``channels``: the number of channels in each frame.
+    - ``rate``: the frame rate, in Hz, or null when frames aren't evenly
+      spaced, as in merged streams, and the first channel gives each frame's
+      time in seconds.
+    - ``dtype``: the NumPy type of samples, e.g. ``<f4``.
+    - ``units``: a list giving the units of each channel, as URIs (or null).
+    - ``signals``: a list giving the URI (or null) of each channel's source signal.
+    - ``encoding``: optional, either ``int16`` or ``varint`` (see below).
+
+  * Each block starts with the length in bytes of its samples, the index of its
+    first frame, and the number of frames it contains, as little-endian 32-bit,
+    64-bit and 32-bit unsigned integers. The samples follow, interleaved by
+    frame, i.e. ``channel 0, channel 1, ..., channel 0, channel 1, ...``
+
+A reader can skip a block using its length, without looking at its samples.
+
+
+Integer encoding
+----------------
+
+Many signals are decimal fixed-point values, i.e. integers divided by a power
+of ten. When a stream has an ``encoding``, each block holds each channel's
+samples in turn, prefixed by an encoding mode byte, a divisor and an integer
+offset (as 64-bit floats), and the length in bytes of the encoded samples (as a
+32-bit unsigned integer). The modes are:
+
+  * 0 -- samples are of the stream's ``dtype``, as for an unencoded stream.
+  * 1 -- samples are 16-bit integers, ``k``.
+  * 2 -- samples are integers ``k``, with the first sample and the difference
+    between successive samples zigzag encoded (so small negative values are
+    small) and then written as LEB128 variable length integers, 7 bits per byte.
+
+A sample's value is ``(offset + k)/divisor``, converted to the stream's
+``dtype``. As division by a power of ten is exact for such values, signed data
+and 64-bit values such as ``-1234/100.0`` are reproduced exactly. Channels are
+only encoded as integers when every value, including the sign of zeros, is
+reproduced, so encoding is lossless; a block of a channel with a ``-0.0`` is
+sent unencoded.
+
+
+Compression
+-----------
+
+Any stream, framed or not, can be compressed with zlib. A compressed stream
+starts with the 8 bytes ``BSMLZLIB`` and is followed by chunks, each being the
+length of its compressed data as a little-endian 32-bit unsigned integer and
+then the data. Each chunk holds :data:`COMPRESS_BLOCK_SIZE` bytes of the
+uncompressed stream, except for the last and for chunks flushed early, as when
+a live stream is sent on a timer. Readers detect compression from the stream's
+first bytes.
+
+"""
+
+import os
+import json
+import zlib
+import struct
+import threading
+
+import numpy as np
+
+
+MAGIC   = 'BSMLSTRM'
+VERSION = 1
+
+HEADER = struct.Struct('<8sI')      # Magic, length of header text
+BLOCK  = struct.Struct('<IQI')      # Sample bytes, first frame, frame count
+
+CHANNEL = struct.Struct('<BddI')    # Mode, divisor, offset, encoded bytes
+
+ENCODINGS = [ 'int16', 'varint' ]
+
+RAW_MODE    = 0
+INT16_MODE  = 1
+VARINT_MODE = 2
+
+DIVISORS = [ 10.0**n for n in xrange(7) ]  # Divisors tried when encoding integers
+MAX_INTEGER = 2**53                        # Largest integer exactly held in a double
+
+ZLIB_MAGIC = 'BSMLZLIB'
+CHUNK = struct.Struct('<I')         # Length of compressed chunk
+
+COMPRESS_LEVEL = 6
+COMPRESS_BLOCK_SIZE = 65536         # See ``benchmark.py --compression``
+COMPRESS_INTERVAL = 1.0             # Seconds live data can be held before it's sent
+
+READ_SIZE = 65536
+
+
+class FormatError(Exception):
+#============================
+  pass
+
+
+def is_framed(prefix):
+#=====================
+  """
+  Check whether data starts a framed stream.
+  """
+  return prefix[:len(MAGIC)] == MAGIC
+
+
+def zigzag(k):
+#=============
+  k = k.astype(np.int64)
+  return ((k << 1) ^ (k >> 63)).view(np.uint64)
+
+def unzigzag(z):
+#===============
+  return (z >> np.uint64(1)).astype(np.int64) ^ -(z & np.uint64(1)).astype(np.int64)
+
+
+def varint_encode(z):
+#====================
+  """
+  Encode unsigned integers as LEB128 variable length integers.
+
+  :param z: An array of unsigned 64-bit integers.
+  :return: A string of bytes.
+  """
+  z = np.asarray(z, np.uint64)
+  sizes = np.ones(len(z), np.int64)
+  for n in xrange(1, 10):
+    sizes += (z >= np.uint64(1 << 7*n))
+  ends = np.cumsum(sizes)
+  starts = ends - sizes
+  result = np.zeros(ends[-1] if len(ends) else 0, np.uint8)
+  for n in xrange(int(sizes.max()) if len(sizes) else 0):
+    has = sizes > n
+    more = (sizes[has] > n + 1).astype(np.uint8) << 7
+    result[starts[has] + n] = ((z[has] >> np.uint64(7*n)) & np.uint64(0x7F)).astype(np.uint8) | more
+  return result.tostring()
+
+def varint_decode(data, count):
+#==============================
+  """
+  Decode ``count`` LEB128 variable length integers.
+
+  :return: An array of unsigned 64-bit integers.
+  """
+  b = np.frombuffer(data, np.uint8)
+  ends = np.flatnonzero(b < 0x80) + 1
+  if len(ends) != count or (count and ends[-1] != len(b)):
+    raise FormatError("Invalid variable length integers")
+  starts = np.concatenate(([0], ends[:-1]))
+  sizes = ends - starts
+  result = np.zeros(count, np.uint64)
+  for n in xrange(int(sizes.max()) if count else 0):
+    has = sizes > n
+    result[has] |= (b[starts[has] + n] & 0x7F).astype(np.uint64) << np.uint64(7*n)
+  return result
+
+
+def _from_integers(divisor, offset, k, dtype):
+#---------------------------------------------
+  return ((offset + k.astype(np.float64))/divisor).astype(dtype)
+
+def _integers(x, dtype):
+#-----------------------
+  """
+  Find a divisor and integer offset for which values are exactly
+  ``(offset + k)/divisor``, with ``k`` non-negative integers.
+
+  :return: A ``(divisor, offset, k)`` tuple, or None if there is none.
+  """
+  if len(x) == 0 or not np.all(np.isfinite(x)): return None
+  if np.any(np.signbit(x[x == 0])): return None      # -0.0 would become 0.0
+  x64 = x.astype(np.float64)
+  for divisor in DIVISORS:
+    n = np.round(x64*divisor)
+    if np.abs(n).max() >= MAX_INTEGER: return None
+    offset = float(n.min())
+    k = (n - offset).astype(np.int64)
+    if np.array_equal(_from_integers(divisor, offset, k, dtype), x): return (divisor, offset, k)
+  return None
+
+
+def encode_channel(x, dtype, encoding):
+#======================================
+  """
+  Encode a channel's samples.
+
+  :return: The encoded data, prefixed by its mode, divisor, offset and length.
+  """
+  x = np.ascontiguousarray(x, dtype)
+  ints = _integers(x, dtype)
+  if ints is None:
+    mode, divisor, offset, data = (RAW_MODE, 1.0, 0.0, x.tostring())
+  else:
+    divisor, offset, k = ints
+    if encoding == 'int16' and k.max() <= 0x7FFF:
+      mode, data = (INT16_MODE, k.astype('<i2').tostring())
+    else:
+      mode, data = (VARINT_MODE, varint_encode(zigzag(np.concatenate((k[:1], np.diff(k))))))
+  return CHANNEL.pack(mode, divisor, offset, len(data)) + data
+
+
+def decode_channel(data, pos, count, dtype):
+#===========================================
+  """
+  Decode a channel's samples starting at ``pos`` in ``data``.
+
+  :return: A ``(samples, next position)`` tuple.
+  """
+  if pos + CHANNEL.size > len(data): raise FormatError("Truncated block")
+  mode, divisor, offset, length = CHANNEL.unpack_from(data, pos)
+  pos += CHANNEL.size
+  encoded = data[pos:pos+length]
+  if len(encoded) < length: raise FormatError("Truncated block")
+  if mode == RAW_MODE:
+    x = np.frombuffer(encoded, dtype)
+  elif mode == INT16_MODE:
+    x = _from_integers(divisor, offset, np.frombuffer(encoded, '<i2'), dtype)
+  elif mode == VARINT_MODE:
+    x = _from_integers(divisor, offset, np.cumsum(unzigzag(varint_decode(encoded, count))), dtype)
+  else:
+    raise FormatError("Unknown encoding mode %d" % mode)
+  if len(x) != count: raise FormatError("Channel has wrong number of samples")
+  return (x, pos + length)
+
+
+def _read(infile, size):
+#-----------------------
+  data = infile.read(size)
+  while len(data) < size:           # Pipes may return less than requested
+    more = infile.read(size - len(data))
+    if not more: break
+    data += more
+  return data
+
+
+class Compressor(object):
+#========================
+
+  def __init__(self, outfile, level=COMPRESS_LEVEL, block_size=COMPRESS_BLOCK_SIZE, interval=None):
+  #-------------------------------------------------------------------------------------------------
+    """
+    Compress data written to ``outfile``, in blocks of ``block_size`` bytes.
+    :meth:`flush` must be called after the last write.
+
+    When ``interval`` is given, as for live input that isn't paced, what's been
+    written is also compressed and ``outfile`` flushed every ``interval``
+    seconds, until :meth:`stop` is called.
+    """
+    self._outfile = outfile
+    self._level = level
+    self._block_size = block_size
+    self._buffer = [ ]
+    self._size = 0
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    outfile.write(ZLIB_MAGIC)
+    if interval is not None:
+      timer = threading.Thread(target=self._flush_every, args=(interval,))
+      timer.daemon = True
+      timer.start()
+
+  def _flush_every(self, interval):
+  #--------------------------------
+    while not self._stop.wait(interval):
+      with self._lock:
+        if self._size:
+          self._flush()
+          self._outfile.flush()
+
+  def _compress(self, data):
+  #-------------------------
+    data = zlib.compress(data, self._level)
+    self._outfile.write(CHUNK.pack(len(data)) + data)
+
+  def write(self, data):
+  #---------------------
+    with self._lock:
+      self._buffer.append(data)
+      self._size += len(data)
+      if self._size >= self._block_size:
+        data = ''.join(self._buffer)
+        end = len(data) - len(data) % self._block_size
+        for pos in xrange(0, end, self._block_size):
+          self._compress(data[pos:pos+self._block_size])
+        self._buffer = [ data[end:] ]
+        self._size = len(data) - end
+
+  def _flush(self):
+  #----------------
+    if self._size:
+      self._compress(''.join(self._buffer))
+      self._buffer = [ ]
+      self._size = 0
+
+  def flush(self):
+  #---------------
+    with self._lock:
+      self._flush()
+
+  def stop(self):
+  #--------------
+    """
+    Stop any flushing on a timer.
+    """
+    self._stop.set()
+
+
+class Decompressor(object):
+#==========================
+
+  def __init__(self):
+  #------------------
+    """
+    Incrementally decompress a stream, passing it through unchanged if it
+    isn't compressed.
+    """
+    self._pending = ''
+    self.compressed = None              # Not known until we see the start
+
+  def feed(self, data):
+  #--------------------
+    """
+    :return: The data that can be decompressed after adding ``data``.
+    """
+    self._pending += data
+    if self.compressed is None:
+      if len(self._pending) < len(ZLIB_MAGIC) and ZLIB_MAGIC.startswith(self._pending):
+        return ''
+      self.compressed = self._pending.startswith(ZLIB_MAGIC)
+      if self.compressed: self._pending = self._pending[len(ZLIB_MAGIC):]
+    if not self.compressed:
+      data = self._pending
+      self._pending = ''
+      return data
+    result = [ ]
+    pos = 0
+    while len(self._pending) - pos >= CHUNK.size:
+      length = CHUNK.unpack_from(self._pending, pos)[0]
+      end = pos + CHUNK.size + length
+      if len(self._pending) < end: break
+      try:
+        result.append(zlib.decompress(self._pending[pos+CHUNK.size:end]))
+      except zlib.error, msg:
+        raise FormatError("Invalid compressed data: %s" % msg)
+      pos = end
+    self._pending = self._pending[pos:]
+    return ''.join(result)
+
+  def finish(self):
+  #----------------
+    """
+    :return: Any remaining data, at the end of the stream.
+    """
+    if self.compressed:
+      if self._pending: raise FormatError("Truncated compressed stream")
+      return ''
+    data = self._pending
+    self._pending = ''
+    return data
+
+
+class StreamInput(object):
+#=========================
+
+  def __init__(self, infile):
+  #--------------------------
+    """
+    A file-like object for reading a stream, decompressing it if necessary.
+    """
+    self._infile = infile
+    try:
+      self._fd = infile.fileno()     # Read what's available, as a pipe may be live
+    except (AttributeError, IOError):
+      self._fd = None
+    self._decompressor = Decompressor()
+    self._buffer = ''
+    self._pos = 0
+    self._chunks = [ ]               # Read after _buffer, joined when needed
+    self._size = 0                   # Unread bytes in _buffer and _chunks
+    self._eof = False
+
+  def _fill(self):
+  #---------------
+    if self._eof: return False
+    while True:
+      if self._fd is not None: data = os.read(self._fd, READ_SIZE)
+      else:                    data = self._infile.read(READ_SIZE)
+      if data: more = self._decompressor.feed(data)
+      else:
+        more = self._decompressor.finish()
+        self._eof = True
+      if more or self._eof: break
+    if more:
+      self._chunks.append(more)
+      self._size += len(more)
+    return len(more) > 0
+
+  def _join(self):
+  #---------------
+    # Only unread data is copied, so reading is linear in the stream's length
+    if self._chunks:
+      self._buffer = ''.join([ self._buffer[self._pos:] ] + self._chunks)
+      self._pos = 0
+      self._chunks = [ ]
+
+  def read(self, size=-1):
+  #-----------------------
+    while size < 0 or self._size < size:
+      if not self._fill(): break
+    self._join()
+    end = len(self._buffer) if size < 0 else self._pos + size
+    data = self._buffer[self._pos:end]
+    self._pos += len(data)
+    self._size -= len(data)
+    return data
+
+  def readline(self):
+  #------------------
+    end = self._buffer.find('\n', self._pos)
+    while end < 0 and self._fill():
+      if '\n' in self._chunks[-1]:
+        self._join()
+        end = self._buffer.find('\n', self._pos)
+    self._join()
+    end = len(self._buffer) if end < 0 else end + 1
+    line = self._buffer[self._pos:end]
+    self._size -= end - self._pos
+    self._pos = end
+    return line
+
+  def __iter__(self):
+  #------------------
+    while True:
+      line = self.readline()
+      if not line: break
+      yield line
+
+
+class StreamWriter(object):
+#==========================
+
+  def __init__(self, outfile, channels, rate, dtype='<f4', units=None, signals=None, encoding=None):
+  #-------------------------------------------------------------------------------------------------
+    if encoding not in [None] + ENCODINGS:
+      raise ValueError("Unknown encoding: %s" % encoding)
+    self._outfile = outfile
+    self._channels = channels
+    self._dtype = np.dtype(dtype)
+    self._encoding = encoding
+    self._frame = 0
+    header = { 'version': VERSION,
+               'channels': channels,
+               'rate': rate,
+               'dtype': self._dtype.str,
+               'units': [ None if u is None else str(u) for u in (units or [None]*channels) ],
+               'signals': [ None if s is None else str(s) for s in (signals or [None]*channels) ] }
+    if encoding is not None: header['encoding'] = encoding
+    if len(header['units']) != channels or len(header['signals']) != channels:
+      raise ValueError("Units and signals must be given for each channel")
+    text = json.dumps(header)
+    outfile.write(HEADER.pack(MAGIC, len(text)) + text)
+
+  def write(self, data):
+  #---------------------
+    """
+    Write a block of frames.
+
+    :param data: A 2-D array, with a row for each frame and a column for each channel.
+    """
+    data = np.asarray(data, dtype=self._dtype)
+    if data.ndim != 2 or data.shape[1] != self._channels:
+      raise ValueError("Block must have %d channels" % self._channels)
+    if self._encoding is None:
+      samples = data.tostring()
+    else:
+      samples = ''.join([ encode_channel(data[:, n], self._dtype, self._encoding)
+                            for n in xrange(self._channels) ])
+    self._outfile.write(BLOCK.pack(len(samples), self._frame, len(data)) + samples)
+    self._frame += len(data)
+
+
+class StreamReader(object):
+#==========================
+
+  def __init__(self, infile, prefix=''):
+  #-------------------------------------
+    """
+    Read a framed stream's header.
+
+    :param prefix: Any data already read from the start of the stream.
+    """
+    self._infile = infile
+    header = prefix + _read(infile, HEADER.size - len(prefix))
+    if len(header) < HEADER.size or not is_framed(header):
+      raise FormatError("Not a framed stream")
+    magic, length = HEADER.unpack(header)
+    try:
+      header = json.loads(_read(infile, length))
+      if header['version'] > VERSION:
+        raise FormatError("Unsupported stream version %s" % header['version'])
+      self.channels = int(header['channels'])
+      self.rate = None if header['rate'] is None else float(header['rate'])
+      self.dtype = np.dtype(str(header['dtype']))
+      self.units = header.get('units') or [None]*self.channels
+      self.signals = header.get('signals') or [None]*self.channels
+      self.encoding = header.get('encoding')
+      if self.encoding not in [None] + ENCODINGS:
+        raise FormatError("Unknown encoding: %s" % self.encoding)
+      self.header = header
+    except (ValueError, KeyError, TypeError), msg:
+      raise FormatError("Invalid stream header: %s" % msg)
+
+  def blocks(self, skip=0):
+  #------------------------
+    """
+    Read blocks of frames.
+
+    :param skip: The number of frames at the start of the stream to skip.
+      Blocks before the first wanted frame are passed over without being decoded.
+    :return: An iterator giving ``(frame, data)`` tuples, where ``frame`` is the
+      index of the block's first frame and ``data`` is a 2-D array with a row
+      for each frame and a column for each channel.
+    """
+    while True:
+      prefix = _read(self._infile, BLOCK.size)
+      if len(prefix) == 0: break
+      elif len(prefix) < BLOCK.size: raise FormatError("Truncated block header")
+      length, frame, count = BLOCK.unpack(prefix)
+      if self.encoding is None and length != count*self.channels*self.dtype.itemsize:
+        raise FormatError("Block length doesn't match its frame count")
+      if frame + count <= skip:
+        self._skip(length)
+        continue
+      samples = _read(self._infile, length)
+      if len(samples) < length: raise FormatError("Truncated block")
+      if self.encoding is None:
+        data = np.frombuffer(samples, self.dtype).reshape(count, self.channels)
+      else:
+        data = np.empty((count, self.channels), self.dtype)
+        pos = 0
+        for n in xrange(self.channels):
+          data[:, n], pos = decode_channel(samples, pos, count, self.dtype)
+      if frame < skip:
+        data = data[skip - frame:]
+        frame = skip
+      yield (frame, data)
+
+  def _skip(self, length):
+  #-----------------------
+    try:
+      self._infile.seek(length, 1)
+    except (AttributeError, IOError):        # Pipes can't seek
+      while length > 0:
+        data = self._infile.read(min(length, 1 << 20))
+        if not data: raise FormatError("Truncated block")
+        length -= len(data)
+
+
+if __name__ == '__main__':
+#=========================
+
+  # Check that encoding is lossless, and how much it saves
+  k = np.round(3000*np.sin(np.arange(5000)/40.0)).astype(np.int64)
+  cases = [ ('signed <f4', k/100.0, '<f4'), ('signed <f8', k/100.0, '<f8'),
+            ('offset <f8', 1234.5 + k/10.0, '<f8'), ('negative zero', np.array([ 1.0, -0.0, 2.5 ]), '<f8'),
+            ('gap', np.where(k > 2000, np.nan, k/100.0), '<f4'), ('random', np.random.randn(1000), '<f8') ]
+  for name, x, dtype in cases:
+    x = x.astype(dtype)
+    for encoding in ENCODINGS:
+      data = encode_channel(x, dtype, encoding)
+      y, end = decode_channel(data, 0, len(x), dtype)
+      assert end == len(data)
+      assert np.array_equal(np.isnan(y), np.isnan(x))
+      assert np.array_equal(y[~np.isnan(x)], x[~np.isnan(x)])
+      assert np.array_equal(np.signbit(y), np.signbit(x))
+      print '%-14s %-7s mode %d, %4.1fx smaller' % (name, encoding, CHANNEL.unpack_from(data)[0],
+                                                    x.nbytes/float(len(data)))
@@ -0,0 +1,57 @@
+"""
+Sliding windows
+===============
+
+Statistics over windows of ``size`` samples, starting at each sample of data
+that begins with the last ``size - 1`` samples of the previous block, so a
+block of data gives a value for each of its new samples.
+
+"""
+
+import numpy as np
+
+
+CHUNK_SIZE = 2**20     # Samples, across windows, compared with their means at a time
+
+
+def extremes(data, size, function):
+#==================================
+  """
+  Apply ``np.fmin`` or ``np.fmax`` to each window, ignoring NaNs, with the van
+  Herk/Gil-Werman method.
+  """
+  count = len(data) - size + 1
+  padded = np.empty(-(-len(data)//size)*size)
+  padded.fill(np.nan)
+  padded[:len(data)] = data
+  rows = padded.reshape(-1, size)
+  forward = function.accumulate(rows, axis=1).ravel()
+  backward = function.accumulate(rows[:, ::-1], axis=1)[:, ::-1].ravel()
+  return function(backward[:count], forward[size-1:size-1+count])
+
+
+def sums(data, size):
+#====================
+  """
+  The sum of each window, from cumulative sums.
+  """
+  total = np.concatenate(([ 0.0 ], np.cumsum(data)))
+  return total[size:] - total[:len(total) - size]
+
+
+def deviations(data, size, mean):
+#================================
+  """
+  The sum of the squared deviations of each window's samples from the window's
+  ``mean``, ignoring NaNs. Deviations are found directly, rather than from sums
+  of squares, so precision isn't lost when the mean is large.
+  """
+  data = np.ascontiguousarray(data, dtype=np.float64)
+  count = len(data) - size + 1
+  windows = np.lib.stride_tricks.as_strided(data, (count, size), (data.strides[0], data.strides[0]))
+  result = np.empty(count)
+  step = max(1, CHUNK_SIZE//size)
+  for start in xrange(0, count, step):
+    deviation = windows[start:start+step] - mean[start:start+step, None]
+    result[start:start+step] = np.nansum(deviation*deviation, axis=1)
+  return result
@@ -54,10 +54,14 @@ Syntax
 import os
 import sys
 import time
+import errno
+import pipes
 import shlex
 import signal
 import fnmatch
+import threading
 import subprocess
+from datetime import datetime
 
 
 CONFIG_OPTIONS = { 'pertecs': ('-c', '.*'),    #  (flag, suffix)
@@ -65,6 +69,8 @@ CONFIG_OPTIONS = { 'pertecs': ('-c', '.*'),    #  (flag, suffix)
 ##                 'tee':     (None, ''),      # Produces an output file...
                  }
 
+BUFFER_SIZE = 65536   # Bytes relayed between stages at a time
+
 
 def file_list(path):
 #===================
@@ -86,6 +92,16 @@ class Command(object):
       self._output = output
       self._outputmode = 'w'
     self._processes = [ ]
+    self._usage = { }
+
+  def __str__(self):
+  #-----------------
+    text = [ ]
+    if self._input not in [None, '']: text.append('< %s' % self._input)
+    text.append(' | '.join([' '.join(pipes.quote(c) for c in cmd) for cmd in self._commands]))
+    if self._output not in [None, '']:
+      text.append('%s %s' % ('>>' if self.appends_output() else '>', self._output))
+    return ' '.join(text)
 
   def controlled_files(self):
   #--------------------------
@@ -99,38 +115,290 @@ class Command(object):
         pass
     return controlled
 
+  def argument_files(self):
+  #------------------------
+    """
+    Words in the command's pipeline that name existing files, such as scripts
+    and the data they read.
+    """
+    return [ w for cmd in self._commands for w in cmd if os.path.isfile(w) ]
+
+  def declared_reads(self):
+  #------------------------
+    """
+    Whether all the files the command's pipeline reads are known, as its input
+    and controlled files, because each of its programs has configuration options.
+    """
+    return all(cmd[0] in CONFIG_OPTIONS for cmd in self._commands)
+
   def output_files(self):
   #----------------------
-     return [ ]
+    return [ ] if self._output in [None, ''] else [self._output]
+
+  def appends_output(self):
+  #------------------------
+    return self._outputmode == 'a'
 
   def interrupt(self, signum, frame):
   #----------------------------------
     for p in self._processes:
-      if p.poll() is None: p.send_signal(signum)
+      if p.returncode is None: p.send_signal(signum)
 
-  def run(self):
-  #-------------
-    signal.signal(signal.SIGINT, self.interrupt)
-    stdin = (sys.stdin if self._input in [None, ''] else
-             open(self._input, 'r'))
+  def start(self, stdin=None, measure=False):
+  #------------------------------------------
+    """
+    Start the command's pipeline without waiting for it to finish.
+
+    :param stdin: Where the pipeline's input comes from when it doesn't have an
+      input file. Default is our standard input.
+    :param measure: Count the bytes passed between stages, by relaying them
+      through threads instead of connecting processes directly.
+    """
+    self._processes = [ ]
+    self._usage = { }
+    self._relays = [ ]
+    self._bytes = [ None ]*len(self._commands)
+    self._started = time.time()
+    self._elapsed = None
+    self._outsize = None
+    files = [ ]
+    if self._input in [None, '']:
+      if stdin is None: stdin = sys.stdin
+    else:
+      stdin = open(self._input, 'r')
+      files.append(stdin)
     stdout = subprocess.PIPE
     lastcmd = (len(self._commands) - 1)
     for n, cmd in enumerate(self._commands):
       if n == lastcmd:
-        stdout = (sys.stdout if self._output in [None, ''] else
-                  open(self._output, self._outputmode))
-      process = subprocess.Popen(cmd, stdin=stdin, stdout=stdout)
-      # Could save process ids -- process.pid
-      if n > 0: stdin.close()
+        if self._output in [None, '']:
+          stdout = subprocess.PIPE if measure else sys.stdout
+        else:
+          stdout = open(self._output, self._outputmode)
+          self._outsize = os.fstat(stdout.fileno()).st_size if self.appends_output() else 0
+          files.append(stdout)
+      # Close other descriptors, so processes don't hold open relay pipes
+      if n > 0 and measure:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout, close_fds=True)
+        self._relay(n - 1, stdin, process.stdin)
+      else:
+        process = subprocess.Popen(cmd, stdin=stdin, stdout=stdout, close_fds=True)
+        if n > 0: stdin.close()
       stdin = process.stdout
       self._processes.append(process)
-    while self._processes:
-      for n, p in enumerate(self._processes):
-        if p.poll() is not None:
-          self._processes.pop(n)
+    if stdout is subprocess.PIPE: self._relay(lastcmd, stdin, sys.stdout)
+    for f in files: f.close()   # Processes have their own copies
+
+  def _relay(self, n, source, sink):
+  #---------------------------------
+    def relay():
+    #-----------
+      count = 0
+      try:
+        while True:
+          data = os.read(source.fileno(), BUFFER_SIZE)
+          if not data: break
+          count += len(data)
+          while data:
+            data = data[os.write(sink.fileno(), data):]
+      except OSError, e:
+        if e.errno != errno.EPIPE: raise   # Reader has finished
+      finally:
+        self._bytes[n] = count
+        source.close()
+        if sink is not sys.stdout: sink.close()
+    thread = threading.Thread(target=relay)
+    thread.daemon = True
+    thread.start()
+    self._relays.append(thread)
+
+  def reaped(self, pid, status, usage=None):
+  #-----------------------------------------
+    """
+    Set the return code of one of our processes reaped by ``os.wait3()``.
+
+    :return: True if the process was ours.
+    """
+    for p in self._processes:
+      if p.pid == pid:
+        if os.WIFSIGNALED(status): p.returncode = -os.WTERMSIG(status)
+        else:                      p.returncode = os.WEXITSTATUS(status)
+        self._usage[pid] = usage
+        if self.finished() and self._elapsed is None:
+          for t in self._relays: t.join()   # Relays finish as the last process exits
+          self._elapsed = time.time() - self._started
+        return True
+    return False
+
+  def finished(self):
+  #------------------
+    return all(p.returncode is not None for p in self._processes)
+
+  def returncode(self):
+  #--------------------
+    return self._processes[-1].returncode if self._processes else None
+
+  def run(self, measure=False):
+  #----------------------------
+    signal.signal(signal.SIGINT, self.interrupt)
+    self.start(measure=measure)
+    # wait4() blocks in the kernel instead of polling. We retry after EINTR,
+    # so SIGINT is still passed on by interrupt().
+    for p in self._processes:
+      while True:
+        try:
+          pid, status, usage = os.wait4(p.pid, 0)
           break
-      time.sleep(0.0001)
-    return process.returncode
+        except OSError, e:
+          if e.errno != errno.EINTR: raise
+      self.reaped(pid, status, usage)
+    return self.returncode()
+
+  def provenance(self):
+  #--------------------
+    """
+    How the command's pipeline performed when it was last run.
+
+    :return: A dictionary giving wall time, user and system CPU time and maximum
+      resident set size (in KiB) for the pipeline and for each of its stages,
+      along with the number of bytes each stage output if they were measured.
+      None if the command wasn't run.
+    """
+    if not self._processes or not self.finished(): return None
+    stages = [ ]
+    for n, p in enumerate(self._processes):
+      usage = self._usage.get(p.pid)
+      stage = { 'command': ' '.join(pipes.quote(c) for c in self._commands[n]),
+                'returncode': p.returncode,
+                'bytes': self._bytes[n] }
+      if usage is not None:
+        stage.update({ 'user': usage.ru_utime, 'system': usage.ru_stime, 'maxrss': usage.ru_maxrss })
+      stages.append(stage)
+    if self._outsize is not None and os.path.isfile(self._output):
+      stages[-1]['bytes'] = os.path.getsize(self._output) - self._outsize
+    record = { 'command': str(self),
+               'started': datetime.utcfromtimestamp(self._started).isoformat() + 'Z',
+               'wall': self._elapsed,
+               'returncode': self.returncode(),
+               'stages': stages }
+    if self._input not in [None, ''] and os.path.isfile(self._input):
+      record['input_bytes'] = os.path.getsize(self._input)
+    if all('user' in s for s in stages):
+      record.update({ 'user': sum(s['user'] for s in stages),
+                      'system': sum(s['system'] for s in stages),
+                      'maxrss': max(s['maxrss'] for s in stages) })
+    return record
+
+
+STDOUT = '<stdout>'   # Pipelines without an output file share standard output
+
+
+def dependencies(commands):
+#==========================
+  """
+  Find which earlier commands each command must follow, because it reads a
+  file that an earlier command writes, or writes a file that an earlier
+  command reads or writes. A command reads its input and controlled files,
+  and any file named on its command line.
+
+  :return: A list giving the set of indices of earlier commands for each command.
+  """
+  outputs = set(os.path.abspath(f) for c in commands for f in c.output_files())
+  files = [ ]
+  for c in commands:
+    reads = set(os.path.abspath(f) for f in c.controlled_files() + c.argument_files())
+    # Outputs of earlier commands may not exist yet, so aren't argument files
+    reads.update(w for w in (os.path.abspath(w) for cmd in c._commands for w in cmd) if w in outputs)
+    writes = set(os.path.abspath(f) for f in c.output_files()) or set([STDOUT])
+    files.append((reads, writes))
+  result = [ ]
+  for n, (reads, writes) in enumerate(files):
+    result.append(set(m for m in xrange(n)
+                        if files[m][1] & (reads | writes) or files[m][0] & writes))
+  return result
+
+
+def run_commands(commands, jobs=1, cache=None, measure=False):
+#=============================================================
+  """
+  Run commands, with up to ``jobs`` independent pipelines running at once.
+
+  Pipelines are started in the order given, once all the commands they depend
+  on have finished. When running in parallel, pipelines without an input file
+  read from ``/dev/null`` instead of sharing standard input.
+
+  :param cache: An optional :class:`result_cache.ResultCache`. Commands whose
+    outputs are in the cache aren't run, and the outputs of commands that
+    succeed are saved in it.
+  :param measure: Count the bytes passed between the stages of each pipeline.
+  :return: The return code of the last command.
+  """
+  keys = { }
+
+  def restored(n):
+  #---------------
+    if cache is not None:
+      keys[n] = cache.key(commands[n])
+      if keys[n] is not None and cache.restore(keys[n], commands[n]): return True
+    return False
+
+  def save(n, returncode):
+  #-----------------------
+    if keys.get(n) is not None and returncode == 0:
+      cache.store(keys[n], commands[n])
+
+  if jobs <= 1 or len(commands) <= 1:
+    returncode = 0
+    for n, c in enumerate(commands):
+      if restored(n):
+        returncode = 0
+      else:
+        returncode = c.run(measure)
+        save(n, returncode)
+    return returncode
+
+  following = dependencies(commands)
+  waiting = range(len(commands))
+  running = [ ]
+  done = set()
+  returncode = { }
+
+  def interrupt(signum, frame):
+  #----------------------------
+    for n in running: commands[n].interrupt(signum, frame)
+
+  signal.signal(signal.SIGINT, interrupt)
+  devnull = open(os.devnull, 'r')
+  try:
+    while waiting or running:
+      for n in list(waiting):
+        if len(running) >= jobs: break
+        if following[n] <= done:
+          waiting.remove(n)
+          if restored(n):
+            returncode[n] = 0
+            done.add(n)
+          else:
+            commands[n].start(devnull, measure)
+            running.append(n)
+      if not running: continue
+      try:
+        pid, status, usage = os.wait3(0)   # Blocks until any process exits
+      except OSError, e:
+        if e.errno == errno.EINTR: continue
+        elif e.errno != errno.ECHILD: raise
+      else:
+        for n in running:
+          if commands[n].reaped(pid, status, usage): break
+      for n in list(running):
+        if commands[n].finished():
+          running.remove(n)
+          done.add(n)
+          returncode[n] = commands[n].returncode()
+          save(n, returncode[n])
+  finally:
+    devnull.close()
+  return returncode[len(commands) - 1]
 
 
 def commands(script, params):
@@ -1,13 +1,18 @@
 import os
 import sys
+import json
 import logging
+from datetime import datetime
 
 import git
 
 import command_processor
+import result_cache
 
 VERSION = '0.0.1'
 
+DIFF_PATHS = 1000     # Maximum paths given to a git diff at once
+
 
 class SourceRepository(object):
 #==============================
@@ -19,7 +24,7 @@ class SourceRepository(object):
     except git.exc.InvalidGitRepositoryError:
       raise IOError("Path isn't to a git repository")
     self._base = self._repo.working_dir
-    # _repo.git_dir
+    self._changes = { }
 
   def revision(self):
   #------------------
@@ -33,20 +38,57 @@ class SourceRepository(object):
   #--------------
     return self._base
 
-  def changed_file(self, filename, diff=False):
-  #--------------------------------------------
+  def git_dir(self):
+  #-----------------
+    return self._repo.git_dir
+
+  def _gitname(self, filename):
+  #----------------------------
     try:
-      gitname = os.path.abspath(filename).split(self._base, 1)[1][1:]
+      return os.path.abspath(filename).split(self._base, 1)[1][1:]
     except IndexError:
       raise KeyError("File outside of controlled directories")
-    try:
-      cm = self._repo.head.commit
-      obj = cm.tree[gitname]
-      d = cm.diff(None, paths=[obj.path], create_patch=diff)
-      if diff: return d[0].diff if d else ''
-      else:    return len(d) != 0
-    except KeyError:
-      return None if diff else True  ## Need to add file
+
+  def changes(self, filenames, diff=False):
+  #----------------------------------------
+    """
+    Compare files with the head revision, using a single git diff for all of
+    them. Results are cached, so later calls for the same files are free.
+
+    :return: A dictionary giving, for each file, None if it isn't tracked and
+      otherwise its diff text if ``diff`` is set, else whether it has changed.
+    """
+    cm = self._repo.head.commit
+    results = { }
+    paths = { }
+    for f in set(filenames):
+      if (f, diff) in self._changes:
+        results[f] = self._changes[(f, diff)]
+        continue
+      gitname = self._gitname(f)
+      try:
+        cm.tree[gitname]
+        paths.setdefault(gitname, []).append(f)
+      except KeyError:
+        results[f] = None      ## Need to add file
+    if paths:
+      names = sorted(paths)
+      changed = { }
+      for n in xrange(0, len(names), DIFF_PATHS):
+        for d in cm.diff(None, paths=names[n:n+DIFF_PATHS], create_patch=diff):
+          changed[(d.a_blob or d.b_blob).path] = d.diff if diff else True
+      for gitname, files in paths.iteritems():
+        for f in files:
+          results[f] = changed.get(gitname, '' if diff else False)
+    for f, result in results.iteritems():
+      self._changes[(f, diff)] = result
+    return results
+
+  def changed_file(self, filename, diff=False):
+  #--------------------------------------------
+    result = self.changes([filename], diff)[filename]
+    if result is None and not diff: return True   ## Need to add file
+    return result
 
   def commit(self, files, comment):
   #--------------------------------
@@ -55,6 +97,7 @@ class SourceRepository(object):
       idx.add(files)
       idx.commit(comment)
       idx.write()
+      self._changes = { }
 
   def tag(self, tag, message):
   #---------------------------
@@ -66,10 +109,35 @@ class SourceRepository(object):
 if __name__ == '__main__':
 #=========================
 
+  usage = "Usage: %s [-r] [-j JOBS] [-p FILE [-c]] COMMAND_FILE [params]" % sys.argv[0]
   if len(sys.argv) < 2:
-    sys.exit("Usage: %s [options] COMMAND_FILE [params]" % sys.argv[0])
+    sys.exit(usage)
 
   cmd = 1     # Position of command file in argument list...
+  jobs = 1
+  restore = False
+  provenance = None
+  commit_provenance = False
+  while cmd < len(sys.argv) and sys.argv[cmd].startswith('-'):
+    if sys.argv[cmd] == '-r':
+      restore = True
+      cmd += 1
+    elif sys.argv[cmd] == '-c':
+      commit_provenance = True
+      cmd += 1
+    elif sys.argv[cmd] == '-p' and cmd + 1 < len(sys.argv):
+      provenance = sys.argv[cmd+1]
+      cmd += 2
+    elif sys.argv[cmd] == '-j':
+      try:
+        jobs = int(sys.argv[cmd+1])
+      except (IndexError, ValueError):
+        sys.exit(usage)
+      cmd += 2
+    else:
+      sys.exit(usage)
+  if len(sys.argv) <= cmd:
+    sys.exit(usage)
   ## options:  -n      Print commands but without executing them
   ##           ??      Set working directory ??
   ##           ??      Set controlled directory ??
@@ -78,6 +146,10 @@ if __name__ == '__main__':
   ##           -d      Store diffs instead of auto-commit
 
   ##           -v      Verbose (debug level ?)
+  ##           -j      Number of independent pipelines to run at once
+  ##           -r      Restore unchanged results from the cache, instead of running all commands
+  ##           -p      File to save timing and resource use of commands in
+  ##           -c      Commit the provenance file after running
 
   ##                   Specify config flag for commands (other than known ones).
   ##                   List config flags for 'known' commands.
@@ -101,14 +173,16 @@ if __name__ == '__main__':
 
   repo = SourceRepository()
   if autocommit:
-    changed = [f for f in controlled if repo.changed_file(f)]
+    changes = repo.changes(controlled)
+    changed = [f for f in controlled if changes[f] is not False]
     logging.info("Committing: %s", changed)
     if not dryrun: repo.commit(changed, comment)
   else:
     differences = { }
     untracked = [ ]
+    changes = repo.changes(controlled, True)
     for f in controlled:
-      diff = repo.changed_file(f, True)
+      diff = changes[f]
       if diff is None:
         untracked.append(f)
       elif diff:
@@ -121,10 +195,30 @@ if __name__ == '__main__':
   ## Provenance includes name (__file__ ??) and version of execute.py
 
   exitcode = 0
-  for c in commands:
-    if dryrun:
+  if dryrun:
+    for c in commands:
       sys.stderr.write('\n| '.join([' '.join(cmds) for cmds in c._commands]))
       sys.stderr.write('\n')
-    else:
-      exitcode = c.run()
+  else:
+    cache = None if not restore else result_cache.ResultCache(
+      os.path.join(repo.git_dir(), 'execute', 'cache'), repo.revision(), not autocommit)
+    started = datetime.utcnow()
+    exitcode = command_processor.run_commands(commands, jobs, cache, provenance is not None)
+    if cache is not None: cache.evict()
+    if provenance is not None:
+      record = { 'program': os.path.basename(__file__),
+                 'version': VERSION,
+                 'repository': repo.path(),
+                 'branch': repo.branch(),
+                 'revision': repo.revision(),
+                 'command_file': sys.argv[cmd],
+                 'params': sys.argv[cmd+1:],
+                 'started': started.isoformat() + 'Z',
+                 'exitcode': exitcode,
+                 'commands': [ c.provenance() or { 'command': str(c), 'restored': True }
+                                 for c in commands ] }
+      with open(provenance, 'w') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+      if commit_provenance:
+        repo.commit([os.path.abspath(provenance)], "Provenance of %s at %s" % (sys.argv[cmd], record['started']))
   sys.exit(exitcode)
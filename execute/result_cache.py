@@ -0,0 +1,175 @@
+"""
+Result cache
+============
+
+Output files of commands are kept in a content-addressed cache, so that a
+command which is run again with the same command line and the same input,
+controlled and argument files, has its outputs restored instead of being re-run.
+
+A command's key is the SHA1 hash of its expanded command line, together with
+the git blob hashes of its input and controlled files and of every other
+existing file named on its command line, such as a script and its data. The
+source revision is also part of the key when changes aren't committed before
+running, and for commands whose reads aren't all declared (see
+:meth:`command_processor.Command.declared_reads`), as these can read files that
+aren't named on their command line, or are named inside a quoted shell string.
+
+Outputs are stored under their git blob hash in ``objects``, and each key has a
+record in ``runs`` listing the command's output files, their hashes and the
+source revision that produced them.
+
+A file that a command reads without declaring it or naming it on its command
+line, and that isn't committed, is in no key, so its changes can't be seen and
+stale outputs would be restored. The cache is therefore only used when asked
+for (``execute.py -r``).
+
+Only commands that save their output to files, without appending, are cached,
+and only when they create all of them.
+Only the :data:`MAX_RUNS` most recently used records are kept, along with the
+outputs they refer to.
+
+"""
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+
+
+BUFFER_SIZE = 1024*1024
+
+MAX_RUNS = 1000       # Records kept when evicting
+
+
+def blob_hash(filename):
+#=======================
+  """
+  The hash git gives a file's contents, as ``git hash-object`` would.
+  """
+  sha = hashlib.sha1('blob %d\0' % os.path.getsize(filename))
+  with open(filename, 'rb') as f:
+    while True:
+      data = f.read(BUFFER_SIZE)
+      if not data: break
+      sha.update(data)
+  return sha.hexdigest()
+
+
+class ResultCache(object):
+#=========================
+
+  def __init__(self, path, revision=None, keyed=False):
+  #----------------------------------------------------
+    """
+    :param revision: The source revision, recorded with each run.
+    :param keyed: Make the revision part of every command's key, not just of
+      those whose reads aren't all declared.
+    """
+    self._path = path
+    self._revision = revision
+    self._keyed = keyed
+    for d in ['objects', 'runs']:
+      try:
+        os.makedirs(os.path.join(path, d))
+      except OSError, e:
+        if e.errno != errno.EEXIST: raise
+
+  def _object(self, hash):
+  #-----------------------
+    return os.path.join(self._path, 'objects', hash[:2], hash[2:])
+
+  def _run(self, key):
+  #-------------------
+    return os.path.join(self._path, 'runs', key)
+
+  def key(self, command):
+  #----------------------
+    """
+    Find the key for a command.
+
+    :return: The key, or None if the command can't be cached.
+    """
+    outputs = command.output_files()
+    if not outputs or command.appends_output(): return None
+    keyed = self._keyed or not command.declared_reads()
+    sha = hashlib.sha1('%s\n%s' % (self._revision if keyed else '', command))
+    controlled = set(command.controlled_files())
+    for f in sorted(controlled):
+      if not os.path.isfile(f): return None
+      sha.update('\n%s %s' % (blob_hash(f), f))
+    for f in sorted(set(command.argument_files()) - controlled):
+      sha.update('\n%s %s' % (blob_hash(f), f))
+    return sha.hexdigest()
+
+  def restore(self, key, command):
+  #-------------------------------
+    """
+    Restore a command's output files from the cache.
+
+    :return: True if the outputs were restored.
+    """
+    try:
+      with open(self._run(key), 'r') as f:
+        record = json.load(f)
+      for output, hash in record['outputs'].iteritems():
+        if not os.path.isfile(self._object(hash)): return False
+      for output, hash in record['outputs'].iteritems():
+        shutil.copyfile(self._object(hash), output)
+      os.utime(self._run(key), None)   # Recently used, so kept by evict()
+    except (OSError, IOError, ValueError, KeyError):
+      return False
+    logging.info("Restored output of '%s' from revision %s", command, record.get('revision'))
+    return True
+
+  def store(self, key, command):
+  #-----------------------------
+    if not all(os.path.isfile(f) for f in command.output_files()): return
+    outputs = { }
+    for output in command.output_files():
+      hash = blob_hash(output)
+      obj = self._object(hash)
+      if not os.path.exists(obj):
+        self._save(output, obj)
+      outputs[output] = hash
+    record = { 'command': str(command), 'revision': self._revision, 'outputs': outputs }
+    fd, tmp = tempfile.mkstemp(dir=self._path)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(record, f, indent=2)
+    os.rename(tmp, self._run(key))     # Replace atomically
+
+  def _save(self, filename, obj):
+  #------------------------------
+    try:
+      os.makedirs(os.path.dirname(obj))
+    except OSError, e:
+      if e.errno != errno.EEXIST: raise
+    fd, tmp = tempfile.mkstemp(dir=self._path)
+    os.close(fd)
+    shutil.copyfile(filename, tmp)
+    os.rename(tmp, obj)
+
+  def evict(self, keep=MAX_RUNS):
+  #------------------------------
+    """
+    Remove all but the ``keep`` most recently used run records, and then any
+    outputs that no remaining record refers to.
+    """
+    runs = os.path.join(self._path, 'runs')
+    records = sorted((os.path.getmtime(r), r) for r in [ os.path.join(runs, k) for k in os.listdir(runs) ])
+    old = max(0, len(records) - keep)
+    for t, r in records[:old]: os.remove(r)
+    wanted = set()
+    for t, r in records[old:]:
+      try:
+        with open(r, 'r') as f:
+          wanted.update(json.load(f)['outputs'].itervalues())
+      except (IOError, ValueError, KeyError):
+        pass
+    objects = os.path.join(self._path, 'objects')
+    for d in os.listdir(objects):
+      for h in os.listdir(os.path.join(objects, d)):
+        if d + h not in wanted: os.remove(os.path.join(objects, d, h))
+      if not os.listdir(os.path.join(objects, d)): os.rmdir(os.path.join(objects, d))
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import command_processor
+
+
+SCRIPT = [ ' sh -c "sleep 1; echo hello"\n',
+           '> data.txt\n',
+           ' wc -c data.txt\n',
+           '> result.txt\n' ]
+
+
+class DependencyTest(unittest.TestCase):
+#=======================================
+
+  def setUp(self):
+  #---------------
+    self._cwd = os.getcwd()
+    self._dir = tempfile.mkdtemp()
+    os.chdir(self._dir)
+
+  def tearDown(self):
+  #------------------
+    os.chdir(self._cwd)
+    shutil.rmtree(self._dir)
+
+  def test_argument_reads_earlier_output(self):
+  #--------------------------------------------
+    commands = list(command_processor.commands(SCRIPT, []))
+    self.assertEqual(command_processor.dependencies(commands), [set(), set([0])])
+
+  def test_parallel_keeps_order(self):
+  #-----------------------------------
+    commands = list(command_processor.commands(SCRIPT, []))
+    self.assertEqual(command_processor.run_commands(commands, jobs=2), 0)
+    with open('result.txt') as f:
+      self.assertEqual(f.read().split(), ['6', 'data.txt'])
+
+
+if __name__ == '__main__':
+#=========================
+  unittest.main()
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import command_processor
+import result_cache
+
+
+class KeyTest(unittest.TestCase):
+#================================
+
+  def setUp(self):
+  #---------------
+    self._cwd = os.getcwd()
+    self._dir = tempfile.mkdtemp()
+    os.chdir(self._dir)
+    with open('in.txt', 'w') as f: f.write('one\n')
+    with open('plot.cfg', 'w') as f: f.write('ctrls\n')
+
+  def tearDown(self):
+  #------------------
+    os.chdir(self._cwd)
+    shutil.rmtree(self._dir)
+
+  def _key(self, command, revision, keyed=False):
+  #----------------------------------------------
+    return result_cache.ResultCache(os.path.join(self._dir, 'cache'), revision, keyed).key(command)
+
+  def test_undeclared_reads(self):
+  #-------------------------------
+    command = command_processor.Command(None, [['sh', '-c', 'cat in.txt']], 'out.txt')
+    self.assertFalse(command.declared_reads())
+    self.assertNotEqual(self._key(command, 'r1'), self._key(command, 'r2'))
+
+  def test_declared_reads(self):
+  #-----------------------------
+    command = command_processor.Command('in.txt', [['pertecs', '-c', 'plot']], 'out.txt')
+    self.assertTrue(command.declared_reads())
+    key = self._key(command, 'r1')
+    self.assertEqual(key, self._key(command, 'r2'))
+    self.assertNotEqual(key, self._key(command, 'r2', True))
+    with open('in.txt', 'w') as f: f.write('two\n')
+    self.assertNotEqual(key, self._key(command, 'r1'))
+
+
+if __name__ == '__main__':
+#=========================
+  unittest.main()
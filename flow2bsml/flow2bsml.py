@@ -1,11 +1,16 @@
-import mmap
-import struct
-import os
+import os, sys
 import uuid
+import json
+import hashlib
+import itertools
 import urllib
 import platform
-from datetime import datetime
+import math
 import logging
+from datetime import timedelta
+import multiprocessing
+import multiprocessing.util
+import signal as sighandler
 
 
 from biosignalml import BSML
@@ -15,31 +20,15 @@ import biosignalml.model as model
 import biosignalml.units as units
 import biosignalml.rdf as rdf
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))   # Shared modules
 
-__version__ = '0.4.0'
-
-
-def get_time(ts):
-#================
-  buf = buffer(ts)
-  date = struct.unpack_from("<H", buf)[0]
-  year = 2000 + (date >> 9)
-  month = (date & 0x01E0) >> 5
-  day = (date & 0x001F)
-  time = struct.unpack_from("<H", buf, 2)[0]
-  hours = time >> 11
-  mins = (time & 0x07E0) >> 5
-  secs = (time & 0x001F) << 1
-  if (1 <= month <= 12 and 1 <= day <= 31
-   and hours < 24 and mins < 60 and secs < 60):
-    return datetime(year, month, day, hours, mins, secs)
-  else:
-    raise ValueError("Invalid timestamp")
+import flowfile
+import pyramid
+import events
+import segments
 
 
-def good_block(b):
-#=================
-  return b[103:105] == '\xFF\xFF'
+__version__ = '0.4.0'
 
 
 class SendError(Exception):
@@ -47,112 +36,235 @@ class SendError(Exception):
   pass
 
 
-def send_file(repo, base, fn, uid=False, replace=False):
-#=======================================================
+def send_file(repo, base, fn, uid=False, replace=False, interval=None, chunksize=flowfile.CHUNK_SIZE,
+              overview=False, detect=None):
+#====================================================================================================
 
   logging.debug("Converting %s", fn)
 
   fn = os.path.normpath(fn)
-  f = open(fn, mode='r')
-  buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-  hdr = buf[:512]
-  if hdr[-1] != '\x3B': raise SendError("Bad file header")
-  header = hdr.split('\x0D')
-  if len(header) != 7: raise SendError("Wrong header format")
-  if   buf[512:516] == '\x00\x00\x00\x00':
-    raise SendError("File appears to be empty")
-  error = ''
+  flow_file = flowfile.FlowFile(fn)
   try:
-    if not good_block(buf[516:]): raise ValueError("Block error")
-    timestamp = get_time(buf[512:516])
-    pos = 516
-  except ValueError:
-    if good_block(buf[1028:]):
-      error = "First 512-byte chunk corrupt"
-      timestamp = get_time(buf[1024:1028])
-      pos = 1028
+    if uid: uri = base + '/' + str(uuid.uuid4())
     else:
-      error = "Short first block"
-      timestamp = get_time(buf[512:516])
-      pos = buf.find('\xFF\xFF') + 2
-  serialno = header[3]
-  fileid = header[2].rsplit('.', 1)[0]
-
-  if uid: uri = base + '/' + str(uuid.uuid4())
+      path = os.path.splitext(fn)[0].replace(' ', '_') # Remove extension and replace ' ' with '_'
+      if path[0] not in ['.', '/']: uri = '/' + path
+      elif path.startswith('./'):   uri = path[1:]
+      else:                         uri = os.path.abspath(path)
+      if '-' in uri or uri != urllib.quote(uri):
+        raise SendError("Invalid characters in resulting URI")
+      uri = base + uri
+    try:
+      repo.get_recording(uri)
+      if not replace:
+        raise SendError("Recording `%s` already exists" % uri)
+    except IOError:
+      pass
+    logging.info('%s --> %s', fn, uri)
+    offset = 0 if interval is None else max(0, int(math.floor(interval[0])))
+
+    rec = repo.new_recording(uri, ## description=,
+                             starttime=flow_file.timestamp + timedelta(seconds=offset),
+                             source='file://%s%s' % (platform.node(), os.path.realpath(fn)),
+                             creator='http://devices.biosignalml.org/icon/%s' % flow_file.serialno)
+    if flow_file.error: rec.add_resource(model.Annotation.Note(rec.uri.make_uri(), rec.uri,
+                   flow_file.error, tags=[BSML.ErrorTAG],
+                   creator='file://' + os.path.abspath(__file__)))
+
+    # rec.annotate(error, tags=, ...)  ####
+    ## Graph is only created when getting metadata as graph...
+    ## So core abstract object can have a list of annotations and an 'annotate' method??
+
+    ## Also device model, firmware rev, serial number, etc...
+
+    flow = rec.new_signal(None, units=units.get_units_uri('lpm'),
+      id=0, rate=50, label='Flow', dtype='f4')
+    pressure = rec.new_signal(None, units=units.get_units_uri('cmH2O'),
+      id=1, rate=1,  label='CPAP Pressure', dtype='f4')
+    leak = rec.new_signal(None, units=units.get_units_uri('lpm'),
+      id=2, rate=1,  label='Leak', dtype='f4')
+    pyramids = pyramid.OverviewWriter(rec, [ flow, pressure, leak ]) if overview else None
+    detections = [ None, None, None ]
+    if detect:
+      writer = events.EventWriter(rec)
+      for n, s in enumerate([ flow, pressure, leak ]):
+        if detect.get(n):
+          detections[n] = events.Detection([ events.make_detector(d, s.rate) for d in detect[n] ], writer, s.uri)
+    duration = 0
+    logging.debug("Reading file...")
+    for fdata, pdata, ldata in flow_file.data(chunksize, interval):   # Append data as it's decoded
+      flow.append(UniformTimeSeries(fdata, rate=50))
+      pressure.append(UniformTimeSeries(pdata, rate=1))
+      leak.append(UniformTimeSeries(ldata, rate=1))
+      if pyramids is not None:
+        for n, data in enumerate([ fdata, pdata, ldata ]): pyramids.append(n, data)
+      for d, data in zip(detections, [ fdata, pdata, ldata ]):
+        if d is not None: d.process(data)
+      duration += len(pdata)
+      logging.debug("Appended %d seconds...", duration)
+    if pyramids is not None: pyramids.close()
+    for d in detections:
+      if d is not None: d.finish()
+    for start, length, pos, size in flow_file.gaps:
+      start -= offset
+      if start + length <= 0 or start >= duration: continue
+      logging.warning("%s: %d bytes of corrupt data at offset %d", fn, size, pos)
+      segment = rec.new_segment(rec.uri.make_uri(), start, length)
+      rec.add_resource(model.Annotation.Note(rec.uri.make_uri(), segment.uri,
+                   "Corrupt data (%d bytes at file offset %d)" % (size, pos), tags=[BSML.ErrorTAG],
+                   creator='file://' + os.path.abspath(__file__)))
+
+    logging.debug("Finishing...")
+
+    rec.duration = duration    ### Does this update metadata on server...??
+    rec.close()                ### Does so when recording closed
+  finally:
+    flow_file.close()
+  return uri
+
+
+def file_checksum(fn):
+#=====================
+  md5 = hashlib.md5()
+  with open(fn, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), ''):
+      md5.update(block)
+  return md5.hexdigest()
+
+
+class Manifest(object):
+#======================
+
+  # Each line is tab separated: status, path, size, mtime, checksum, the options
+  # the file was stored with, and either the recording's URI or an error message.
+  # Later lines supersede earlier ones for the same path and options.
+
+  def __init__(self, filename):
+  #----------------------------
+    self._entries = { }
+    if os.path.exists(filename):
+      with open(filename) as f:
+        for l in f:
+          fields = l.rstrip('\n').split('\t', 6)
+          if len(fields) == 7: self._entries[(fields[1], fields[5])] = fields
+    self._file = open(filename, 'a')
+
+  @staticmethod
+  def options(**options):
+  #----------------------
+    """
+    Describe the options files are stored with, so that storing a file with
+    different options, e.g. another segment, isn't skipped.
+    """
+    return json.dumps(options, sort_keys=True)
+
+  def close(self):
+  #---------------
+    self._file.close()
+
+  @staticmethod
+  def file_status(fn):
+  #-------------------
+    st = os.stat(fn)
+    return (os.path.realpath(fn), str(st.st_size), '%.6f' % st.st_mtime)
+
+  def completed(self, fn, options):
+  #--------------------------------
+    """
+    Return ``(done, checksum)``, where ``done`` is True if the file has been
+    stored with ``options`` and not changed since, and ``checksum`` is that of
+    the previously stored file (if any).
+    """
+    path, size, mtime = self.file_status(fn)
+    entry = self._entries.get((path, options))
+    if entry is None or entry[0] != 'done': return (False, None)
+    return (entry[2] == size and entry[3] == mtime, entry[4])
+
+  def record(self, fn, options, status, checksum, result):
+  #-------------------------------------------------------
+    path, size, mtime = self.file_status(fn)
+    entry = [ status, path, size, mtime, checksum or '', options, str(result).replace('\n', ' ') ]
+    self._entries[(path, options)] = entry
+    self._file.write('\t'.join(entry) + '\n')
+    self._file.flush()
+
+  def uri(self, fn, options):
+  #--------------------------
+    entry = self._entries.get((self.file_status(fn)[0], options))
+    return entry[6] if entry is not None else None
+
+
+_repository = None
+
+def _start_worker(repo_uri, pooled=True):
+#=========================================
+  global _repository
+  _repository = Repository(repo_uri)
+  if pooled:
+    sighandler.signal(sighandler.SIGINT, sighandler.SIG_IGN)  # Parent handles ^C
+    multiprocessing.util.Finalize(_repository, _repository.close, exitpriority=10)
+
+
+def _store_file(task):
+#=====================
+  fn, base, uid, replace, interval, overview, detect, checksum, uri = task
+  try:
+    current = file_checksum(fn)
+    if checksum is not None and current == checksum:
+      return (fn, 'done', current, uri)    # Only the file's mtime has changed
+    return (fn, 'done', current, send_file(_repository, base, fn, uid, replace, interval,
+                                           overview=overview, detect=detect))
+  except (SendError, flowfile.FormatError, ValueError, IOError, OSError), msg:
+    logging.exception("%s: Unable to store", fn)
+    return (fn, 'error', None, '%s: %s' % (type(msg).__name__, msg))
+
+
+def store_files(repo_uri, base, files, jobs=1, manifest=None, uid=False, replace=False, interval=None,
+                overview=False, detect=None):
+#=====================================================================================================
+  tasks = [ ]
+  errors = 0
+  options = Manifest.options(base=base, uid=uid, interval=interval, overview=overview, detect=detect)
+  for fn in files:
+    if not os.path.isfile(fn):
+      logging.error('%s: No such file', fn)
+      errors += 1
+      continue
+    checksum = None
+    if manifest is not None:
+      done, checksum = manifest.completed(fn, options)
+      if done:
+        logging.debug("Skipping %s", fn)
+        continue
+    tasks.append((fn, base, uid, replace, interval, overview, detect, checksum,
+                  manifest.uri(fn, options) if checksum is not None else None))
+  logging.info("Storing %d of %d files using %d processes", len(tasks), len(files), jobs)
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs, _start_worker, (repo_uri,))
+    results = pool.imap_unordered(_store_file, tasks)
   else:
-    path = os.path.splitext(fn)[0].replace(' ', '_') # Remove extension and replace ' ' with '_'
-    if path[0] not in ['.', '/']: uri = '/' + path
-    elif path.startswith('./'):   uri = path[1:]
-    else:                         uri = os.path.abspath(path)
-    if '-' in uri or uri != urllib.quote(uri):
-      raise SendError("Invalid characters in resulting URI")
-    uri = base + uri
+    pool = None
+    _start_worker(repo_uri, False)
+    results = itertools.imap(_store_file, tasks)
   try:
-    repo.get_recording(uri)
-    if not replace:
-      raise SendError("Recording `%s` already exists" % uri)
-  except IOError:
-    pass
-  logging.info('%s --> %s', fn, uri)
-
-  rec = repo.new_recording(uri, ## description=,
-                           starttime=timestamp,
-                           source='file://%s%s' % (platform.node(), os.path.realpath(fn)),
-                           creator='http://devices.biosignalml.org/icon/%s' % serialno)
-  if error: rec.add_resource(model.Annotation.Note(rec.uri.make_uri(), rec.uri,
-                 error, tags=[BSML.ErrorTAG],
-                 creator='file://' + os.path.abspath(__file__)))
-
-  # rec.annotate(error, tags=, ...)  ####
-  ## Graph is only created when getting metadata as graph...
-  ## So core abstract object can have a list of annotations and an 'annotate' method??
-
-  ## Also device model, firmware rev, serial number, etc...
-
-  flow = rec.new_signal(None, units=units.get_units_uri('lpm'),
-    id=0, rate=50, label='Flow', dtype='f4')
-  pressure = rec.new_signal(None, units=units.get_units_uri('cmH2O'),
-    id=1, rate=1,  label='CPAP Pressure', dtype='f4')
-  leak = rec.new_signal(None, units=units.get_units_uri('lpm'),
-    id=2, rate=1,  label='Leak', dtype='f4')
-  fdata = []
-  pdata = []
-  ldata = []
-  duration = 0
-  logging.debug("Reading file...")
-  while buf[pos:pos+4] != '\xFF\x7F\x00\x00':
-    record = buffer(buf[pos:pos+105])
-    duration += 1
-    for i in xrange(50):
-      fdata.append(struct.unpack_from('<h', record, 2*i)[0]/100.0)
-    pdata.append(struct.unpack_from('<h', record, 100)[0]/100.0)
-    ldata.append(struct.unpack_from('B', record, 102)[0]/100.0)
-    if record[103:105] != '\xFF\xFF':
-      raise SendError("Remainder of file has a short block")
-    pos += 105
-
-  logging.debug("All read, starting append...")
-  flow.append(UniformTimeSeries(fdata, rate=50))
-  ## sent as 'f8' ??
-
-  logging.debug("Flow appended...")
-  pressure.append(UniformTimeSeries(pdata, rate=1))
-  leak.append(UniformTimeSeries(ldata, rate=1))
-
-  logging.debug("Finishing...")
-
-  rec.duration = duration    ### Does this update metadata on server...??
-  rec.close()                ### Does so when recording closed
-
-  buf.close()
-  f.close()
+    for fn, status, checksum, result in results:
+      if status != 'done':
+        logging.error('%s: %s', fn, result)
+        errors += 1
+      if manifest is not None: manifest.record(fn, options, status, checksum, result)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    else:
+      _repository.close()
+  return errors
 
 
 if __name__ == '__main__':
 #=========================
 
   import docopt
-  import sys
 
 
   LOGFORMAT = '%(asctime)s %(levelname)8s: %(message)s'
@@ -182,6 +294,37 @@ Options:
 
   -u --uuid     Use UUID strings for file names.
 
+  -s SEGMENT --segment=SEGMENT
+                Only store the given temporal segment of each file.
+
+                SEGMENT is either "start-end" or "start:duration", with times
+                being in seconds from the start of the file's data. Times are
+                widened to whole seconds.
+
+  -j N --jobs=N  Store files using N worker processes. [default: 1]
+
+  -o --overview  Also store overview pyramids, giving the minimum, maximum
+                and mean of every 10, 100 and 1000 samples of each signal.
+
+  -e DETECTORS --detect=DETECTORS
+                Search signals for events as they are stored, annotating
+                the recording with events found. DETECTORS is a comma separated
+                list of "N:detector" entries, where "N" is the signal number
+                (0 = Flow, 1 = CPAP Pressure, 2 = Leak), with detectors without
+                a signal number searching Flow. A detector is one of:
+
+                  above:LEVEL[:DURATION]      below:LEVEL[:DURATION]
+                  rising:LEVEL                falling:LEVEL
+                  apnea[:DROP[:DURATION]]     hypopnea[:DROP[:DURATION]]
+                  flat[:DURATION[:TOLERANCE]]
+
+                with durations in seconds (see events.py).
+
+  -m FILE --manifest=FILE
+                Record the status of each file in FILE, skipping files that
+                have already been stored, with the same base URI, segment,
+                overview and detectors, and not changed since.
+
   """
 
   ## As parameters....
@@ -192,17 +335,39 @@ Options:
 ##  trial = p[1]
 
 
+  def parse_detectors(detectors):
+  #==============================
+    result = { }
+    if detectors in [None, '']: return result
+    for d in detectors.split(','):
+      channel, spec = d.split(':', 1) if d.split(':', 1)[0].isdigit() else ('0', d)
+      if int(channel) > 2: raise ValueError("Invalid signal number: %s" % channel)
+      events.make_detector(spec, 1.0)     # Check it's valid
+      result.setdefault(int(channel), [ ]).append(spec)
+    return result
+
+
   args = docopt.docopt(usage % { 'prog': sys.argv[0] } )
   if args['--debug']: logging.getLogger().setLevel(logging.DEBUG)
-  base = args['REPO']
-  repo = Repository(base)
-  if base.endswith('/'): base = base[:-1]
+  repo_uri = args['REPO']
+  base = repo_uri[:-1] if repo_uri.endswith('/') else repo_uri
+  try:
+    jobs = int(args['--jobs'])
+  except ValueError:
+    sys.exit("Invalid number of jobs")
+  try:
+    interval = segments.parse_segment(args['--segment'])
+  except ValueError:
+    sys.exit("Invalid segment specification")
+  try:
+    detect = parse_detectors(args['--detect'])
+  except ValueError, msg:
+    sys.exit(msg)
+  manifest = Manifest(args['--manifest']) if args['--manifest'] else None
   try:
-    for f in args['FILE']:
-      try:
-        send_file(repo, base, f, args['--uuid'], args['--replace'])
-      except SendError, msg:
-        logging.error('%s: %s', f, msg)
+    errors = store_files(repo_uri, base, args['FILE'], max(1, jobs), manifest,
+                         args['--uuid'], args['--replace'], interval, args['--overview'], detect)
   finally:
-    repo.close()
+    if manifest is not None: manifest.close()
+  sys.exit(1 if errors else 0)
 
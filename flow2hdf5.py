@@ -1,7 +1,9 @@
-import mmap
-import struct
-import os
-from datetime import datetime
+import os, sys
+import time
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
 
 from biosignalml import BSML
 from biosignalml.formats import HDF5Recording
@@ -9,141 +11,333 @@ from biosignalml.data import UniformTimeSeries
 import biosignalml.model as model
 import biosignalml.units as units
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'common'))   # Shared modules
+
+import flowfile
+
 
 URI_PREFIX   = "http://devel.biosignalml.org/fph/icon/"
 DATA_PREFIX  = "/recordings/fph/icon/"
 
+INTEGER_GAIN = 100.0      # FLOW values are stored as integers in units of 0.01
+
+## Layouts compared by a benchmark. Chunk shapes and the shuffle filter
+## need HDF5's ``h5repack`` utility.
+LAYOUTS = [ ('f4 default',             { }),     # HDF5Recording's own filter
+            ('f4 gzip',                { 'compression': 'gzip' }),
+            ('f4 lzf',                 { 'compression': 'lzf' }),
+            ('f4 shuffle gzip',        { 'compression': 'gzip', 'shuffle': True }),
+            ('i2 gzip',                { 'compression': 'gzip', 'integer': True }),
+            ('i2 lzf',                 { 'compression': 'lzf',  'integer': True }),
+            ('i2 shuffle gzip',        { 'compression': 'gzip', 'integer': True, 'shuffle': True }),
+            ('i2 shuffle gzip 36000',  { 'compression': 'gzip', 'integer': True, 'shuffle': True,
+                                         'chunks': 36000 }),
+          ]
+
+
+def compression_option(compression):
+#===================================
+  """
+  Convert a compression name ('gzip', 'gzip=LEVEL', 'lzf', 'szip' or 'none')
+  to the value h5py expects.
+  """
+  if compression is None: return None
+  elif compression == 'none': return None
+  elif compression.startswith('gzip='):
+    level = int(compression[5:])
+    if not 0 <= level <= 9: raise ValueError("Invalid gzip level")
+    return level
+  elif compression in ['gzip', 'lzf', 'szip']:
+    return compression
+  raise ValueError("Unknown compression '%s'" % compression)
+
+
+def check_layout(layout):
+#========================
+  """
+  Check that a layout can be written, before any files are converted.
+  """
+  compression = compression_option(layout.get('compression'))
+  if compression == 'lzf' and (layout.get('chunks') or layout.get('shuffle')):
+    raise ValueError("Chunk shapes and shuffle can't be used with 'lzf' compression")
 
-def get_time(ts):
-#================
-  buf = buffer(ts)
-  date = struct.unpack_from("<H", buf)[0] 
-  year = 2000 + (date >> 9)
-  month = (date & 0x01E0) >> 5
-  day = (date & 0x001F)
-  time = struct.unpack_from("<H", buf, 2)[0] 
-  hours = time >> 11
-  mins = (time & 0x07E0) >> 5
-  secs = (time & 0x001F) << 1
-  if (1 <= month <= 12 and 1 <= day <= 31
-   and hours < 24 and mins < 60 and secs < 60):
-    return datetime(year, month, day, hours, mins, secs)
+
+def mark_missing(filename, signals):
+#===================================
+  """
+  Give integer signal datasets a ``missing_value`` attribute, as netCDF and CF
+  readers honour, so gaps, stored as :data:`flowfile.MISSING_VALUE`, aren't
+  read as values of ``MISSING_VALUE/INTEGER_GAIN``.
+  """
+  import h5py
+  with h5py.File(filename, 'r+') as h5:
+    for s in signals:
+      h5[s].attrs.create('missing_value', flowfile.MISSING_VALUE, dtype='i2')
+
+
+def repack_filters(filename, signals, layout):
+#=============================================
+  """
+  Find the ``h5repack`` filters that give signal datasets a layout's compression
+  and shuffle filters. Without a compression in the layout, datasets keep the
+  compression they were created with.
+
+  :return: A list of ``h5repack`` filters, empty if datasets' filters are
+    unchanged.
+  """
+  if layout.get('compression') is None:
+    if not layout.get('shuffle'): return [ ]
+    import h5py
+    with h5py.File(filename, 'r') as h5:
+      compression = h5[signals[0]].compression
+      options = h5[signals[0]].compression_opts
+  else:
+    compression = compression_option(layout['compression'])
+    options = None
+  if isinstance(compression, int): compression, options = 'gzip', compression
+  if compression == 'szip':
+    coding, pixels = options or ('nn', 8)      # h5py's defaults
+    filters = [ 'SZIP=%d,%s' % (pixels, coding.upper()) ]
+  elif compression == 'gzip':
+    filters = [ 'GZIP=%d' % (4 if options is None else options) ]
+  elif compression is None:
+    filters = [ ]
   else:
-    raise ValueError("Invalid timestamp")
+    raise ValueError("h5repack can't use the '%s' filter" % compression)
+  if layout.get('shuffle'): filters.insert(0, 'SHUF')
+  return filters if filters else [ 'NONE' ]
 
 
-def good_block(b):
-#=================
-  return b[103:105] == '\xFF\xFF'
+def repack(filename, signals, layout):
+#=====================================
+  """
+  Use ``h5repack`` to set the chunk shape and filters of signal datasets.
+
+  (Creating signals via :class:`HDF5Recording` fixes chunking to h5py's choice,
+  with no shuffle filter.)
+  """
+  datasets = ','.join(signals)
+  cmd = [ 'h5repack' ]
+  if layout.get('chunks'): cmd.extend([ '-l', '%s:CHUNK=%d' % (datasets, layout['chunks']) ])
+  for f in repack_filters(filename, signals, layout):
+    cmd.extend([ '-f', '%s:%s' % (datasets, f) ])
+  packed = filename + '.repack'
+  try:
+    subprocess.check_call(cmd + [ filename, packed ])
+  except OSError:
+    raise RuntimeError("Chunk shapes and shuffle need HDF5's h5repack utility")
+  os.rename(packed, filename)
 
 
-def convert(fn, replace=False):
-#==============================
+def convert(fn, replace=False, layout=None, datadir=DATA_PREFIX):
+#================================================================
+  """
+  Convert a FLOW file into a BioSignalML HDF5 file.
 
+  :param layout: An optional dictionary with ``compression``, ``shuffle``,
+    ``chunks`` (the number of data points in a chunk), and ``integer`` (store
+    values as 16-bit integers) entries.
+  :return: The path of the HDF5 file.
+  """
   print "Converting ", fn
 
+  layout = layout or { }
   fn = os.path.abspath(fn)
-  f = open(fn, mode='r')
-  buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-  hdr = buf[:512]
-  if hdr[-1] != '\x3B': raise TypeError("Bad file header")
-  header = hdr.split('\x0D')
-  if len(header) != 7: raise TypeError("Wrong header format")
-  if   buf[512:516] == '\x00\x00\x00\x00':
-    raise Exception("File appears to be empty")
-  error = ''
+  flow_file = flowfile.FlowFile(fn)
   try:
-    if not good_block(buf[516:]): raise ValueError("Block error")
-    timestamp = get_time(buf[512:516])
-    pos = 516
-  except ValueError:
-    if good_block(buf[1028:]):
-      error = "First 512-byte chunk corrupt"
-      timestamp = get_time(buf[1024:1028])
-      pos = 1028
-    else:
-      error = "Short first block"
-      timestamp = get_time(buf[512:516])
-      pos = buf.find('\xFF\xFF') + 2
-  serialno = header[3]
-  fileid = header[2].rsplit('.', 1)[0]
-
-  # ./FlowData/NZ_Patients/30_Day_Data/07124524/FLW0003.FPH
-  filepath = fn.rsplit('/FlowData/', 1)[1].rsplit('/', 1)[0].replace(' ', '_')
-  p = filepath.split('/')
-  region = p[0]
-  trial = p[1]
-
-  datapath = DATA_PREFIX + filepath
-  dataset = 'file://' + datapath + '/' + fileid + '.h5'
-  uri = URI_PREFIX + filepath + '/' + fileid
+    # ./FlowData/NZ_Patients/30_Day_Data/07124524/FLW0003.FPH
+    filepath = fn.rsplit('/FlowData/', 1)[1].rsplit('/', 1)[0].replace(' ', '_')
+    p = filepath.split('/')
+    region = p[0]
+    trial = p[1]
+
+    datapath = os.path.join(datadir, filepath)
+    filename = datapath + '/' + flow_file.fileid + '.h5'
+    dataset = 'file://' + filename
+    uri = URI_PREFIX + filepath + '/' + flow_file.fileid
+
+    try:
+      os.makedirs(datapath, 0755)
+    except OSError:
+      if os.path.isdir(datapath): pass
+      else: raise # Directory creation error
+    h5 = HDF5Recording.create(uri, dataset, replace=replace,
+           starttime=flow_file.timestamp, source='file://' + fn)
+    h5.dataset = None     ## Don't store as metadata attribute
+
+    if flow_file.error: h5.associate(model.Annotation.Note(h5.uri.make_uri(), h5.uri,
+                   flow_file.error, tags=[BSML.ErrorTAG],
+                   creator='file://' + os.path.abspath(__file__)))
+
+
+    # h5.annotate(error, tags=, ...)  ####
+
+    ## Graph is only created when getting metadata as graph...
+
+    ## So core abstract object can have a list of annotations and an 'annotate' method??
+
+    ## Also device model, firmware rev, serial number, etc...
+    ## Also study details (from filename path...)
+    integer = layout.get('integer', False)
+    options = { 'dtype': 'i2' if integer else 'f4' }
+    if integer: options['gain'] = INTEGER_GAIN    # Gaps have flowfile.MISSING_VALUE (see mark_missing())
+    if layout.get('compression') is not None:
+      options['compression'] = compression_option(layout['compression'])
+    flow = h5.new_signal(None, units=units.get_units_uri('lpm'),
+      id=0, rate=50, label='Flow', **options)
+    pressure = h5.new_signal(None, units=units.get_units_uri('cmH2O'),
+      id=1, rate=1,  label='CPAP Pressure', **options)
+    leak = h5.new_signal(None, units=units.get_units_uri('lpm'),
+      id=2, rate=1,  label='Leak', **options)
+    duration = 0
+    for fdata, pdata, ldata in flow_file.data(raw=integer):   # Extend datasets as data is decoded
+      flow.append(UniformTimeSeries(fdata, rate=50))
+      pressure.append(UniformTimeSeries(pdata, rate=1))
+      leak.append(UniformTimeSeries(ldata, rate=1))
+      duration += len(pdata)
+    for start, length, pos, size in flow_file.gaps:
+      segment = h5.new_segment(h5.uri.make_uri(), start, length)
+      h5.associate(model.Annotation.Note(h5.uri.make_uri(), segment.uri,
+                   "Corrupt data (%d bytes at file offset %d)" % (size, pos), tags=[BSML.ErrorTAG],
+                   creator='file://' + os.path.abspath(__file__)))
+    h5.duration = duration
+    h5.save_metadata()
+    h5.close()
+  finally:
+    flow_file.close()
+  signals = [ '/recording/signal/%d' % n for n in xrange(3) ]
+  if integer: mark_missing(filename, signals)
+  if layout.get('chunks') or layout.get('shuffle'):
+    repack(filename, signals, layout)
+  return filename
+
 
+def _convert(task):
+#==================
+  fn, replace, layout, datadir = task
   try:
-    os.makedirs(datapath, 0755)
-  except OSError:
-    if os.path.isdir(datapath): pass
-    else: raise # Directory creation error
-  h5 = HDF5Recording.create(uri, dataset, replace=replace,
-         starttime=timestamp, source='file://' + fn)
-  h5.dataset = None     ## Don't store as metadata attribute
-
-  if error: h5.associate(model.Annotation.Note(h5.uri.make_uri(), h5.uri,
-                 error, tags=[BSML.ErrorTAG],
-                 creator='file://' + os.path.abspath(__file__)))
-
-
-  # h5.annotate(error, tags=, ...)  ####
-
-  ## Graph is only created when getting metadata as graph...
-
-  ## So core abstract object can have a list of annotations and an 'annotate' method??
-
-  ## Also device model, firmware rev, serial number, etc...
-  ## Also study details (from filename path...)
-  flow = h5.new_signal(None, units=units.get_units_uri('lpm'),
-    id=0, rate=50, label='Flow', dtype='f4')
-  pressure = h5.new_signal(None, units=units.get_units_uri('cmH2O'),
-    id=1, rate=1,  label='CPAP Pressure', dtype='f4')
-  leak = h5.new_signal(None, units=units.get_units_uri('lpm'),
-    id=2, rate=1,  label='Leak', dtype='f4')
-  fdata = []
-  pdata = []
-  ldata = []
-  duration = 0
-  while buf[pos:pos+4] != '\xFF\x7F\x00\x00':
-    rec = buffer(buf[pos:pos+105])
-    duration += 1
-    for i in xrange(50):
-      fdata.append(struct.unpack_from('<h', rec, 2*i)[0]/100.0)
-    pdata.append(struct.unpack_from('<h', rec, 100)[0]/100.0)
-    ldata.append(struct.unpack_from('B', rec, 102)[0]/100.0)
-    if rec[103:105] != '\xFF\xFF':
-      raise Exception("Remainder of file has a short block")
-    pos += 105
-  flow.append(UniformTimeSeries(fdata, rate=50))
-  pressure.append(UniformTimeSeries(pdata, rate=1))
-  leak.append(UniformTimeSeries(ldata, rate=1))
-  h5.duration = duration
-  h5.save_metadata()
-  h5.close()
-
-  buf.close()
-  f.close()
+    return (fn, convert(fn, replace, layout, datadir), None)
+  except Exception, msg:
+    return (fn, None, str(msg))
+
+
+def convert_files(files, replace=False, layout=None, datadir=DATA_PREFIX, jobs=1):
+#=================================================================================
+  """
+  Convert FLOW files, using ``jobs`` processes in parallel.
+
+  :return: A list of the HDF5 files created.
+  """
+  check_layout(layout or { })
+  tasks = [ (fn, replace, layout, datadir) for fn in files ]
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap_unordered(_convert, tasks)
+  else:
+    pool = None
+    results = (_convert(t) for t in tasks)
+  converted = [ ]
+  try:
+    for fn, filename, error in results:
+      if error is None: converted.append(filename)
+      else:             print '%s: %s' % (fn, error)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  return converted
+
+
+def read_rate(files):
+#====================
+  """
+  Read all signal datasets in HDF5 files.
+
+  :return: A tuple with the number of data points read and the time taken.
+  """
+  import h5py
+  points = 0
+  start = time.time()
+  for filename in files:
+    with h5py.File(filename, 'r') as h5:
+      for dset in h5['/recording/signal'].itervalues():
+        for pos in xrange(0, len(dset), 1000000):
+          points += len(dset[pos:pos+1000000])
+  return (points, time.time() - start)
+
+
+def benchmark(files, jobs=1, layouts=LAYOUTS):
+#=============================================
+  """
+  Convert FLOW files using each layout, reporting bytes on disk along with
+  conversion and read times.
+  """
+  print '%-24s %12s %10s %10s %12s' % ('Layout', 'Bytes', 'Convert s', 'Read s', 'Points/s')
+  for name, layout in layouts:
+    datadir = tempfile.mkdtemp()
+    try:
+      start = time.time()
+      converted = convert_files(files, True, layout, datadir, jobs)
+      elapsed = time.time() - start
+      if not converted: continue
+      size = sum(os.path.getsize(f) for f in converted)
+      points, seconds = read_rate(converted)
+      print '%-24s %12d %10.2f %10.2f %12.0f' % (name, size, elapsed, seconds,
+                                                points/seconds if seconds else 0)
+    finally:
+      shutil.rmtree(datadir)
 
 
 if __name__ == '__main__':
 #=========================
 
-  import sys
+  import docopt
+
+  usage = """Usage:
+  %(prog)s [options] FILE...
+  %(prog)s --benchmark [-j N] FILE...
+  %(prog)s (-h | --help)
 
-# Use argparse to add an --overwrite parameter...
+Convert FLOW files to BioSignalML HDF5 files, replacing any existing files.
+
+Options:
+
+  -h --help     Show this text and exit.
+
+  --benchmark   Convert the files using a range of layouts, reporting bytes
+                on disk and read throughput for each layout.
+
+  -c N --chunks=N
+                Store signal datasets in chunks of N data points.
+
+  -z FILTER --compression=FILTER
+                Compress signal datasets using FILTER, one of 'gzip',
+                'gzip=LEVEL', 'lzf', 'szip', or 'none'.
+
+  --shuffle     Apply HDF5's shuffle filter before compression.
+
+  --integer     Store values as 16-bit integers, with a gain of 100. Gaps
+                are stored as -32768 and marked by a 'missing_value'
+                attribute.
+
+  -j N --jobs=N Convert N files in parallel. [default: 1]
+
+Chunk shapes and the shuffle filter are set using HDF5's h5repack utility,
+which can't write 'lzf' compression.
+
+  """
 
 #  fn = 'FlowData/US_Patients/7Day/07167919/FLW0003.FPH'
-  if len(sys.argv) < 2:
-    print 'Usage: %s file(s)' % sys.argv[0]
-    sys.exit(1)
-
-  for f in sys.argv[1:]:
-    try: convert(f, True)      # One block == one second
-    except Exception, msg:
-      print '%s: %s' % (f, msg)
+  args = docopt.docopt(usage % { 'prog': sys.argv[0] } )
+  try:
+    jobs = max(1, int(args['--jobs']))
+    if args['--benchmark']:
+      benchmark(args['FILE'], jobs)
+    else:
+      layout = { 'compression': args['--compression'],
+                 'shuffle': args['--shuffle'],
+                 'integer': args['--integer'] }
+      if args['--chunks'] is not None: layout['chunks'] = int(args['--chunks'])
+      convert_files(args['FILE'], True, layout, jobs=jobs)   # One block == one second
+  except ValueError, msg:
+    sys.exit(msg)
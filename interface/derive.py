@@ -0,0 +1,181 @@
+"""
+Derived channels
+================
+
+Channels computed from a stream's signals, and from other derived channels,
+a block of frames at a time. They're defined in a stream's ``derived`` list
+(see :mod:`language`), for example:::
+
+  derived [
+    flow_rms = rms(signal/0, 1s)
+    leak_adj = signal/2 - 0.5*signal/1
+    ]
+
+Expressions use numbers, ``+``, ``-``, ``*``, ``/`` and parentheses, with
+signals referred to by their URIs, either relative to the stream's recording or
+in angle brackets, and derived channels by name. As ``/`` between names is part
+of a URI, division needs spaces around it.
+
+The functions ``abs(x)``, ``sqrt(x)``, ``exp(x)`` and ``log(x)`` apply to each
+sample, and ``mean(x, T)``, ``rms(x, T)``, ``std(x, T)``, ``min(x, T)`` and
+``max(x, T)`` to a window of the ``T`` seconds (as ``1s`` or ``500ms``) of
+samples ending at each sample. Windows carry on across blocks, and are shorter
+at the start of a stream. NaNs are ignored in windows.
+
+"""
+
+import urlparse
+
+import numpy as np
+
+import windows
+
+
+FUNCTIONS = { 'abs':  np.abs,
+              'sqrt': np.sqrt,
+              'exp':  np.exp,
+              'log':  np.log }
+
+WINDOW_FUNCTIONS = [ 'mean', 'rms', 'std', 'min', 'max' ]
+
+OPERATORS = { '+': np.add,
+              '-': np.subtract,
+              '*': np.multiply,
+              '/': np.true_divide }
+
+
+class _Constant(object):
+#=======================
+
+  def __init__(self, value):
+  #-------------------------
+    self.value = value
+
+  def evaluate(self, columns):
+  #---------------------------
+    return self.value
+
+
+class _Channel(object):
+#======================
+
+  def __init__(self, index):
+  #-------------------------
+    self._index = index
+
+  def evaluate(self, columns):
+  #---------------------------
+    return columns[self._index]
+
+
+class _Operation(object):
+#========================
+
+  def __init__(self, function, *arguments):
+  #----------------------------------------
+    self._function = function
+    self._arguments = arguments
+
+  def evaluate(self, columns):
+  #---------------------------
+    return self._function(*[ a.evaluate(columns) for a in self._arguments ])
+
+
+class _Window(object):
+#=====================
+
+  def __init__(self, name, argument, size):
+  #----------------------------------------
+    self._name = name
+    self._argument = argument
+    self._size = size
+    self._history = np.empty(size - 1)    # The last samples of the previous block
+    self._history.fill(np.nan)
+
+  def evaluate(self, columns):
+  #---------------------------
+    x = self._argument.evaluate(columns)
+    length = len(columns[0])
+    data = np.concatenate((self._history, np.broadcast_to(x, (length,)).astype(np.float64)))
+    self._history = data[length:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      if self._name in [ 'min', 'max' ]:
+        return windows.extremes(data, self._size, np.fmin if self._name == 'min' else np.fmax)
+      valid = ~np.isnan(data)
+      count = windows.sums(valid.astype(np.float64), self._size)
+      values = np.where(valid, data, 0.0)
+      mean = windows.sums(values, self._size)/count
+      if self._name == 'mean': return mean
+      if self._name == 'rms': return np.sqrt(windows.sums(values*values, self._size)/count)
+      return np.sqrt(windows.deviations(data, self._size, mean)/count)
+
+
+class Derivation(object):
+#========================
+
+  def __init__(self, definitions, signals, base, rate):
+  #----------------------------------------------------
+    """
+    Compile the definitions of derived channels.
+
+    :param definitions: A list of ``(name, expression, units)`` tuples, with
+      expressions as parsed by :mod:`language`.
+    :param signals: The URIs of the stream's signals, in channel order.
+    :param base: The URI that relative signal URIs are resolved against.
+    :param rate: The stream's sampling rate.
+    """
+    self._channels = dict((str(uri), n) for n, uri in enumerate(signals))
+    self._base = base
+    self._rate = rate
+    self._derived = [ ]
+    self.names = [ ]
+    self.units = [ ]
+    for name, expression, units in definitions:
+      if name in self.names or urlparse.urljoin(base, name) in self._channels:
+        raise ValueError("Derived channel '%s' is already defined" % name)
+      self._derived.append(self._compile(expression))
+      self._channels[name] = len(signals) + len(self.names)
+      self.names.append(name)
+      self.units.append(units)
+
+  def _compile(self, expression):
+  #------------------------------
+    kind = expression[0]
+    if kind == 'number':
+      return _Constant(expression[1])
+    elif kind == 'signal':
+      ref = expression[1]
+      index = self._channels.get(ref, self._channels.get(urlparse.urljoin(self._base, ref)))
+      if index is None: raise ValueError("'%s' isn't a signal in the stream or a derived channel" % ref)
+      return _Channel(index)
+    elif kind == 'negate':
+      return _Operation(np.negative, self._compile(expression[1]))
+    elif kind == 'call':
+      name, arguments = expression[1], expression[2]
+      if name in FUNCTIONS:
+        if len(arguments) != 1: raise ValueError("%s() takes one argument" % name)
+        return _Operation(FUNCTIONS[name], self._compile(arguments[0]))
+      elif name in WINDOW_FUNCTIONS:
+        if len(arguments) != 2 or arguments[1][0] != 'number':
+          raise ValueError("%s() takes an expression and a window duration" % name)
+        size = max(1, int(round(arguments[1][1]*self._rate)))
+        return _Window(name, self._compile(arguments[0]), size)
+      raise ValueError("Unknown function: %s" % name)
+    return _Operation(OPERATORS[kind], self._compile(expression[1]), self._compile(expression[2]))
+
+  def process(self, data):
+  #-----------------------
+    """
+    Add derived channels to a block of frames.
+
+    :param data: A 2-D array with a row for each frame and a column for each
+      signal.
+    :return: ``data`` with a column for each derived channel after those of the
+      signals.
+    """
+    columns = [ data[:, n] for n in xrange(data.shape[1]) ]
+    for d in self._derived:
+      with np.errstate(invalid='ignore', divide='ignore'):
+        values = d.evaluate(columns)
+      columns.append(np.broadcast_to(values, (len(data),)).astype(np.float64))
+    return np.column_stack(columns)
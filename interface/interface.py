@@ -1,4 +1,5 @@
 import os, sys
+import stat
 import errno
 import select
 import logging
@@ -7,13 +8,25 @@ import multiprocessing
 import multiprocessing.sharedctypes
 import signal as sighandler
 
+import numpy as np
+
 from biosignalml.client import Repository
 from biosignalml.units import get_units_uri
 from biosignalml.model import BSML
 import biosignalml.rdf as rdf
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))   # Shared modules
+
 import language
 import framestream
+import pacing
+import streamformat
+import streamdecoder
+import follower
+import pyramid
+import stages
+import derive
+import events
 
 VERSION = '0.6.0'
 
@@ -40,6 +53,12 @@ def get_units(units, default=None):
   else:                     return get_units_uri(units)
 
 
+def get_specs(specs):
+#--------------------
+  if specs in [None, '']: return [ ]
+  else:                   return specs.replace(',', ' ').split()
+
+
 class SynchroniseCondition(object):
 #==================================
 
@@ -73,9 +92,14 @@ _sender_lock = SynchroniseCondition()
 class SignalReader(multiprocessing.Process):
 #===========================================
 
-  def __init__(self, signal, output, channel, ratechecker, **options):
-  #-------------------------------------------------------------------
+  def __init__(self, signal, output, channel, ratechecker, stages=(), timed=False, **options):
+  #-------------------------------------------------------------------------------------------
     super(SignalReader, self).__init__()
+    self._stages = stages           # Applied to uniformly sampled data
+    self._timed = timed             # Put (time, value) rows, for merging
+    self._rate = None
+    self._start = None              # Time of the first uniform sample
+    self._count = 0                 # Uniform samples put
     self._signal = signal
     self._output = output
     self._channel = channel
@@ -90,19 +114,35 @@ class SignalReader(multiprocessing.Process):
       for ts in self._signal.read(**self._options):
         if _interrupted.is_set(): break
         if ts.is_uniform:
-          self._ratechecker.check(ts.rate)
-          self._output.put_data(self._channel, ts.data)
+          self._rate = stages.stages_rate(self._stages, ts.rate)
+          if self._start is None: self._start = ts.starttime
+          if not self._timed: self._ratechecker.check(self._rate)
+          self._put_uniform(stages.apply_stages(self._stages, ts.data))
         else:
-          self._ratechecker.check(None)
+          if not self._timed: self._ratechecker.check(None)
           self._output.put_data(self._channel, ts.points)
+      else:
+        if self._stages and self._start is not None:
+          data = stages.finish_stages(self._stages)
+          if len(data): self._put_uniform(data)
     except Exception, err:
       logging.error("ERROR: %s", err)
     finally:
       logging.debug("Reader exit... %d", self._channel)
+      if isinstance(self._signal, follower.Follower):
+        logging.info("Followed channel %d: %s", self._channel, self._signal.stats())
       self._output.put_data(self._channel, None)
       self._signal.close()
       logging.debug("Finished channel %d", self._channel)
 
+  def _put_uniform(self, data):
+  #----------------------------
+    if self._timed:
+      times = self._start + (self._count + np.arange(len(data)))/float(self._rate)
+      self._count += len(data)
+      data = np.column_stack((times, data))
+    self._output.put_data(self._channel, data)
+
 
 class RateChecker(object):
 #=========================
@@ -127,20 +167,45 @@ class RateChecker(object):
 class OutputStream(multiprocessing.Process):
 #===========================================
 
-  def __init__(self, recording, options, signals, dtypes, segment, stream_meta, pipename, binary=False):
-  #-----------------------------------------------------------------------------------------------------
+  def __init__(self, recording, options, signals, dtypes, segment, stream_meta, pipename,
+                     binary=False, framed=False, encoding=None, compress=None, speed=None, follow=False,
+                     derived=None, merge=None):
+  #--------------------------------------------------------------------------------------------------------------
+    """
+    Signals are merged onto the timeline of all their sample times, with a first
+    column of times and 64-bit binary values, if a ``merge`` policy is given (see
+    :func:`merging.merge`), or with the ``hold`` policy if any signal isn't
+    uniformly sampled.
+    """
     super(OutputStream, self).__init__()
     rate = options.get('rate')
     units = { -1: get_units(options.get('units')) }
+    filters = { -1: get_specs(options.get('filter')) }
     self._signals = [ ]
+    self._stages = [ ]
     repo = recording.repository
     logging.debug("got recording: %s %s", type(recording), str(recording.uri))
     for n, s in enumerate(signals):
       self._signals.append(repo.get_signal(s[0]))
       units[n] = get_units(s[1].get('units'))
+      if 'filter' in s[1]: filters[n] = get_specs(s[1]['filter'])
+      signal_rate = self._signals[-1].rate if rate is None else rate
+      self._stages.append([ stages.make_filter(f, signal_rate) for f in filters.get(n, filters[-1]) ])
+    self._derivation = None
+    if derived:
+      base = str(recording.uri) + '/'
+      self._derivation = derive.Derivation(derived, [ s[0] for s in signals ], base,
+                                           self._signals[0].rate if rate is None else rate)
+      self._derived_uris = [ urlparse.urljoin(base, name) for name in self._derivation.names ]
+      self._derived_units = [ get_units(u) for u in self._derivation.units ]
     recording.close()
     repo.close()
     logging.debug("got signals: %s", [ (type(s), str(s.uri)) for s in self._signals ])
+    if merge is None and any(s.rate is None for s in self._signals):
+      merge = 'hold'                   # Point signals have no frames to line up
+    if merge is not None and (derived or stream_meta):
+      raise ValueError("A merged stream can't have derived channels or a metadata channel")
+    self._merge = merge
     self._units = units
     self._rate = rate
     self._dtypes = dtypes
@@ -148,10 +213,28 @@ class OutputStream(multiprocessing.Process):
     self._nometadata = not stream_meta
     self._pipename = pipename
     self._binary = binary
+    self._framed = framed or encoding is not None
+    self._encoding = encoding
+    self._compress = compress
+    self._follow = follow
+    self._speed = speed
+    self._pacer = None
+    if speed is not None:                # Merged rows are paced by time
+      self._pacer = pacing.Pacer(1.0 if merge is not None else self._signals[0].rate if rate is None else rate,
+                                 speed)
 
   def run(self):
   #-------------
 
+    class PipeWriter(object):
+    #------------------------
+      def __init__(self, fd):
+        self._fd = fd
+      def write(self, data):
+        send_data(self._fd, data)
+      def flush(self):
+        pass
+
     def send_data(fd, data):
     #-----------------------
       pos = 0
@@ -162,32 +245,96 @@ class OutputStream(multiprocessing.Process):
         pos += select.PIPE_BUF
 
     logging.debug("Running process: %d", self.pid)
-    output = framestream.FrameStream(len(self._signals), self._nometadata, self._binary)
+    derivation = self._derivation
+    output = framestream.FrameStream(len(self._signals), self._nometadata, self._binary,
+                                     derive=None if derivation is None else derivation.process,
+                                     queue=multiprocessing.Queue)
     ratechecker = RateChecker(self._rate)
     readers = [ ]
     fd = os.open(self._pipename, os.O_WRONLY)  # Write will block until there's a reader
     logging.debug("Writing to FD: %d", fd)
+    sync = stat.S_ISREG(os.fstat(fd).st_mode)  # fsync() fails on pipes
 
     for n, s in enumerate(self._signals):
-      readers.append(SignalReader(s, output, n, ratechecker,
+      if self._follow: s = follower.Follower(s, follower.RecordingClosed(str(s.uri), Repository), _interrupted)
+      readers.append(SignalReader(s, output, n, ratechecker, self._stages[n],
                                   rate=self._rate,
                                   units=self._units.get(n, self._units.get(-1)),
                                   dtype=self._dtypes.get(n, self._dtypes.get(-1)),
+                                  timed=self._merge is not None,
                                   interval=self._segment, maxpoints=BUFFER_SIZE))
+    pacer = self._pacer
+    out = None
     try:
       for r in readers: r.start()
-      starting = True
-      for frame in output.frames():
-        if starting:
-          _sender_lock.wait_for_everyone()
-          starting = False
-        if _interrupted.is_set(): break
-        send_data(fd, frame)
-        if not self._binary: send_data(fd, '\n')
-        os.fsync(fd)
+      out = PipeWriter(fd)
+      if self._compress is not None:   # Live data is sent when paced, else on a timer
+        interval = streamformat.COMPRESS_INTERVAL if self._follow and pacer is None else None
+        out = streamformat.Compressor(out, self._compress, interval=interval)
+      if self._merge is not None:
+        units = [ self._units.get(n, self._units.get(-1)) for n in xrange(len(self._signals)) ]
+        if self._framed:
+          writer = streamformat.StreamWriter(out, len(self._signals) + 1, None, '<f8',
+            [ None ] + units, [ None ] + [ signal.uri for signal in self._signals ], self._encoding)
+          write = writer.write
+        elif self._binary:
+          write = lambda data: out.write(data.astype('=f8').tostring())
+        else:
+          write = lambda data: out.write(''.join('%.6f %s\n' % (r[0], ' '.join('%8g' % v for v in r[1:]))
+                                                   for r in data))
+        _sender_lock.wait_for_everyone()
+        origin = None
+        for row, data in output.merged(self._merge):
+          if _interrupted.is_set(): break
+          pos = 0
+          while pos < len(data):
+            end = len(data)
+            if pacer is not None:
+              if origin is None: origin = data[0, 0]
+              end = data[:, 0].searchsorted(data[pos, 0] + pacing.PACING_BATCH*self._speed, 'right')
+              out.flush()
+              pacer.wait(data[pos, 0] - origin)
+            write(data[pos:end])
+            pos = end
+      elif self._framed:
+        units = [ self._units.get(n, self._units.get(-1)) for n in xrange(len(self._signals)) ]
+        uris = [ signal.uri for signal in self._signals ]
+        if derivation is not None:
+          units.extend(self._derived_units)
+          uris.extend(self._derived_uris)
+        writer = streamformat.StreamWriter(out, len(uris),
+          self._signals[0].rate if self._rate is None else self._rate,
+          self._dtypes.get(-1), units, uris, self._encoding)
+        _sender_lock.wait_for_everyone()
+        for frame, data in output.blocks():
+          if _interrupted.is_set(): break
+          if pacer is None:
+            writer.write(data)
+          else:
+            for pos in xrange(0, len(data), pacer.batch):
+              out.flush()
+              pacer.wait(frame + pos)
+              writer.write(data[pos:pos+pacer.batch])
+      else:
+        starting = True
+        for n, frame in enumerate(output.frames()):
+          if starting:
+            _sender_lock.wait_for_everyone()
+            starting = False
+          if _interrupted.is_set(): break
+          if pacer is not None and n % pacer.batch == 0:
+            out.flush()
+            pacer.wait(n)
+          out.write(frame)
+          if not self._binary: out.write('\n')
+          if sync and self._compress is None: os.fsync(fd)
+      out.flush()
+      if pacer is not None:
+        logging.info("%s: %s", self._pipename, pacer.stats())
     except Exception, err:
       logging.error("ERROR: %s", err)
     finally:
+      if isinstance(out, streamformat.Compressor): out.stop()
       for r in readers:
         if r.is_alive(): r.terminate()
       os.close(fd)
@@ -197,8 +344,8 @@ class OutputStream(multiprocessing.Process):
 class InputStream(multiprocessing.Process):
 #==========================================
 
-  def __init__(self, rec_uri, options, metadata, signals, dtypes, pipename, binary=False):
-  #---------------------------------------------------------------------------------------
+  def __init__(self, rec_uri, options, metadata, signals, dtypes, pipename, binary=False, framed=False):
+  #-----------------------------------------------------------------------------------------------------
     super(InputStream, self).__init__()
     rate = options.get('rate')
     if rate is None: raise ValueError("Input rate must be specified")
@@ -207,6 +354,7 @@ class InputStream(multiprocessing.Process):
     self._dtypes = dtypes
     self._pipename = pipename
     self._binary = binary
+    self._framed = framed
     self._repo = Repository(rec_uri)
     kwds = dict(label=options.get('label'), description=options.get('desc'))
     self._recording = self._repo.new_recording(rec_uri, **kwds)
@@ -225,54 +373,105 @@ class InputStream(multiprocessing.Process):
       self._signals.append(self._recording.new_signal(sig_uri,
                                                       get_units(sigopts.get('units'), units),
                                                       **kwds))
+    self._overview = None
+    if options.get('overview'): self._overview = pyramid.OverviewWriter(self._recording, self._signals)
+    self._events = events.EventWriter(self._recording)
+    self._detections = [ ]
+    for s, signal in zip(signals, self._signals):
+      detectors = get_specs(s[1].get('detect', options.get('detect')))
+      self._detections.append(events.Detection([ events.make_detector(d, rate) for d in detectors ],
+                                               self._events, signal.uri) if detectors else None)
 
   def run(self):
   #-------------
 
-    def newdata(n):
-    #--------------
-      return [ [] for i in xrange(n) ] # Independent lists
-
-    def writedata(signals, data):
-    #----------------------------
-      for n, s in enumerate(signals):
-        s.append(data[n], dtype=self._dtypes.get(n, self._dtypes.get(-1)))
-
     logging.debug("Running process: %d", self.pid)
+    if self._framed:
+      self._read_framed()
+      return
     count = 0
     frames = 0
     channels = len(self._signals)
-    data = newdata(channels)
     fd = os.open(self._pipename, os.O_RDONLY | os.O_NONBLOCK)
     logging.debug("Reading from FD: %d", fd)
 
 #    for l in self._infile:      ### Binary.... ???
 # Wrwp in try ... except ... finally
-    buf = ''
+    decompressor = streamformat.Decompressor()
+    decoder = streamdecoder.TextDecoder()
+    blocks = [ ]
     while True:
       ready = select.select([fd], [], [], 0.5)
       if len(ready[0]) == 0: continue
-      indata = os.read(fd, 1024)
+      indata = os.read(fd, streamdecoder.READ_SIZE)
       if indata == '': break
-      buf += indata
-      lines = buf.split('\n')
-      buf = lines.pop(-1)
-      for l in lines:
-        frames += 1
-        for n, d in enumerate(l.split()[1:]):
-          data[n].append(float(d))
-        count += 1
-        if count >= BUFFER_SIZE:
-          writedata(self._signals, data)
-          data = newdata(channels)
-          count = 0
+      rows = decoder.feed(decompressor.feed(indata))
+      if len(rows) == 0: continue
+      blocks.append(rows[:, 1:channels+1])   # After the frame number
+      frames += len(rows)
+      count += len(rows)
+      if count >= BUFFER_SIZE:
+        self._write_blocks(blocks)
+        blocks = [ ]
+        count = 0
+    for rows in [ decoder.feed(decompressor.finish()), decoder.finish() ]:
+      if len(rows):
+        blocks.append(rows[:, 1:channels+1])
+        frames += len(rows)
+        count += len(rows)
     logging.debug("Got %d frames", frames)
     os.close(fd)
-    if count > 0: writedata(self._signals, data)
+    if count > 0: self._write_blocks(blocks)
+    self._finish()
+    self._recording.duration = frames/self._rate
+    self._recording.close()
+    self._repo.close()
+
+  def _read_framed(self):
+  #----------------------
+    frames = 0
+    with open(self._pipename, 'rb') as pipe:  # Blocks until there's a writer
+      try:
+        reader = streamformat.StreamReader(streamformat.StreamInput(pipe))
+        if reader.channels != len(self._signals):
+          raise streamformat.FormatError("Stream has %d channels, not %d" % (reader.channels, len(self._signals)))
+        if reader.rate != self._rate:
+          raise streamformat.FormatError("Stream rate is %s, not %g" % (reader.rate, self._rate))
+        blocks = [ ]
+        count = 0
+        for frame, data in reader.blocks():
+          if _interrupted.is_set(): break
+          blocks.append(data)
+          count += len(data)
+          frames = frame + len(data)
+          if count >= BUFFER_SIZE:
+            self._write_blocks(blocks)
+            blocks = [ ]
+            count = 0
+        if count > 0: self._write_blocks(blocks)
+      except streamformat.FormatError, err:
+        logging.error("ERROR: %s: %s", self._pipename, err)
+    logging.debug("Got %d frames", frames)
+    self._finish()
     self._recording.duration = frames/self._rate
     self._recording.close()
     self._repo.close()
 
+  def _write_blocks(self, blocks):
+  #-------------------------------
+    data = np.concatenate(blocks)
+    for n, s in enumerate(self._signals):
+      s.append(data[:, n], dtype=self._dtypes.get(n, self._dtypes.get(-1)))
+      if self._overview is not None: self._overview.append(n, data[:, n])
+      if self._detections[n] is not None: self._detections[n].process(data[:, n])
+
+  def _finish(self):
+  #-----------------
+    if self._overview is not None: self._overview.close()
+    for d in self._detections:
+      if d is not None: d.finish()
+    if self._events.count: logging.info("%s: %d events", self._recording.uri, self._events.count)
+
 
 class DataSource(rdf.Graph):
 #===========================
@@ -338,9 +537,16 @@ def stream_data(connections, generate='auto', stream_data=True):
 
     stream_meta = options.pop('stream_meta', False)
     binary = options.pop('binary', False)
+    framed = options.pop('framed', False)
+    encoding = options.pop('encoding', None)
+    compress = options.pop('compress', None)
+    speed = options.pop('realtime', None)
+    follow = options.pop('follow', False)
+    merge = options.pop('merge', None)
     signals = [ (urlparse.urljoin(base, sig[0][1:-1]), dict(sig[1:])) for sig in defn[2]]
     if stream_data:
-      write_streams.append(OutputStream(recording, options, signals, dtypes, segment, stream_meta, pipe, binary))
+      write_streams.append(OutputStream(recording, options, signals, dtypes, segment, stream_meta, pipe,
+                                        binary, framed, encoding, compress, speed, follow, defn[4], merge))
       _sender_lock.add_waiter()
 
   for defn in [ d for d in definitions if d[0] == 'recording' ]:
@@ -349,6 +555,9 @@ def stream_data(connections, generate='auto', stream_data=True):
     pipe = create_pipe(defn[1][1])
     options = dict(defn[1][2:])
     binary = options.pop('binary', False)
+    framed = options.pop('framed', False)
+    options.pop('encoding', None)           # Decoding and decompression are automatic
+    options.pop('compress', None)
     signals = [ (urlparse.urljoin(base, sig[0][1:-1]), dict(sig[1:])) for sig in defn[2]]
     turtle = defn[3].strip()
     if generate == 'none' and turtle == '':
@@ -372,7 +581,7 @@ def stream_data(connections, generate='auto', stream_data=True):
                                       + [ '@prefix %s: <%s> .' % (p, u) for (p, u) in PREFIXES.iteritems() ]
                                       + [ turtle ]), format=rdf.Format.TURTLE, base=base)
     if stream_data:
-      read_streams.append(InputStream(rec_uri, options, metadata, signals, dtypes, pipe, binary))
+      read_streams.append(InputStream(rec_uri, options, metadata, signals, dtypes, pipe, binary, framed))
 
   sighandler.signal(sighandler.SIGINT, interrupt)
   try:    # Start all readers before streaming anything
@@ -49,17 +49,71 @@ _interval = pp.Group(pp.CaselessKeyword('segment') + pp.Suppress('=')
                    + pp.Group(_number + (pp.Literal('-') ^ pp.Literal(':')) + _number))
 _binary   = pp.Group(pp.CaselessKeyword('binary')
                    + pp.Optional(pp.Suppress('=') + _yesno, default=True))
+_framed   = pp.Group(pp.CaselessKeyword('framed')
+                   + pp.Optional(pp.Suppress('=') + _yesno, default=True))
+_encoding = pp.Group(pp.CaselessKeyword('encoding') + pp.Suppress('=')
+                   + (pp.CaselessKeyword('int16') ^ pp.CaselessKeyword('varint')))
+_compress = pp.Group(pp.CaselessKeyword('compress')
+                   + pp.Optional(pp.Suppress('=') + pp.Word(pp.nums).setParseAction(lambda t:int(t[0])),
+                                 default=6))
+_overview = pp.Group(pp.CaselessKeyword('overview')
+                   + pp.Optional(pp.Suppress('=') + _yesno, default=True))
+_follow   = pp.Group(pp.CaselessKeyword('follow')
+                   + pp.Optional(pp.Suppress('=') + _yesno, default=True))
+_realtime = pp.Group(pp.CaselessKeyword('realtime')
+                   + pp.Optional(pp.Suppress('=') + _number, default=1.0))
+_merge    = pp.Group(pp.CaselessKeyword('merge') + pp.Suppress('=')
+                   + (pp.CaselessKeyword('hold') ^ pp.CaselessKeyword('nearest') ^ pp.CaselessKeyword('change')))
 _stream_meta = pp.Group(pp.CaselessKeyword('stream_meta')
                    + pp.Optional(pp.Suppress('=') + _yesno, default=True))
 
-_options  = (_rate | _units | _interval | _binary | _stream_meta)
+_options  = (_rate | _units | _interval | _binary | _framed | _encoding | _compress | _realtime
+           | _follow | _merge | _overview | _stream_meta)
+
+_filter = pp.Group(pp.CaselessKeyword('filter') + pp.Suppress('=') + (_string ^ _word))
+_detect = pp.Group(pp.CaselessKeyword('detect') + pp.Suppress('=') + (_string ^ _word))
 
 _desc = pp.Group(pp.CaselessKeyword('description') + pp.Suppress('=') + _string)
 _label = pp.Group(pp.CaselessKeyword('label') + pp.Suppress('=') + (_string ^ _word))
 
 
-_output_options = _options + pp.Optional(',').suppress()
-_output_signal  = pp.Group(_uri + pp.Optional(_units) + pp.Optional(',').suppress())
+## Expressions for derived channels, parsed into nested tuples of
+## ('number', value), ('signal', reference), ('call', name, [args]),
+## ('negate', arg) and (operator, left, right)
+_duration = pp.Regex(r"\d+(\.\d*)?(ms|s)(?!\w)")
+_duration.setParseAction(lambda t:('number', float(t[0][:-2])/1000.0 if t[0].endswith('ms')
+                                              else float(t[0][:-1])))
+_constant = _number.copy().setParseAction(lambda t:('number', float(t[0])))
+_name = pp.Word(pp.alphas + '_', pp.alphanums + '_')
+_reference = (_uri | pp.Regex(r"[A-Za-z_]\w*(/\w+)+") | _name.copy())
+_reference.setParseAction(lambda t:('signal', t[0][1:-1] if t[0].startswith('<') else t[0]))
+
+def _fold(t):
+#------------
+  t = t[0]
+  if len(t) == 2: return ('negate', t[1])
+  result = t[0]
+  for n in xrange(1, len(t), 2): result = (t[n], result, t[n+1])
+  return result
+
+_expression = pp.Forward()
+_call = (_name + pp.Suppress('(') + pp.Group(pp.delimitedList(_expression)) + pp.Suppress(')'))
+_call.setParseAction(lambda t:('call', t[0], list(t[1])))
+_expression <<= pp.infixNotation(_call | _duration | _constant | _reference,
+                                 [ ('-', 1, pp.opAssoc.RIGHT, _fold),
+                                   (pp.oneOf('* /'), 2, pp.opAssoc.LEFT, _fold),
+                                   (pp.oneOf('+ -'), 2, pp.opAssoc.LEFT, _fold) ])
+
+_derived_channel = pp.Group(_name + pp.Suppress('=') + _expression
+                          + pp.Optional(_units) + pp.Optional(',').suppress())
+_output_derived = pp.Group(pp.CaselessKeyword('derived')
+                         + pp.Optional('=').suppress()
+                         + pp.Group(pp.Suppress('[') + pp.ZeroOrMore(_derived_channel) + pp.Suppress(']')))
+
+
+_output_options = (_options | _filter) + pp.Optional(',').suppress()
+_output_sigopts = (_units | _filter) + pp.Optional(',').suppress()
+_output_signal  = pp.Group(_uri + pp.ZeroOrMore(_output_sigopts) + pp.Optional(',').suppress())
 _output_signals = pp.Group(pp.CaselessKeyword('signals')
                          + pp.Optional('=').suppress()
                          + pp.Group(pp.Suppress('[') + pp.ZeroOrMore(_output_signal) + pp.Suppress(']')))
@@ -67,11 +121,12 @@ _output_statement = pp.Group(pp.CaselessKeyword('stream')
                           + pp.Group(_uri
                                    + pp.CaselessKeyword('to').suppress() + _pipe
                                    + pp.ZeroOrMore(_output_options))
-                          + _output_signals)
+                          + _output_signals
+                          + pp.Optional(_output_derived))
 
 
-_input_options = (_options | _desc | _label) + pp.Optional(',').suppress()
-_input_sigopts = (_units | _label | _desc) + pp.Optional(',').suppress()
+_input_options = (_options | _desc | _label | _detect) + pp.Optional(',').suppress()
+_input_sigopts = (_units | _label | _desc | _detect) + pp.Optional(',').suppress()
 _input_signal  = pp.Group(_uri + pp.ZeroOrMore(_input_sigopts))
 _input_signals = pp.Group(pp.CaselessKeyword('signals')
                         + pp.Optional('=').suppress()
@@ -119,7 +174,8 @@ def parse(definition):
     parsed = _grammer.parseString(definition, parseAll=True)
     for p in parsed:
       sigmeta = dict(p[2:])
-      yield (p[0], p[1],  sigmeta.get('signals', []), _join_turtle(sigmeta.get('metadata', [])))
+      derived = [ (d[0], d[1], dict(d[2:]).get('units')) for d in sigmeta.get('derived', []) ]
+      yield (p[0], p[1],  sigmeta.get('signals', []), _join_turtle(sigmeta.get('metadata', [])), derived)
 
   except pp.ParseException as err:
     lines = definition.split('\n')
@@ -144,7 +200,12 @@ if __name__ == '__main__':
       stream_meta = no
      signals [
       <signal/0> units=<http://www.sbpax.org/uome/list.owl#Millivolt>
-      <signal/0> units=mV
+      <signal/0> units=mV filter="notch:50 bandpass:0.5-40"
+      <signal/1>
+      ]
+    derived [
+      flow_rms = rms(signal/0, 1s)
+      leak_adj = signal/1 - 0.5*<signal/0> units=mV
       ]
     recording <http://devel.biosignalml.org/testdata/sinewave>
       from /tmp/pipe2
@@ -152,7 +213,7 @@ if __name__ == '__main__':
       units = 'mV'
       description="An example"
      signals=[
-       <signal/0> label="abc x" description="hgv hgv j" units=mV
+       <signal/0> label="abc x" description="hgv hgv j" units=mV detect="apnea flat:30"
        ] ;
     recording <http://devel.biosignalml.org/testdata/sinewave2>
       from /tmp/pipe3
@@ -182,4 +243,6 @@ if __name__ == '__main__':
       print '   ', sig[0], dict(sig[1:])
     print ''
     print '   ', r[3]
+    for d in r[4]:
+      print '   ', d
     print ''
@@ -1,3 +1,5 @@
+import os, sys
+
 import numpy as np
 
 from biosignalml.client import Repository
@@ -5,18 +7,107 @@ from biosignalml.data import UniformTimeSeries
 import biosignalml.units as units
 import biosignalml.rdf as rdf
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))   # Shared modules
+
+import streamformat
+import streamdecoder
+import pyramid
+
 
 VERSION = '0.1'
 
 BUFFER_SIZE = 50000
 
 
+def append_data(signals, data, overview=None):
+#=============================================
+  for n, s in enumerate(signals):
+    s.append(data[:, n])
+    if overview is not None: overview.append(n, data[:, n])
+
+
+def strm2bsml(infile, rec, signals, columns, delimiter=None, overview=None):
+#===========================================================================
+  """
+  Load a text stream into signals of a recording, saving any RDF/XML found
+  in the stream as the recording's metadata.
+
+  :param columns: The column in the stream of each signal's data.
+  :param overview: An optional :class:`pyramid.OverviewWriter` for the signals.
+  :return: The number of frames read.
+  """
+  decoder = streamdecoder.TextDecoder(delimiter=delimiter)
+  blocks = [ ]
+  count = 0
+  rdfxml = [ ]
+
+  def add_rows(rows):
+  #------------------
+    if len(rows):
+      blocks.append(rows[:, columns])
+      return len(rows)
+    return 0
+
+  partial = ''
+  while True:
+    chunk = infile.read(streamdecoder.READ_SIZE)
+    end = chunk.rfind('\n') + 1
+    if chunk and end == 0:
+      partial += chunk
+      continue
+    if chunk: text = partial + chunk[:end]
+    else:     text = partial + '\n' if partial else ''   # An unterminated last line
+    partial = chunk[end:]
+    if len(rdfxml) == 0 and '<' not in text:
+      count += add_rows(decoder.feed(text))     # Only data
+    else:
+      for l in text.splitlines(True):
+        if (len(rdfxml) > 0
+         or l.startswith('<?xml ')
+         or l.startswith('<rdf:RDF ')):
+          rdfxml.append(l)
+          if l.startswith('</rdf:RDF>'):
+            rec.save_metadata(''.join(rdfxml), rdf.Format.RDFXML)
+            rdfxml = []
+        else:
+          count += add_rows(decoder.feed(l))
+    if count >= BUFFER_SIZE or (not chunk and count > 0):
+      append_data(signals, np.concatenate(blocks), overview)
+      blocks = [ ]
+      count = 0
+    if not chunk: break
+  return decoder.lines
+
+
+def load_framed(reader, signals, overview=None):
+#==============================================
+  """
+  Load a framed stream into signals of a recording, one signal per channel.
+
+  :param reader: A :class:`streamformat.StreamReader` for the stream.
+  :param overview: An optional :class:`pyramid.OverviewWriter` for the signals.
+  :return: The number of frames read.
+  """
+  frames = 0
+  blocks = [ ]
+  count = 0
+  for frame, data in reader.blocks():
+    blocks.append(data)
+    count += len(data)
+    frames = frame + len(data)
+    if count >= BUFFER_SIZE:
+      append_data(signals, np.concatenate(blocks), overview)
+      blocks = [ ]
+      count = 0
+  if count > 0: append_data(signals, np.concatenate(blocks), overview)
+  return frames
+
+
 if __name__ == '__main__':
 #=========================
 
-  import os, sys
-
-  USAGE = 'Usage: %s [options] RECORDING_URI RATE ([-p POS] [-u UNITS] SIGNAL_ID)+' % sys.argv[0]
+  USAGE = ('Usage: %s [-o] [options] RECORDING_URI RATE ([-p POS] [-u UNITS] SIGNAL_ID)+\n'
+           '       %s [-o] -f RECORDING_URI [SIGNAL_ID...]') % (sys.argv[0], sys.argv[0])
 
   ## [-c CHANNELS] # Or determine from first line of input ( = len(l.split()) - 1)
 
@@ -29,16 +120,35 @@ if __name__ == '__main__':
   #--------------------
     if len(args) == 1 and args[0] == '-h':
       print USAGE
-      print """ """
-      sys.exit(0)
-    if len(args) < 4: error_exit()
+      print """
+  -f    The input is a framed stream (as from ``bsml2strm --framed``), whose
+        header gives the rate, units and number of signals. Signal ids default
+        to channel numbers.
 
+  -o    Also store an overview pyramid of each signal, giving the minimum,
+        maximum and mean of every 10, 100 and 1000 samples as companion signals
+        (see ``pyramid.py``).
+
+  Compressed input (as from ``bsml2strm --compress``) is decompressed.
+"""
+      sys.exit(0)
     parameters = { }
+    if len(args) > 1 and args[1] == '-o':
+      parameters['overview'] = True
+      args = args[:1] + args[2:]
+    if len(args) >= 3 and args[1] == '-f':
+      if not args[2].startswith('http://'):
+        error_exit('Invalid recording URI')
+      parameters['framed'] = True
+      parameters['recording'] = args[2]
+      parameters['signals'] = args[3:]
+      return parameters
+    if len(args) < 4: error_exit()
 
     n = 1
     if args[n] == '-d':
       n += 1
-      parameters['delimiter'] = args
+      parameters['delimiter'] = args[n]
       n += 1
     if not args[n].startswith('http://'):
       error_exit('Invalid recording URI')
@@ -76,7 +186,31 @@ if __name__ == '__main__':
 
   args = parse_args(sys.argv)
 
+  infile = streamformat.StreamInput(sys.stdin)
   uri = args['recording']
+  if args.get('framed'):
+    try:
+      reader = streamformat.StreamReader(infile)
+    except streamformat.FormatError, msg:
+      error_exit(msg)
+    if reader.rate is None:
+      error_exit('Stream has no frame rate')
+    ids = args['signals'] or range(reader.channels)
+    if len(ids) != reader.channels:
+      error_exit('Stream has %d channels' % reader.channels)
+    repo = Repository(uri)
+    rec = repo.new_recording(uri)
+    signals = [ rec.new_signal(None, reader.units[n], id=id, rate=reader.rate)
+                  for n, id in enumerate(ids) ]
+    overview = pyramid.OverviewWriter(rec, signals) if args.get('overview') else None
+    frames = load_framed(reader, signals, overview)
+    if overview is not None: overview.close()
+    rec.duration = frames/reader.rate
+    rec.close()
+    repo.close()
+    print rec.graph
+    sys.exit(0)
+
   rate = args['rate']
   signals = args['signals']
 
@@ -86,35 +220,9 @@ if __name__ == '__main__':
   for n, s in enumerate(args['signals']):
     signals.append(rec.new_signal(None, s[1], id=s[2], rate=rate))
 
-  frames = 0
-  count = 0
-  data = [ [] for i in xrange(len(signals)) ] # Independent lists
-  #      [ [] ]*len(signals)                  # Shared list object...
-  rdfxml = [ ]
-  for l in sys.stdin:
-    if (len(rdfxml) > 0
-     or l.startswith('<?xml ')
-     or l.startswith('<rdf:RDF ')):
-      rdfxml.append(l)
-    elif l.startswith('</rdf:RDF>'):
-      rdfxml.append(l)
-      rec.save_metadata(''.join(rdfxml), rdf.Format.RDFXML)
-      rdfxml = []
-    else:
-      frames += 1
-      d = l.split(args.get('delimiter'))
-      for n, s in enumerate(args['signals']):
-        data[n].append(float(d[s[0]]))
-      count += 1
-      if count >= BUFFER_SIZE:
-        for n, s in enumerate(signals): s.append(data[n])
-        count = 0
-        data = [ [] for i in xrange(len(signals)) ] # Independent lists
-
-  if count > 0:
-    for n, s in enumerate(signals):
-#      print data[n]
-      s.append(data[n])
+  overview = pyramid.OverviewWriter(rec, signals) if args.get('overview') else None
+  frames = strm2bsml(infile, rec, signals, [ s[0] for s in args['signals'] ], args.get('delimiter'), overview)
+  if overview is not None: overview.close()
 
   rec.duration = frames/rate
   rec.close()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+
+import numpy as np
+import h5py
+
+import flow2hdf5
+
+
+SIGNALS = [ '/recording/signal/%d' % n for n in xrange(3) ]
+
+
+class RepackTest(unittest.TestCase):
+#===================================
+
+  def setUp(self):
+  #---------------
+    self._dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+  #------------------
+    shutil.rmtree(self._dir)
+
+  def _file(self, **options):
+  #--------------------------
+    filename = os.path.join(self._dir, 'test.h5')
+    with h5py.File(filename, 'w') as h5:
+      for s in SIGNALS:
+        h5.create_dataset(s, data=np.arange(100000, dtype='f4'), maxshape=(None,), chunks=True, **options)
+    return filename
+
+  def test_keeps_filters(self):
+  #----------------------------
+    filename = self._file(compression='gzip', compression_opts=6)
+    self.assertEqual(flow2hdf5.repack_filters(filename, SIGNALS, { 'chunks': 1000 }), [ ])
+    self.assertEqual(flow2hdf5.repack_filters(filename, SIGNALS, { 'shuffle': True }), [ 'SHUF', 'GZIP=6' ])
+
+  def test_no_compression(self):
+  #-----------------------------
+    filename = self._file()
+    self.assertEqual(flow2hdf5.repack_filters(filename, SIGNALS, { 'shuffle': True }), [ 'SHUF' ])
+    self.assertEqual(flow2hdf5.repack_filters(filename, SIGNALS, { 'compression': 'none' }), [ 'NONE' ])
+
+  def test_given_compression(self):
+  #--------------------------------
+    filename = self._file()
+    layout = { 'compression': 'gzip=2', 'shuffle': True }
+    self.assertEqual(flow2hdf5.repack_filters(filename, SIGNALS, layout), [ 'SHUF', 'GZIP=2' ])
+    self.assertRaises(ValueError, flow2hdf5.repack_filters, filename, SIGNALS, { 'compression': 'lzf' })
+
+  @unittest.skipUnless(find_executable('h5repack'), "needs HDF5's h5repack utility")
+  def test_repack(self):
+  #---------------------
+    filename = self._file(compression='gzip')
+    flow2hdf5.repack(filename, SIGNALS, { 'chunks': 1000, 'shuffle': True })
+    with h5py.File(filename, 'r') as h5:
+      for s in SIGNALS:
+        self.assertEqual(h5[s].chunks, (1000,))
+        self.assertTrue(h5[s].shuffle)
+        self.assertEqual(h5[s].compression, 'gzip')
+        self.assertTrue(np.array_equal(h5[s][:], np.arange(100000, dtype='f4')))
+
+
+if __name__ == '__main__':
+#=========================
+  unittest.main()